@@ -0,0 +1,101 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from nifti_io import load_for_output, write_output
+from quantify_soft_tissue_uptake import load_2d_any
+
+# (name, codec) pairs compared by default
+CODECS = [
+    ("float32_gz_default", {"out_dtype": "float32", "compresslevel": None, "uncompressed": False}),
+    ("float32_gz1", {"out_dtype": "float32", "compresslevel": 1, "uncompressed": False}),
+    ("float32_gz6", {"out_dtype": "float32", "compresslevel": 6, "uncompressed": False}),
+    ("native_gz1", {"out_dtype": "native", "compresslevel": 1, "uncompressed": False}),
+    ("native_gz6", {"out_dtype": "native", "compresslevel": 6, "uncompressed": False}),
+    ("float32_nii", {"out_dtype": "float32", "compresslevel": None, "uncompressed": True}),
+    ("native_nii", {"out_dtype": "native", "compresslevel": None, "uncompressed": True}),
+]
+
+
+def synthetic_counts(n, shape, seed=0):
+    """Planar-scintigraphy-like uint16 count images: mostly low background + a brighter body."""
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    yy, xx = np.mgrid[:h, :w]
+    body = (((yy - h / 2) / (h * 0.45)) ** 2 + ((xx - w / 2) / (w * 0.2)) ** 2) < 1
+    for _ in range(n):
+        lam = np.where(body, 40.0, 2.0)
+        yield rng.poisson(lam).astype(np.uint16)[:, :, None], 1.0, 0.0
+
+
+def source_arrays(src_dir, n, shape, out_dtype):
+    if src_dir is None:
+        yield from synthetic_counts(n, shape)
+        return
+    for p in sorted(Path(src_dir).glob("*.nii*"))[:n]:
+        yield load_for_output(p, out_dtype)
+
+
+def run_codec(name, codec, arrays, workdir: Path) -> dict:
+    out_dir = workdir / name
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    t0 = time.perf_counter()
+    paths = []
+    for k, (x, slope, inter) in enumerate(arrays):
+        if codec["out_dtype"] == "float32":
+            x = (x * slope + inter).astype(np.float32) if (slope, inter) != (1.0, 0.0) else x
+            slope, inter = 1.0, 0.0
+        paths.append(write_output(x, out_dir / f"case_{k:06d}_0000.nii.gz", codec, slope, inter))
+    t_write = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for p in paths:
+        load_2d_any(p, channel=0)
+    t_read = time.perf_counter() - t0
+
+    n_bytes = sum(p.stat().st_size for p in paths)
+    shutil.rmtree(out_dir)
+    return {
+        "codec": name,
+        **codec,
+        "n_files": len(paths),
+        "write_s": round(t_write, 4),
+        "read_s": round(t_read, 4),
+        "write_files_per_s": round(len(paths) / t_write, 1) if t_write else None,
+        "read_files_per_s": round(len(paths) / t_read, 1) if t_read else None,
+        "disk_mb": round(n_bytes / 1e6, 3),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare NIfTI output codecs: write time, read time and disk footprint.")
+    ap.add_argument("--src_dir", default=None, help="Folder with real NIfTIs to re-encode. Default: synthetic counts.")
+    ap.add_argument("--n", type=int, default=200, help="Number of files. Default 200.")
+    ap.add_argument("--shape", type=int, nargs=2, default=[256, 1024], help="Synthetic H W. Default 256 1024.")
+    ap.add_argument("--workdir", default=None, help="Scratch folder (default: system temp)")
+    ap.add_argument("--out_json", default=None, help="Optional JSON with the results")
+    args = ap.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="nifti_codec_bench_"))
+    results = []
+    for name, codec in CODECS:
+        arrays = list(source_arrays(args.src_dir, args.n, tuple(args.shape), codec["out_dtype"]))
+        res = run_codec(name, codec, arrays, workdir)
+        results.append(res)
+        print(f"{name:20s} write {res['write_s']:8.3f}s  read {res['read_s']:8.3f}s  disk {res['disk_mb']:9.2f} MB")
+
+    if args.out_json:
+        Path(args.out_json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print("Saved:", args.out_json)
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
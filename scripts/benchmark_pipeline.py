@@ -0,0 +1,379 @@
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import multiprocessing as mp
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+# install locally (NOT in repo): pip install pydicom pyarrow
+import pydicom
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import build_dicom_nifti_reference
+import build_nifti_index
+from build_dicom_index import build_index
+from build_nnunet_inference_inputs import build
+from dicom_store import save_store, scan_roots
+from fix_orientation_2023 import fix_one
+from quantify_soft_tissue_uptake import DEFAULT_MAPPING, case_id_of, iter_results, iter_results_batched
+
+# Benchmark with synthetic data only (no patient data leaves the secured machines).
+# Every stage runs in a fresh process, so peak RSS is per stage and not the max over the whole run.
+
+STAGES = [
+    "dicom_index",
+    "dicom_store",
+    "nifti_index",
+    "reference_join",
+    "inference_inputs",
+    "fix_orientation_data",
+    "fix_orientation_header",
+    "quantify_case",
+    "quantify_batched",
+]
+
+# stages that read the outputs of earlier ones
+STAGE_DEPS = {
+    "reference_join": ["dicom_index", "nifti_index"],
+    "quantify_case": ["inference_inputs"],
+    "quantify_batched": ["inference_inputs"],
+}
+
+PREFIX = "AUT2020"
+
+
+# --------------------------- synthetic fixtures ---------------------------
+
+def synthetic_scan(rng, shape, n_views):
+    """Planar whole-body-like uint16 counts: low background, brighter body, hot bone-like spots."""
+    h, w = shape
+    yy, xx = np.mgrid[:h, :w]
+    body = (((yy - h / 2) / (h * 0.45)) ** 2 + ((xx - w / 2) / (w * 0.2)) ** 2) < 1
+    views = []
+    for _ in range(n_views):
+        lam = np.where(body, 40.0, 2.0)
+        for _ in range(4):
+            cy, cx, r = rng.integers(0, h), rng.integers(0, w), rng.integers(3, max(4, h // 8))
+            lam = lam + 200.0 * (((yy - cy) ** 2 + (xx - cx) ** 2) < r * r)
+        views.append(rng.poisson(lam).astype(np.uint16))
+    return np.stack(views, axis=-1)
+
+
+def synthetic_labels(rng, shape, n_labels=5):
+    """(H,W,1) label map with one disc per foreground label (0 = background)."""
+    h, w = shape
+    yy, xx = np.mgrid[:h, :w]
+    seg = np.zeros((h, w), np.uint8)
+    for k in range(1, n_labels):
+        cy, cx, r = rng.integers(0, h), rng.integers(0, w), rng.integers(4, max(5, h // 6))
+        seg[((yy - cy) ** 2 + (xx - cx) ** 2) < r * r] = k
+    return seg[:, :, None]
+
+
+def write_fake_dicom(path: Path, patient_id, study_uid, series_uid, date, tm, description, pixels):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.20"  # NM Image Storage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = pydicom.Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyDate = date
+    ds.StudyTime = tm
+    ds.AcquisitionDateTime = date + tm
+    ds.AccessionNumber = "ACC" + patient_id[1:]
+    ds.Modality = "NM"
+    ds.StudyDescription = "Skelettszintigraphie"
+    ds.SeriesDescription = description
+    ds.PatientName = "Synthetic^" + patient_id
+    ds.PatientID = patient_id
+    ds.ProtocolName = "WB"
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.tobytes()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+
+
+def make_fixtures(root: Path, n_cases=200, shape=(256, 1024), files_per_series=2, seed=0) -> dict:
+    """Synthetic cohort: NIfTIs in (H,W), (H,W,1) and (H,W,2) layout with acquisition timestamps in
+    the filename, one fake DICOM study (ANT + POST series) per NIfTI at the same timestamp, and a
+    5-label segmentation per nnU-Net case.
+    """
+    rng = np.random.default_rng(seed)
+    nifti_dir = root / f"NIFTI_{PREFIX}"
+    dicom_root = root / f"DICOMS_{PREFIX}"
+    seg_dir = root / "segs"
+    for d in (nifti_dir, dicom_root, seg_dir):
+        d.mkdir(parents=True, exist_ok=True)
+
+    t0 = dt.datetime(2020, 1, 6, 8, 0, 0)
+    dicom_pixels = rng.poisson(5.0, (64, 64)).astype(np.uint16)
+    for k in range(n_cases):
+        ts = t0 + dt.timedelta(minutes=7 * k)
+        date, tm = ts.strftime("%Y%m%d"), ts.strftime("%H%M%S")
+
+        # cycle through the layouts seen in the exports: (H,W), (H,W,1), (H,W,2)
+        layout = k % 3
+        x = synthetic_scan(rng, shape, n_views=2 if layout == 2 else 1)
+        if layout == 0:
+            x = x[:, :, 0]
+        nib.save(nib.Nifti1Image(x, np.eye(4)), nifti_dir / f"scan_{date}{tm}_{k}.nii.gz")
+
+        patient_id = f"P{k // 2:06d}"
+        study_uid = generate_uid()
+        for view in ("ANT", "POST"):
+            series_uid = generate_uid()
+            for j in range(files_per_series):
+                write_fake_dicom(dicom_root / patient_id / study_uid[-12:] / view / f"IM{j:04d}.dcm",
+                                 patient_id, study_uid, series_uid, date, tm, f"WB {view}", dicom_pixels)
+
+    # nnU-Net case ids follow the sorted source files (see build_nnunet_inference_inputs.list_tasks)
+    for i in range(1, n_cases + 1):
+        nib.save(nib.Nifti1Image(synthetic_labels(rng, shape), np.eye(4)), seg_dir / f"{PREFIX}_{i:06d}.nii.gz")
+
+    return {
+        "root": str(root),
+        "nifti_dir": str(nifti_dir),
+        "dicom_root": str(dicom_root),
+        "seg_dir": str(seg_dir),
+        "out_dir": str(root / "out"),
+    }
+
+
+# --------------------------- stages ---------------------------
+# each stage: (fixtures, workers) -> (n_files, n_bytes of the inputs it reads)
+
+def _tree_size(paths):
+    paths = list(paths)
+    return len(paths), sum(p.stat().st_size for p in paths)
+
+
+def _files(folder, pattern="*.nii*"):
+    return sorted(Path(folder).glob(pattern))
+
+
+def _pool_map(fn, items, workers):
+    if workers > 1:
+        with Pool(processes=workers) as pool:
+            return list(pool.imap(fn, items, chunksize=max(1, len(items) // (workers * 8))))
+    return list(map(fn, items))
+
+
+def stage_dicom_index(fx, workers):
+    out = Path(fx["out_dir"]) / "dicom_index_full.csv"
+    build_index([Path(fx["dicom_root"])], workers=workers).to_csv(out, index=False, sep=";")
+    return _tree_size(Path(fx["dicom_root"]).rglob("*.dcm"))
+
+
+def stage_dicom_store(fx, workers):
+    files = scan_roots([Path(fx["dicom_root"])], workers=workers)
+    save_store(files, Path(fx["out_dir"]) / "dicom_store.parquet")
+    return _tree_size(Path(fx["dicom_root"]).rglob("*.dcm"))
+
+
+def stage_nifti_index(fx, workers):
+    build_nifti_index.main(fx["nifti_dir"], str(Path(fx["out_dir"]) / "nifti_index.csv"), ";", workers=workers)
+    return _tree_size(_files(fx["nifti_dir"]))
+
+
+def stage_reference_join(fx, workers):
+    out = Path(fx["out_dir"])
+    build_dicom_nifti_reference.main(out / "dicom_index_full.csv", out / "nifti_index.csv",
+                                     out / "dicom_nifti_reference.csv")
+    return _tree_size([out / "dicom_index_full.csv", out / "nifti_index.csv"])
+
+
+def stage_inference_inputs(fx, workers):
+    out = Path(fx["out_dir"])
+    build([(Path(fx["nifti_dir"]), PREFIX)], out / "ant", out / "post", out / "mapping.csv", workers=workers)
+    return _tree_size(_files(fx["nifti_dir"]))
+
+
+def _stage_fix_orientation(fx, workers, mode):
+    out_dir = Path(fx["out_dir"]) / f"fixed_{mode}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = _files(fx["nifti_dir"])
+    _pool_map(partial(fix_one, in_dir=fx["nifti_dir"], out_dir=str(out_dir), mode=mode),
+              [p.name for p in files], workers)
+    return _tree_size(files)
+
+
+def stage_fix_orientation_data(fx, workers):
+    return _stage_fix_orientation(fx, workers, "data")
+
+
+def stage_fix_orientation_header(fx, workers):
+    return _stage_fix_orientation(fx, workers, "header")
+
+
+def _quantify_tasks(fx):
+    tasks = []
+    for img_path in _files(Path(fx["out_dir"]) / "ant", "*_0000.nii*"):
+        case_id = case_id_of(img_path)
+        tasks.append((case_id, [(None, img_path, Path(fx["seg_dir"]) / f"{case_id}.nii.gz", 0)]))
+    return tasks
+
+
+def stage_quantify_case(fx, workers):
+    tasks = _quantify_tasks(fx)
+    for _ in iter_results(tasks, DEFAULT_MAPPING, workers=workers):
+        pass
+    return _tree_size([p for _, views in tasks for p in views[0][1:3]])
+
+
+def stage_quantify_batched(fx, workers):
+    tasks = _quantify_tasks(fx)
+    for _ in iter_results_batched(tasks, DEFAULT_MAPPING, workers=workers, batch_size=64):
+        pass
+    return _tree_size([p for _, views in tasks for p in views[0][1:3]])
+
+
+STAGE_FUNCS = {name: globals()[f"stage_{name}"] for name in STAGES}
+
+
+# --------------------------- measurement ---------------------------
+
+def peak_rss_mb():
+    """(this process, largest finished child) peak resident set size in MB; None where unknown."""
+    try:
+        import resource
+    except ImportError:
+        # Windows: psutil is optional
+        try:
+            import psutil
+        except ImportError:
+            return None, None
+        return psutil.Process().memory_info().peak_wset / 1e6, None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6
+    return own, children or None
+
+
+def _stage_process(name, fx, workers, queue):
+    try:
+        # stage scripts print progress; keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            n_files, n_bytes = STAGE_FUNCS[name](fx, workers)
+            seconds = time.perf_counter() - t0
+    except Exception:
+        queue.put({"stage": name, "error": traceback.format_exc()})
+        return
+    own, workers_rss = peak_rss_mb()
+    queue.put({
+        "stage": name,
+        "n_files": n_files,
+        "mb": round(n_bytes / 1e6, 3),
+        "seconds": round(seconds, 4),
+        "files_per_s": round(n_files / seconds, 1) if seconds else None,
+        "mb_per_s": round(n_bytes / 1e6 / seconds, 2) if seconds else None,
+        "peak_rss_mb": round(own, 1) if own else None,
+        "peak_rss_worker_mb": round(workers_rss, 1) if workers_rss else None,
+    })
+
+
+def run_stage(name, fx, workers) -> dict:
+    """Run one stage in a fresh (spawned) process and return its measurements."""
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_stage_process, args=(name, fx, workers, queue))
+    proc.start()
+    try:
+        result = queue.get()
+    finally:
+        proc.join()
+    if "error" in result:
+        raise RuntimeError(f"Stage {name} failed:\n{result['error']}")
+    return result
+
+
+def with_deps(stages):
+    wanted = set(stages)
+    for s in stages:
+        wanted.update(STAGE_DEPS.get(s, []))
+    return [s for s in STAGES if s in wanted]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark every pipeline stage on a synthetic scintigraphy cohort.")
+    ap.add_argument("--n", type=int, default=200, help="Number of synthetic scans. Default 200.")
+    ap.add_argument("--shape", type=int, nargs=2, default=[256, 1024], help="H W of the scans. Default 256 1024.")
+    ap.add_argument("--files_per_series", type=int, default=2, help="Fake DICOM files per series. Default 2.")
+    ap.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                    help="Stages to run (prerequisites are added automatically). Default: all.")
+    ap.add_argument("--workers", type=int, default=4, help="Workers passed to every stage. Default 4.")
+    ap.add_argument("--workdir", default=None, help="Fixture folder (kept). Default: system temp, deleted.")
+    ap.add_argument("--out_json", default=None, help="Optional JSON with the results (compare across commits)")
+    args = ap.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="pipeline_bench_"))
+    t0 = time.perf_counter()
+    fx = make_fixtures(workdir, n_cases=args.n, shape=tuple(args.shape), files_per_series=args.files_per_series)
+    Path(fx["out_dir"]).mkdir(parents=True, exist_ok=True)
+    print(f"Fixtures: {args.n} scans in {time.perf_counter() - t0:.1f}s ({workdir})")
+
+    results = []
+    for name in with_deps(args.stages):
+        res = run_stage(name, fx, args.workers)
+        results.append(res)
+        print(f"{name:24s} {res['seconds']:8.3f}s  {res['files_per_s'] or 0:9.1f} files/s  "
+              f"{res['mb_per_s'] or 0:8.2f} MB/s  peak RSS {res['peak_rss_mb'] or 0:7.1f} MB")
+
+    if args.out_json:
+        report = {
+            "meta": {
+                "commit": git_commit(),
+                "date": dt.datetime.now().isoformat(timespec="seconds"),
+                "n": args.n,
+                "shape": args.shape,
+                "files_per_series": args.files_per_series,
+                "workers": args.workers,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "numpy": np.__version__,
+                "nibabel": nib.__version__,
+            },
+            "stages": results,
+        }
+        Path(args.out_json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print("Saved:", args.out_json)
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
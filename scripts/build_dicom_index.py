@@ -1,12 +1,15 @@
 import argparse
-import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pandas as pd
 
-# pydicom is the standard library to read DICOM headers
 # install locally (NOT in repo): pip install pydicom
-import pydicom
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
+
+from dicom_store import iter_dicom_dirs, scan_roots, series_view
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled
 
 
 DICOM_TAGS = {
@@ -21,6 +24,12 @@ DICOM_TAGS = {
 }
 
 
+HEADER_TAGS = [Tag(*(int(x, 16) for x in t)) for t in DICOM_TAGS.values()]
+# all tags we need sit in front of (0020,000E) SeriesInstanceUID -> stop parsing right after it
+LAST_TAG = max(HEADER_TAGS)
+SERIES_TAG = Tag(0x0020, 0x000E)
+
+
 def get_tag(ds, name, default=None):
     # safer: ds.get("PatientID", default) usually works, but we keep a robust version
     try:
@@ -29,57 +38,161 @@ def get_tag(ds, name, default=None):
         return default
 
 
+def _after_last_tag(tag, vr, length):
+    return tag > LAST_TAG
+
+
+def _after_series_tag(tag, vr, length):
+    return tag > SERIES_TAG
+
+
+def read_header(path: Path, series_only=False):
+    """Read just the tags we index and stop parsing right after them.
+    series_only: only SeriesInstanceUID (used to count files of an already known series).
+    """
+    with open(path, "rb") as fp:
+        if series_only:
+            return read_partial(fp, _after_series_tag, force=True, specific_tags=[SERIES_TAG])
+        return read_partial(fp, _after_last_tag, force=True, specific_tags=HEADER_TAGS)
+
+
 def iter_dicom_files(root: Path):
-    # DICOM files may have arbitrary extensions; your screenshots show .dcm, but we do both:
-    for dirpath, _, filenames in os.walk(root):
-        for fn in filenames:
-            p = Path(dirpath) / fn
-            # quick filter (keeps it fast); extend if needed
-            if p.suffix.lower() in {".dcm", ""}:
-                yield p
-            elif p.suffix.lower() in {".ima"}:
-                yield p
-            # else ignore
-
-
-def build_index(roots, max_files_per_series=1):
+    for dirpath, files in iter_dicom_dirs(root):
+        for fn in files:
+            yield dirpath / fn
+
+
+def extract_tags(ds):
+    return {name: get_tag(ds, name, None) for name in DICOM_TAGS}
+
+
+def header_row(root: Path, f: Path, tags: dict, series_uid):
+    return {
+        "dicom_root": str(root),
+        "dicom_example_file": str(f),
+        "patient_id": tags["PatientID"] or "",
+        "study_uid": tags["StudyInstanceUID"] or "",
+        "series_uid": series_uid,
+        "study_date": tags["StudyDate"] or "",
+        "study_time": tags["StudyTime"] or "",
+        "modality": tags["Modality"] or "",
+        "series_description": tags["SeriesDescription"] or "",
+        "protocol_name": tags["ProtocolName"] or "",
+    }
+
+
+def scan_dir(root: Path, dirpath: Path, files, count_mode="read"):
+    """Scan one folder.
+    Returns (rows, counts): one representative header row per series first seen in this
+    folder (in file order) and the number of files per series.
+    count_mode:
+      read: every file is opened, but only up to SeriesInstanceUID
+      dir:  if the first and the last file of the folder share a series, all files of the
+            folder are counted for it without opening the rest (typical one-series-per-folder export)
+    """
+    rows = {}
+    counts = {}
+
+    def read(f, series_only):
+        try:
+            ds = read_header(f, series_only=series_only)
+        except Exception:
+            return None, None
+        return ds, get_tag(ds, "SeriesInstanceUID", None)
+
+    paths = [dirpath / fn for fn in files]
+
+    # full header for the first readable file of the folder
+    i = len(paths)
+    for k, f in enumerate(paths):
+        ds, series_uid = read(f, series_only=False)
+        if series_uid is not None:
+            rows[series_uid] = header_row(root, f, extract_tags(ds), series_uid)
+            counts[series_uid] = 1
+            i = k + 1
+            break
+
+    if count_mode == "dir" and len(rows) == 1 and i < len(paths):
+        series_uid = next(iter(rows))
+        _, last_uid = read(paths[-1], series_only=True)
+        if last_uid == series_uid:
+            counts[series_uid] += len(paths) - i
+            return rows, counts
+
+    for f in paths[i:]:
+        _, series_uid = read(f, series_only=True)
+        if series_uid is None:
+            continue
+        if series_uid not in rows:
+            # new series inside this folder: we need a full header for its representative
+            ds, series_uid = read(f, series_only=False)
+            if series_uid is None:
+                continue
+            rows[series_uid] = header_row(root, f, extract_tags(ds), series_uid)
+        counts[series_uid] = counts.get(series_uid, 0) + 1
+
+    return rows, counts
+
+
+def _scan_task(job, count_mode):
+    # thread worker: folder results + its scan time
+    clock = StageClock()
+    with clock("scan"):
+        rows, counts = scan_dir(*job, count_mode=count_mode)
+    return rows, counts, clock.times
+
+
+def build_index(roots, workers=8, count_mode="read", stats=None):
     """
     We create one row per SeriesInstanceUID (series).
-    We only read up to max_files_per_series files per series (fast), but also count total files.
+    One full header per series is read (its representative file); the other files are only counted
+    (see scan_dir / count_mode).
+    Folders are scanned concurrently (I/O bound, e.g. network shares); results are merged
+    in walk order, so the representative file per series is the same as in a serial scan.
+    stats: RunStats, progress in DICOM files (counted per finished folder), optional.
     """
     series_rows = {}
     series_counts = {}
 
-    for root in roots:
-        for f in iter_dicom_files(root):
-            # Try reading header only (fast). If it fails, skip.
-            try:
-                ds = pydicom.dcmread(str(f), stop_before_pixels=True, force=True)
-            except Exception:
-                continue
+    jobs = [(root, dirpath, files) for root in roots for dirpath, files in iter_dicom_dirs(root)]
+    if stats is not None:
+        stats.total = sum(len(files) for _, _, files in jobs)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        results = ex.map(lambda job: _scan_task(job, count_mode), jobs)
+        for (_, _, files), (rows, counts, times) in zip(jobs, results):
+            if stats is not None:
+                # stage totals only: a folder latency is not a per-file latency
+                stats.add_times(times)
+                stats.file_done(n=len(files))
+            for suid, row in rows.items():
+                # store one representative header per series
+                series_rows.setdefault(suid, row)
+            for suid, n in counts.items():
+                # count files per series
+                series_counts[suid] = series_counts.get(suid, 0) + n
+
+    return index_frame(series_rows, series_counts)
+
+
+def build_index_from_manifest(roots, manifest, workers=8):
+    """Same table as build_index, but built from the file-level scan in dicom_store.py with an
+    on-disk manifest (see dicom_manifest.py): only new or changed files are parsed.
+    """
+    files = scan_roots(roots, manifest=manifest, workers=workers)
+    series = series_view(files)
 
-            series_uid = get_tag(ds, "SeriesInstanceUID", None)
-            if series_uid is None:
-                continue
+    series_rows = {}
+    series_counts = {}
+    for rec in series.to_dict("records"):
+        series_uid = rec["SeriesInstanceUID"]
+        series_rows[series_uid] = header_row(rec["dicom_root"], rec["dicom_example_file"], rec, series_uid)
+        series_counts[series_uid] = rec["n_files_in_series"]
 
-            # count files per series
-            series_counts[series_uid] = series_counts.get(series_uid, 0) + 1
-
-            # store one representative header per series
-            if series_uid not in series_rows:
-                series_rows[series_uid] = {
-                    "dicom_root": str(root),
-                    "dicom_example_file": str(f),
-                    "patient_id": get_tag(ds, "PatientID", ""),
-                    "study_uid": get_tag(ds, "StudyInstanceUID", ""),
-                    "series_uid": series_uid,
-                    "study_date": get_tag(ds, "StudyDate", ""),
-                    "study_time": get_tag(ds, "StudyTime", ""),
-                    "modality": get_tag(ds, "Modality", ""),
-                    "series_description": get_tag(ds, "SeriesDescription", ""),
-                    "protocol_name": get_tag(ds, "ProtocolName", ""),
-                }
+    return index_frame(series_rows, series_counts)
 
+
+def index_frame(series_rows: dict, series_counts: dict) -> pd.DataFrame:
     # add counts
     for suid, row in series_rows.items():
         row["n_files_in_series"] = series_counts.get(suid, 0)
@@ -99,21 +212,41 @@ def main():
     parser.add_argument("--subfolders", type=str, nargs="*", default=["DICOMS_AUT2020", "DICOMS_AUT2023"],
                         help="Which subfolders inside dicom_root to scan.")
     parser.add_argument("--out_csv", type=str, required=True, help="Output CSV path.")
+    parser.add_argument("--workers", type=int, default=8, help="Threads scanning folders concurrently. Default 8.")
+    parser.add_argument("--count_mode", choices=["read", "dir"], default="read",
+                        help="read: open every file up to SeriesInstanceUID to count it. "
+                             "dir: trust a folder to be one series when its first and last file agree.")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="SQLite manifest (path -> size, mtime, tags). Rescans only parse new/changed files.")
+    add_instrumentation_args(parser)
     args = parser.parse_args()
 
+    with profiled(args.profile):
+        run(args)
+
+
+def run(args):
+    stats = RunStats("build_dicom_index", progress_every=args.progress_every)
     dicom_root = Path(args.dicom_root)
     roots = [dicom_root / s for s in args.subfolders]
     roots = [r for r in roots if r.exists()]
     if not roots:
         raise FileNotFoundError(f"No valid DICOM subfolders found under {dicom_root} (checked {args.subfolders})")
 
-    df = build_index(roots)
+    if args.manifest:
+        with stats.stage("scan"):
+            df = build_index_from_manifest(roots, args.manifest, workers=args.workers)
+        stats.file_done(n=int(df["n_files_in_series"].sum()) if len(df) else 0)
+    else:
+        df = build_index(roots, workers=args.workers, count_mode=args.count_mode, stats=stats)
     out_csv = Path(args.out_csv)
     out_csv.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(out_csv, index=False, sep=";")
+    with stats.stage("write"):
+        df.to_csv(out_csv, index=False, sep=";")
     print("Saved:", out_csv)
     print("Rows (series):", len(df))
     print("Unique patients:", df["patient_id"].nunique() if "patient_id" in df.columns else "n/a")
+    stats.report(args.log_json, extra={"series": len(df)})
 
 
 if __name__ == "__main__":
@@ -1,47 +1,72 @@
 import argparse
 from pathlib import Path
 import pandas as pd
-import pydicom
 
-def get_tag(ds, name, default=""):
-    return str(getattr(ds, name, default) or default)
+from dicom_store import scan_paths, save_store
+from instrumentation import RunStats, add_instrumentation_args, profiled
+
+FILE_TAGS = [
+    "PatientID",
+    "PatientName",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "StudyDate",
+    "StudyTime",
+    "AcquisitionDateTime",
+    "AccessionNumber",
+    "StudyDescription",
+    "SeriesDescription",
+]
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--dicom_root", required=True)
     ap.add_argument("--out_csv", required=True)
     ap.add_argument("--sep", default=";")
+    ap.add_argument("--manifest", default=None,
+                    help="SQLite manifest (path -> size, mtime, tags). Rescans only parse new/changed files.")
+    ap.add_argument("--workers", type=int, default=8, help="Threads for stat/header reads")
+    ap.add_argument("--out_parquet", default=None,
+                    help="Also write the typed file-level index (categorical UIDs, parsed datetimes) as Parquet")
+    add_instrumentation_args(ap)
     args = ap.parse_args()
 
+    with profiled(args.profile):
+        run(args)
+
+def run(args):
+    stats = RunStats("build_dicom_index_LOCAL", progress_every=args.progress_every)
     dicom_root = Path(args.dicom_root)
-    rows = []
+    with stats.stage("discover"):
+        paths = [str(p) for p in dicom_root.rglob("*.dcm")]
+    stats.total = len(paths)
 
-    for p in dicom_root.rglob("*.dcm"):
-        try:
-            ds = pydicom.dcmread(str(p), stop_before_pixels=True, force=True)
-        except Exception:
-            continue
+    with stats.stage("scan"):
+        tags_by_path = scan_paths(paths, manifest=args.manifest, roots=[dicom_root], workers=args.workers, stats=stats)
 
-        rows.append({
-            "file_path": str(p),
-            "PatientID": get_tag(ds, "PatientID"),
-            "PatientName": get_tag(ds, "PatientName"),
-            "StudyInstanceUID": get_tag(ds, "StudyInstanceUID"),
-            "SeriesInstanceUID": get_tag(ds, "SeriesInstanceUID"),
-            "SOPInstanceUID": get_tag(ds, "SOPInstanceUID"),
-            "StudyDate": get_tag(ds, "StudyDate"),
-            "StudyTime": get_tag(ds, "StudyTime"),
-            "AcquisitionDateTime": get_tag(ds, "AcquisitionDateTime"),
-            "AccessionNumber": get_tag(ds, "AccessionNumber"),
-            "StudyDescription": get_tag(ds, "StudyDescription"),
-            "SeriesDescription": get_tag(ds, "SeriesDescription"),
-        })
+    rows = []
+    for p in paths:
+        tags = tags_by_path.get(p)
+        if tags is None:
+            continue
+        rows.append({"file_path": p, **{name: tags[name] for name in FILE_TAGS}})
 
     df = pd.DataFrame(rows)
-    df.to_csv(args.out_csv, index=False, sep=args.sep)
+    with stats.stage("write"):
+        df.to_csv(args.out_csv, index=False, sep=args.sep)
     print("Saved:", args.out_csv)
     print("Rows:", len(df))
     print("Columns:", list(df.columns))
 
+    if args.out_parquet:
+        with stats.stage("write"):
+            save_store(pd.DataFrame(
+                [{"dicom_root": str(dicom_root), "file_path": p, **tags_by_path[p]} for p in paths if tags_by_path.get(p)],
+            ), args.out_parquet)
+        print("Saved:", args.out_parquet)
+
+    stats.report(args.log_json)
+
 if __name__ == "__main__":
     main()
@@ -1,107 +1,268 @@
-import argparse
-from pathlib import Path
-import pandas as pd
-
-
-def pick_col(df, candidates):
-    """Return first column name that exists in df.columns from candidates list."""
-    for c in candidates:
-        if c in df.columns:
-            return c
-    return None
-
-
-def normalize_cols(df):
-    """Strip whitespace from column names."""
-    df.columns = [c.strip() for c in df.columns]
-    return df
-
-
-def main(dicom_index, nifti_index, out_csv, sep=";"):
-    dicom_index = Path(dicom_index)
-    nifti_index = Path(nifti_index)
-    out_csv = Path(out_csv)
-
-    df_d = pd.read_csv(dicom_index, sep=sep, dtype=str)
-    df_n = pd.read_csv(nifti_index, sep=sep, dtype=str)
-
-    df_d = normalize_cols(df_d)
-    df_n = normalize_cols(df_n)
-
-    # --- detect date/time columns ---
-    d_date = pick_col(df_d, ["StudyDate", "study_date", "date", "DATE"])
-    d_time = pick_col(df_d, ["StudyTime", "study_time", "time", "TIME"])
-
-    n_date = pick_col(df_n, ["StudyDate", "study_date", "date", "DATE"])
-    n_time = pick_col(df_n, ["StudyTime", "study_time", "time", "TIME"])
-
-    if not d_date or not d_time:
-        raise ValueError(f"DICOM index is missing date/time columns. Found: {list(df_d.columns)}")
-    if not n_date or not n_time:
-        raise ValueError(f"NIfTI index is missing date/time columns. Found: {list(df_n.columns)}")
-
-    # --- normalize (trim spaces) ---
-    df_d[d_date] = df_d[d_date].astype(str).str.strip()
-    df_d[d_time] = df_d[d_time].astype(str).str.strip()
-    df_n[n_date] = df_n[n_date].astype(str).str.strip()
-    df_n[n_time] = df_n[n_time].astype(str).str.strip()
-
-    # --- key ---
-    df_d["key"] = df_d[d_date] + "_" + df_d[d_time]
-    df_n["key"] = df_n[n_date] + "_" + df_n[n_time]
-
-    # Optional: prefer ANT before POST if SeriesDescription exists
-    if "SeriesDescription" in df_d.columns:
-        df_d["SeriesDescription"] = df_d["SeriesDescription"].fillna("").astype(str)
-        df_d = df_d.sort_values(["key", "SeriesDescription"])
-
-    df_d_one = df_d.drop_duplicates(subset=["key"], keep="first").copy()
-
-    keep_cols = [
-        "key",
-        "PatientID", "PatientName",
-        "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID",
-        "AccessionNumber",
-        "StudyDescription", "SeriesDescription",
-        "file_path",
-        d_date, d_time,
-    ]
-    keep_cols = [c for c in keep_cols if c in df_d_one.columns]
-
-    df_out = df_n.merge(df_d_one[keep_cols], on="key", how="left")
-
-    # match flag
-    df_out["match_found"] = df_out["PatientID"].notna().astype(int)
-
-    # rename nifti date/time to standard output names
-    df_out = df_out.rename(columns={n_date: "StudyDate", n_time: "StudyTime"})
-
-    # reorder columns nicely (only if they exist)
-    front = ["nifti_filename", "nifti_path", "StudyDate", "StudyTime", "match_found"]
-    front = [c for c in front if c in df_out.columns]
-    rest = [c for c in df_out.columns if c not in front]
-    df_out = df_out[front + rest]
-
-    out_csv.parent.mkdir(parents=True, exist_ok=True)
-    df_out.to_csv(out_csv, index=False, sep=sep)
-
-    n_total = len(df_out)
-    n_match = int(df_out["match_found"].sum())
-    print("Saved:", out_csv)
-    print(f"Matched {n_match}/{n_total} NIfTIs ({(100*n_match/n_total):.1f}%)")
-
-    if n_match < n_total:
-        print("\nFirst unmatched rows:")
-        cols_show = [c for c in ["nifti_filename", "StudyDate", "StudyTime"] if c in df_out.columns]
-        print(df_out[df_out["match_found"] == 0][cols_show].head(10))
-
-
-if __name__ == "__main__":
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--dicom_index", required=True)
-    ap.add_argument("--nifti_index", required=True)
-    ap.add_argument("--out_csv", required=True)
-    ap.add_argument("--sep", default=";")
-    args = ap.parse_args()
-
-    main(args.dicom_index, args.nifti_index, args.out_csv, sep=args.sep)
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from dicom_store import parse_dicom_datetime
+from instrumentation import RunStats, add_instrumentation_args, profiled
+
+
+def pick_col(df, candidates):
+    """Return first column name that exists in df.columns from candidates list."""
+    for c in candidates:
+        if c in df.columns:
+            return c
+    return None
+
+
+def normalize_cols(df):
+    """Strip whitespace from column names."""
+    df.columns = [c.strip() for c in df.columns]
+    return df
+
+
+def read_index(path: Path, sep=";"):
+    """Load an index table: typed Parquet store (see dicom_store.py) or a ';' CSV read as strings."""
+    if path.suffix.lower() == ".parquet":
+        df = pd.read_parquet(path)
+        # categoricals -> strings with missing values as "" (like empty CSV cells after the fillna below),
+        # so the key/sort logic behaves like on the CSVs
+        for c in df.select_dtypes("category").columns:
+            df[c] = df[c].astype("string").fillna("")
+        return df
+    return pd.read_csv(path, sep=sep, dtype=str)
+
+
+def to_timestamp(date: pd.Series, time: pd.Series) -> pd.Series:
+    """DICOM DA + TM strings (fractional seconds allowed) -> ns since epoch (nullable Int64, exact),
+    <NA> if unparsable."""
+    return datetime_to_ns(parse_dicom_datetime(date, time))
+
+
+def datetime_to_ns(ts: pd.Series) -> pd.Series:
+    """datetime64 column (NaT = missing) -> ns since epoch (nullable Int64)."""
+    out = pd.Series(pd.NA, index=ts.index, dtype="Int64")
+    ok = ts.notna()
+    out[ok] = ts[ok].astype("datetime64[ns]").astype("int64")
+    return out
+
+
+def index_timestamp(df: pd.DataFrame, date_col: str, time_col: str) -> pd.Series:
+    """"_ts" of an index: the StudyDateTime the Parquet store already parsed (dicom_store.to_typed),
+    otherwise parsed from the date/time strings."""
+    if date_col == "StudyDate" and pd.api.types.is_datetime64_any_dtype(df.get("StudyDateTime")):
+        return datetime_to_ns(df["StudyDateTime"])
+    return to_timestamp(df[date_col], df[time_col])
+
+
+def count_candidates(left_ts: np.ndarray, right_ts_sorted: np.ndarray, tol_ns: int):
+    """For every left timestamp: index range [lo, hi) of right timestamps within +-tol (binary search)."""
+    lo = np.searchsorted(right_ts_sorted, left_ts - tol_ns, side="left")
+    hi = np.searchsorted(right_ts_sorted, left_ts + tol_ns, side="right")
+    return lo, hi
+
+
+def match_nearest(df_n, df_d, tol_s=1.0, by=None, candidates=None):
+    """Nearest-timestamp join of NIfTI rows (left) onto DICOM rows (right) within +-tol_s seconds.
+
+    Both frames need an integer "_ts" column (Int64, <NA> = no timestamp). Sorted as-of join (merge_asof),
+    optionally per `by` column (e.g. PatientID), so it stays O(n log n). Adds match_delta_s and
+    n_candidates: rows of `candidates` (default df_d, e.g. one row per study) within
+    tolerance; n_candidates > 1 means ambiguous.
+    """
+    tol_ns = int(round(tol_s * 1e9))
+    left = df_n.reset_index(drop=True)
+    left["_row"] = np.arange(len(left))
+    has_ts = left["_ts"].notna()
+
+    l = left[has_ts].copy()
+    l["_ts"] = l["_ts"].astype("int64")
+    l = l.sort_values("_ts", kind="stable")
+    r = df_d[df_d["_ts"].notna()].copy()
+    r["_ts"] = r["_ts"].astype("int64")
+    r = r.sort_values("_ts", kind="stable")
+    r["_ts_dicom"] = r["_ts"]
+
+    merged = pd.merge_asof(
+        l, r, on="_ts", by=by, direction="nearest", tolerance=tol_ns, suffixes=("", "_dicom"),
+    )
+    merged["match_delta_s"] = (merged["_ts_dicom"] - merged["_ts"]) / 1e9
+
+    c = r if candidates is None else candidates[candidates["_ts"].notna()].copy()
+    c["_ts"] = c["_ts"].astype("int64")
+    c = c.sort_values("_ts", kind="stable")
+
+    # candidate counts via binary search on the sorted DICOM timestamps (per group if `by`)
+    n_cand = np.zeros(len(merged), dtype=np.int64)
+    if by is None:
+        lo, hi = count_candidates(merged["_ts"].to_numpy(), c["_ts"].to_numpy(), tol_ns)
+        n_cand[:] = hi - lo
+    else:
+        r_groups = {k: g["_ts"].to_numpy() for k, g in c.groupby(by, sort=False)}
+        for k, idx in merged.groupby(by, sort=False).indices.items():
+            ts_r = r_groups.get(k)
+            if ts_r is None:
+                continue
+            lo, hi = count_candidates(merged["_ts"].to_numpy()[idx], ts_r, tol_ns)
+            n_cand[idx] = hi - lo
+    merged["n_candidates"] = n_cand
+
+    # rows without a parsable timestamp stay in the output, unmatched
+    out = pd.concat([merged, left[~has_ts]], ignore_index=True)
+    out["n_candidates"] = out["n_candidates"].fillna(0).astype(int)
+    out = out.sort_values("_row").reset_index(drop=True)
+    return out.drop(columns=["_row", "_ts_dicom"])
+
+
+def path_key(paths: pd.Series) -> pd.Series:
+    """Resolved path strings, so the same file written as relative/absolute path compares equal."""
+    return paths.map(lambda p: str(Path(p).resolve()) if isinstance(p, str) and p else pd.NA)
+
+
+def merge_reference(out: pd.DataFrame, ref: pd.DataFrame) -> pd.DataFrame:
+    """Left join of the reference columns onto rows with source_path, on the NIfTI path (not the filename:
+    two source folders can hold files with the same name). One reference row per NIfTI file."""
+    ref = ref[ref["nifti_path"].notna()].drop(columns=["nifti_filename"], errors="ignore")
+    ref = ref.assign(_path=path_key(ref["nifti_path"])).drop(columns=["nifti_path"])
+    out = out.assign(_path=path_key(out["source_path"]))
+    return out.merge(ref, on="_path", how="left", validate="many_to_one").drop(columns=["_path"])
+
+
+def main(dicom_index, nifti_index, out_csv, sep=";", tol_s=1.0, ambiguous_csv=None, log_json=None,
+         progress_every=500):
+    dicom_index = Path(dicom_index)
+    nifti_index = Path(nifti_index)
+    out_csv = Path(out_csv)
+    stats = RunStats("build_dicom_nifti_reference", progress_every=progress_every)
+
+    with stats.stage("read"):
+        df_d = read_index(dicom_index, sep=sep)
+        df_n = read_index(nifti_index, sep=sep)
+    stats.total = len(df_n)
+
+    df_d = normalize_cols(df_d)
+    df_n = normalize_cols(df_n)
+
+    # --- detect date/time columns ---
+    d_date = pick_col(df_d, ["StudyDate", "study_date", "date", "DATE"])
+    d_time = pick_col(df_d, ["StudyTime", "study_time", "time", "TIME"])
+
+    n_date = pick_col(df_n, ["StudyDate", "study_date", "date", "DATE"])
+    n_time = pick_col(df_n, ["StudyTime", "study_time", "time", "TIME"])
+
+    if not d_date or not d_time:
+        raise ValueError(f"DICOM index is missing date/time columns. Found: {list(df_d.columns)}")
+    if not n_date or not n_time:
+        raise ValueError(f"NIfTI index is missing date/time columns. Found: {list(df_n.columns)}")
+
+    # --- normalize (trim spaces) ---
+    df_d[d_date] = df_d[d_date].fillna("").astype(str).str.strip()
+    df_d[d_time] = df_d[d_time].fillna("").astype(str).str.strip()
+    df_n[n_date] = df_n[n_date].fillna("").astype(str).str.strip()
+    df_n[n_time] = df_n[n_time].fillna("").astype(str).str.strip()
+
+    # --- key (exact string, kept for reference) + integer timestamps for the tolerant join ---
+    df_d["key"] = df_d[d_date] + "_" + df_d[d_time]
+    df_n["key"] = df_n[n_date] + "_" + df_n[n_time]
+    with stats.stage("parse"):
+        df_d["_ts"] = index_timestamp(df_d, d_date, d_time)
+        df_n["_ts"] = index_timestamp(df_n, n_date, n_time)
+
+    # group by patient only if both sides know it (the filename-based NIfTI index usually doesn't);
+    # the two indexes may name it differently (file-level PatientID, series-level patient_id)
+    d_patient = pick_col(df_d, ["PatientID", "patient_id"])
+    n_patient = pick_col(df_n, ["PatientID", "patient_id"])
+    by = None
+    if d_patient and n_patient:
+        by = "_patient"
+        df_d[by] = df_d[d_patient].fillna("").astype(str).str.strip()
+        df_n[by] = df_n[n_patient].fillna("").astype(str).str.strip()
+
+    # Optional: prefer ANT before POST if SeriesDescription exists
+    if "SeriesDescription" in df_d.columns:
+        df_d["SeriesDescription"] = df_d["SeriesDescription"].fillna("").astype(str)
+        df_d = df_d.sort_values(["_ts", "SeriesDescription"], kind="stable")
+
+    # files/series of the same study share one timestamp: one DICOM row per timestamp (per patient)
+    df_d_one = df_d.drop_duplicates(subset=["_ts"] + ([by] if by else []), keep="first").copy()
+    # ambiguity is counted over distinct studies, so two patients scanned at the same second show up
+    d_study = pick_col(df_d, ["StudyInstanceUID", "study_uid"])
+    df_d_studies = df_d.drop_duplicates(subset=["_ts"] + ([by] if by else []) + ([d_study] if d_study else []))
+
+    keep_cols = [
+        "_ts", "_patient",
+        "PatientID", "PatientName",
+        "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID",
+        "AccessionNumber",
+        "StudyDescription", "SeriesDescription",
+        "file_path",
+        # series-level index (build_dicom_index.py) names
+        "patient_id", "study_uid", "series_uid", "series_description",
+        d_date, d_time,
+    ]
+    keep_cols = [c for c in keep_cols if c in df_d_one.columns]
+    # avoid clashes with the NIfTI date/time columns (same names in both indexes)
+    df_d_one = df_d_one[keep_cols].rename(columns={
+        c: f"dicom_{c}" for c in (d_date, d_time) if c in df_n.columns
+    })
+
+    with stats.stage("match"):
+        df_out = match_nearest(df_n, df_d_one, tol_s=tol_s, by=by, candidates=df_d_studies).drop(
+            columns=["_ts", "_patient"], errors="ignore")
+    stats.file_done(n=len(df_out))
+    df_out["match_ambiguous"] = (df_out["n_candidates"] > 1).astype(int)
+
+    # match flag
+    df_out["match_found"] = df_out["match_delta_s"].notna().astype(int)
+
+    # rename nifti date/time to standard output names
+    df_out = df_out.rename(columns={n_date: "StudyDate", n_time: "StudyTime"})
+
+    # reorder columns nicely (only if they exist)
+    front = ["nifti_filename", "nifti_path", "StudyDate", "StudyTime", "match_found",
+             "match_delta_s", "n_candidates", "match_ambiguous"]
+    front = [c for c in front if c in df_out.columns]
+    rest = [c for c in df_out.columns if c not in front]
+    df_out = df_out[front + rest]
+
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    with stats.stage("write"):
+        df_out.to_csv(out_csv, index=False, sep=sep)
+
+    n_total = len(df_out)
+    n_match = int(df_out["match_found"].sum())
+    print("Saved:", out_csv)
+    print(f"Matched {n_match}/{n_total} NIfTIs ({(100*n_match/n_total):.1f}%)")
+
+    n_amb = int(df_out["match_ambiguous"].sum())
+    if n_amb:
+        print(f"Ambiguous: {n_amb} NIfTIs have >1 DICOM study within +-{tol_s}s (nearest one kept)")
+        if ambiguous_csv:
+            cols_amb = [c for c in ["nifti_filename", "StudyDate", "StudyTime", "n_candidates",
+                                    "match_delta_s", "PatientID", "SeriesInstanceUID"] if c in df_out.columns]
+            df_out[df_out["match_ambiguous"] == 1][cols_amb].to_csv(ambiguous_csv, index=False, sep=sep)
+            print("Saved:", ambiguous_csv)
+
+    if n_match < n_total:
+        print("\nFirst unmatched rows:")
+        cols_show = [c for c in ["nifti_filename", "StudyDate", "StudyTime"] if c in df_out.columns]
+        print(df_out[df_out["match_found"] == 0][cols_show].head(10))
+    stats.report(log_json, extra={"matched": n_match, "ambiguous": n_amb})
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dicom_index", required=True)
+    ap.add_argument("--nifti_index", required=True)
+    ap.add_argument("--out_csv", required=True)
+    ap.add_argument("--sep", default=";")
+    ap.add_argument("--tolerance_s", type=float, default=1.0,
+                    help="Max |StudyDateTime difference| in seconds for a match (0 = exact). Default 1.")
+    ap.add_argument("--ambiguous_csv", default=None,
+                    help="Optional CSV listing NIfTIs with more than one DICOM candidate within tolerance")
+    add_instrumentation_args(ap)
+    args = ap.parse_args()
+
+    with profiled(args.profile):
+        main(args.dicom_index, args.nifti_index, args.out_csv, sep=args.sep, tol_s=args.tolerance_s,
+             ambiguous_csv=args.ambiguous_csv, log_json=args.log_json, progress_every=args.progress_every)
@@ -1,8 +1,20 @@
 import argparse
 import csv
+import gzip
 import re
+from multiprocessing import Pool
 from pathlib import Path
 
+import nibabel as nib
+import numpy as np
+
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled
+
+# Index columns: file + timestamp from the name, and the header fields downstream builders route on
+# (shape, n_frames, ...), so nobody has to decompress a file just to find out what it contains.
+INDEX_COLUMNS = ["nifti_path", "nifti_filename", "StudyDate", "StudyTime",
+                 "shape", "ndim", "dtype", "n_frames", "pixdim", "file_size", "header_error"]
+
 def extract_datetime(name):
     """
     Sucht YYYYMMDDHHMMSS im Dateinamen
@@ -12,31 +24,114 @@ def extract_datetime(name):
         return m.group(1), m.group(2)
     return None, None
 
-def main(nifti_root, out_csv, sep):
-    nifti_root = Path(nifti_root)
+def read_header(path):
+    """NIfTI-1 header from the first 348 bytes (.nii.gz: only the first gzip block is inflated)."""
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return nib.Nifti1Header.from_fileobj(f, check=False)
 
-    rows = []
-    for f in nifti_root.glob("*.nii.gz"):
-        date, time = extract_datetime(f.name)
-        rows.append({
-            "nifti_path": str(f),
-            "nifti_filename": f.name,
-            "StudyDate": date,
-            "StudyTime": time
+def format_shape(shape):
+    return "x".join(str(n) for n in shape)
+
+def parse_shape(s):
+    """'256x1024x2' -> (256, 1024, 2), '' / NaN -> None"""
+    if not isinstance(s, str) or not s:
+        return None
+    return tuple(int(n) for n in s.split("x"))
+
+def index_row(path):
+    path = Path(path)
+    date, time = extract_datetime(path.name)
+    row = {"nifti_path": str(path), "nifti_filename": path.name, "StudyDate": date, "StudyTime": time,
+           "shape": "", "ndim": "", "dtype": "", "n_frames": "", "pixdim": "", "file_size": path.stat().st_size,
+           "header_error": ""}
+    try:
+        hdr = read_header(path)
+        shape = hdr.get_data_shape()
+        row.update({
+            "shape": format_shape(shape),
+            "ndim": len(shape),
+            "dtype": str(hdr.get_data_dtype()),
+            # 2D planes in the file: (H,W) -> 1, (H,W,2) -> 2, (H,W,Z,C) -> Z*C
+            "n_frames": int(np.prod(shape[2:], dtype=np.int64)),
+            "pixdim": "x".join(f"{z:g}" for z in hdr.get_zooms()),
         })
+    except Exception as e:
+        row["header_error"] = f"{type(e).__name__}: {e}"[:300]
+    return row
+
+def list_nifti(nifti_root):
+    return sorted(Path(nifti_root).glob("*.nii*"))
 
+def _index_task(path):
+    # pool worker: index row + its stage times
+    clock = StageClock()
+    with clock("header"):
+        row = index_row(path)
+    return row, clock.times
+
+def _collect(results, stats=None):
+    rows = []
+    for row, times in results:
+        rows.append(row)
+        if stats is not None:
+            stats.file_done(times)
+            if row["header_error"]:
+                stats.error("unreadable header", f"{row['nifti_filename']}: {row['header_error']}")
+    return rows
+
+def build_index(files, workers=1, stats=None):
+    """One row per file (in the given order); headers are read in parallel with workers > 1.
+    stats: RunStats for progress, header timings and unreadable-header counts (optional)."""
+    files = list(files)
+    if stats is not None:
+        stats.total = len(files)
+    if workers > 1 and len(files) > 1:
+        chunksize = max(1, min(256, len(files) // (workers * 8)))
+        with Pool(processes=workers) as pool:
+            return _collect(pool.imap(_index_task, files, chunksize=chunksize), stats)
+    return _collect(map(_index_task, files), stats)
+
+def write_index(rows, out_csv, sep=";"):
+    # fixed columns: an empty folder gives a header-only CSV instead of a crash
+    Path(out_csv).parent.mkdir(parents=True, exist_ok=True)
     with open(out_csv, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=rows[0].keys(), delimiter=sep)
+        writer = csv.DictWriter(csvfile, fieldnames=INDEX_COLUMNS, delimiter=sep)
         writer.writeheader()
         writer.writerows(rows)
 
-    print(f"Saved {len(rows)} rows to {out_csv}")
+def load_index(index_csv, sep=";"):
+    """{resolved nifti_path: row} of an index CSV, shape parsed back into a tuple (None if unreadable)."""
+    index = {}
+    with open(index_csv, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter=sep):
+            row["shape"] = parse_shape(row.get("shape", ""))
+            index[str(Path(row["nifti_path"]).resolve())] = row
+    return index
+
+def main(nifti_root, out_csv, sep, workers=1, log_json=None, progress_every=500):
+    stats = RunStats("build_nifti_index", progress_every=progress_every)
+    with stats.stage("discover"):
+        files = list_nifti(nifti_root)
+    rows = build_index(files, workers=workers, stats=stats)
+    with stats.stage("write"):
+        write_index(rows, out_csv, sep)
+
+    n_bad = sum(bool(r["header_error"]) for r in rows)
+    print(f"Saved {len(rows)} rows to {out_csv}" + (f" ({n_bad} unreadable headers)" if n_bad else ""))
+    stats.report(log_json)
+    return rows
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description="Index NIfTIs: timestamp from the file name + header metadata "
+                                                 "(shape, dtype, n_frames, pixdim, size), no pixel data is read.")
     parser.add_argument("--nifti_root", required=True)
     parser.add_argument("--out_csv", required=True)
     parser.add_argument("--sep", default=";")
+    parser.add_argument("--workers", type=int, default=8, help="Processes reading headers. Default 8.")
+    add_instrumentation_args(parser)
     args = parser.parse_args()
 
-    main(args.nifti_root, args.out_csv, args.sep)
+    with profiled(args.profile):
+        main(args.nifti_root, args.out_csv, args.sep, workers=args.workers, log_json=args.log_json,
+             progress_every=args.progress_every)
@@ -0,0 +1,251 @@
+import argparse
+import csv
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from build_nifti_index import load_index
+from build_nnunet_inference_inputs_ant import extract_ant_as_hw1
+from build_nnunet_inference_inputs_post import extract_post_as_hw1
+from decoded_cache import add_decode_cache_args, decode_cache_from_args
+from deduplicate_scans import alias_case_ids, load_duplicates
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled, shape_layout
+from nifti_io import add_codec_args, codec_from_args, load_for_output, write_output
+
+MAPPING_COLUMNS = ["case_id", "source_path", "source_filename", "source_shape", "ant_path", "post_path",
+                   "canonical_case_id"]
+
+
+def process_one(task, out_ant: Path, out_post: Path, codec: dict, reorient=None, rot180=()):
+    """Load one source NIfTI once and write both views (whatever is available).
+    reorient: axcodes to flip header-only orientation fixes into the pixels (see fix_orientation_2023.py)
+    rot180:   views to rotate by 180 deg on the fly (replaces a separate ant_180/post_180 pass)
+    Returns (mapping row, stage times, skip reasons).
+    """
+    p, prefix, i = task
+    case_id = f"{prefix}_{i:06d}"
+    clock = StageClock()
+    skipped = []
+
+    with clock("read"):
+        x, slope, inter = load_for_output(p, codec["out_dtype"], reorient=reorient)
+
+    row = {
+        "case_id": case_id,
+        "source_path": str(p),
+        "source_filename": p.name,
+        "source_shape": "x".join(str(n) for n in x.shape),
+        "ant_path": "",
+        "post_path": "",
+    }
+
+    if out_ant is not None:
+        with clock("extract"):
+            ant = extract_ant_as_hw1(x)
+            if ant is not None and "ant" in rot180:
+                ant = np.rot90(ant, 2, axes=(0, 1))
+        if ant is None:
+            skipped.append(f"ant: unsupported shape {shape_layout(x.shape)}")
+        else:
+            # cleanheader: identity affine + qform/sform
+            with clock("write"):
+                out_path = write_output(ant, out_ant / f"{case_id}_0000.nii.gz", codec, slope, inter)
+            row["ant_path"] = str(out_path)
+
+    if out_post is not None:
+        with clock("extract"):
+            post = extract_post_as_hw1(x)
+            if post is not None and "post" in rot180:
+                post = np.rot90(post, 2, axes=(0, 1))
+        if post is None:
+            skipped.append(f"post: unsupported shape {shape_layout(x.shape)}")
+        else:
+            with clock("write"):
+                out_path = write_output(post, out_post / f"{case_id}_0000.nii.gz", codec, slope, inter)
+            row["post_path"] = str(out_path)
+
+    return row, clock.times, skipped
+
+
+def views_for_shape(shape) -> dict:
+    """{"ant": bool, "post": bool} for a source shape, decided by the extractors themselves on a
+    zero-stride stand-in array (no pixel data needed)."""
+    dummy = np.broadcast_to(np.zeros((), dtype=np.uint8), shape)
+    return {"ant": extract_ant_as_hw1(dummy) is not None, "post": extract_post_as_hw1(dummy) is not None}
+
+
+def skip_by_index(p: Path, index: dict, views=("ant", "post")):
+    """Skip reasons for a source whose indexed header has none of the wanted views, None = process it.
+    Files missing from the index (e.g. added after indexing) are processed as usual."""
+    entry = index.get(str(Path(p).resolve()))
+    if entry is None:
+        return None
+    if entry["header_error"] or entry["shape"] is None:
+        return ["unreadable header"]
+    supported = views_for_shape(entry["shape"])
+    if any(supported[v] for v in views):
+        return None
+    return [f"{v}: unsupported shape {shape_layout(entry['shape'])}" for v in views]
+
+
+def skipped_row(p: Path, case_id: str, index: dict) -> dict:
+    """Mapping row of a source skipped from the index (no inputs written)."""
+    entry = index.get(str(Path(p).resolve()), {})
+    return {"case_id": case_id, "source_path": str(p), "source_filename": p.name,
+            "source_shape": "x".join(str(n) for n in entry.get("shape") or ()), "ant_path": "", "post_path": ""}
+
+
+def alias_row(p: Path, case_id: str, canonical_row: dict) -> dict:
+    """Mapping row of a duplicate source: its own case/source, the inputs of its canonical case."""
+    return {**canonical_row, "case_id": case_id, "source_path": str(p), "source_filename": p.name,
+            "canonical_case_id": canonical_row["case_id"]}
+
+
+def list_tasks(sources):
+    """sources: [(folder, prefix)] -> [(path, prefix, i)], numbered like the single-view builders."""
+    tasks = []
+    for folder, prefix in sources:
+        files = sorted(Path(folder).glob("*.nii*"))
+        tasks.extend((p, prefix, i) for i, p in enumerate(files, start=1))
+    return tasks
+
+
+def build(sources, out_ant, out_post, mapping_csv, workers=1, chunksize=None, codec=None,
+          reorient=None, rot180=(), stats=None, index=None, duplicates=None):
+    """index: {path: row} from build_nifti_index.load_index; sources without a usable view are
+    skipped from their header metadata, without being decompressed.
+    duplicates: {path: canonical path} from deduplicate_scans.load_duplicates; duplicates are not
+    written again, their mapping rows point to the inputs of the canonical case (canonical_case_id)."""
+    stats = stats or RunStats("build_nnunet_inference_inputs")
+    with stats.stage("discover"):
+        tasks = list_tasks(sources)
+    print("Files:", len(tasks))
+
+    # index: decide from the header which sources have nothing to extract ({case_id: (mapping row, reasons)})
+    skipped_by_index = {}
+    if index:
+        views = [v for v, out in (("ant", out_ant), ("post", out_post)) if out is not None]
+        for p, prefix, i in tasks:
+            reasons = skip_by_index(p, index, views)
+            if reasons is not None:
+                case_id = f"{prefix}_{i:06d}"
+                skipped_by_index[case_id] = (skipped_row(p, case_id, index), reasons)
+        print("Skipped from the index:", len(skipped_by_index))
+    aliases = {}
+    if duplicates:
+        aliases = {a: c for a, c in alias_case_ids(tasks, duplicates).items()
+                   if a not in skipped_by_index and c not in skipped_by_index}
+        print("Duplicates (routed to their canonical case):", len(aliases))
+    drop = skipped_by_index.keys() | aliases.keys()
+    todo = [t for t in tasks if f"{t[1]}_{t[2]:06d}" not in drop]
+    stats.total = len(todo)
+
+    for out in (out_ant, out_post):
+        if out is not None:
+            out.mkdir(parents=True, exist_ok=True)
+
+    codec = codec or {"out_dtype": "float32", "compresslevel": None, "uncompressed": False}
+    fn = partial(process_one, out_ant=out_ant, out_post=out_post, codec=codec, reorient=reorient, rot180=rot180)
+    if chunksize is None:
+        chunksize = max(1, min(64, len(todo) // (max(workers, 1) * 8)))
+
+    n_ant = n_post = 0
+    if workers > 1:
+        pool = Pool(processes=workers)
+        results = pool.imap(fn, todo, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(fn, todo)
+
+    rows = {}
+    try:
+        for row, times, skipped in results:
+            row["canonical_case_id"] = row["case_id"]
+            rows[row["case_id"]] = row
+            n_ant += bool(row["ant_path"])
+            n_post += bool(row["post_path"])
+            for reason in skipped:
+                stats.skip(reason)
+            stats.file_done(times)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for p, prefix, i in tasks:
+        case_id = f"{prefix}_{i:06d}"
+        if case_id in skipped_by_index:
+            row, skipped = skipped_by_index[case_id]
+            rows[case_id] = {**row, "canonical_case_id": case_id}
+            for reason in skipped:
+                stats.skip(reason)
+        elif case_id in aliases:
+            rows[case_id] = alias_row(p, case_id, rows[aliases[case_id]])
+
+    # mapping rows stay in source order: skipped sources and duplicates are merged back in between
+    mapping_csv.parent.mkdir(parents=True, exist_ok=True)
+    with open(mapping_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=MAPPING_COLUMNS, delimiter=";")
+        writer.writeheader()
+        writer.writerows(rows[f"{prefix}_{i:06d}"] for _, prefix, i in tasks)
+
+    print("DONE | files:", len(tasks), "| ANT written:", n_ant, "| POST written:", n_post)
+    print("Mapping:", mapping_csv)
+    return n_ant, n_post
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Build nnU-Net inference inputs for the anterior and posterior view in one pass over the sources.")
+    ap.add_argument("--src", nargs=2, action="append", metavar=("FOLDER", "PREFIX"), required=True,
+                    help="Source folder + case prefix, e.g. --src ...\\NIFTI_AUT2020 AUT2020 (repeatable)")
+    ap.add_argument("--out_ant", default=None, help="Output folder for anterior <case>_0000.nii.gz")
+    ap.add_argument("--out_post", default=None, help="Output folder for posterior <case>_0000.nii.gz")
+    ap.add_argument("--mapping_csv", required=True, help="case_id -> source file mapping (';' separated)")
+    ap.add_argument("--workers", type=int, default=1, help="Worker processes. Default 1 (serial).")
+    ap.add_argument("--chunksize", type=int, default=None, help="Files per pool task. Default: auto.")
+    add_codec_args(ap)
+    add_decode_cache_args(ap)
+    add_instrumentation_args(ap)
+    ap.add_argument("--reorient", default=None, metavar="AXCODES",
+                    help="Flip sources into this orientation from their affine. For files fixed with "
+                         "fix_orientation_2023.py --mode header: the orientation of the original sources "
+                         "(RAS for this cohort, printed by the fix), which gives the --mode data pixels.")
+    ap.add_argument("--rot180", nargs="*", choices=["ant", "post"], default=[],
+                    help="Rotate these views by 180 deg while writing (instead of ant_180/post_180 afterwards)")
+    ap.add_argument("--nifti_index", default=None,
+                    help="Index CSV from build_nifti_index.py: sources without a usable view (by header shape) "
+                         "are skipped without decompressing them")
+    ap.add_argument("--sep", default=";", help="Separator of --nifti_index and --dedup_csv. Default ';'")
+    ap.add_argument("--dedup_csv", default=None,
+                    help="Duplicate table from deduplicate_scans.py scan: duplicates are not written again, they "
+                         "map to their canonical case (column canonical_case_id)")
+    args = ap.parse_args()
+    decode_cache_from_args(args)
+
+    if not args.out_ant and not args.out_post:
+        raise ValueError("Nothing to do: give --out_ant and/or --out_post")
+
+    stats = RunStats("build_nnunet_inference_inputs", progress_every=args.progress_every)
+    with profiled(args.profile):
+        build(
+            [(Path(folder), prefix) for folder, prefix in args.src],
+            Path(args.out_ant) if args.out_ant else None,
+            Path(args.out_post) if args.out_post else None,
+            Path(args.mapping_csv),
+            workers=args.workers,
+            chunksize=args.chunksize,
+            codec=codec_from_args(args),
+            reorient=args.reorient,
+            rot180=tuple(args.rot180),
+            stats=stats,
+            index=load_index(args.nifti_index, args.sep) if args.nifti_index else None,
+            duplicates=load_duplicates(args.dedup_csv, args.sep) if args.dedup_csv else None,
+        )
+    stats.report(args.log_json)
+
+
+if __name__ == "__main__":
+    main()
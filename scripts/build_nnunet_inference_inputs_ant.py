@@ -1,15 +1,25 @@
-import nibabel as nib
 import numpy as np
 from pathlib import Path
 
+from instrumentation import RunStats, StageClock, profiled, shape_layout
+from nifti_io import load_for_output, write_output
+
 SRC_2020 = Path(r"C:PATH")
 SRC_2023 = Path(r"C:PATH")
 
 OUT = Path(r"PATH")
-OUT.mkdir(exist_ok=True)
 
 I = np.eye(4, dtype=np.float32)
 
+# Output format (see nifti_io.py): "native" keeps e.g. uint16 counts + scl_slope instead of float32,
+# compresslevel 1 is much faster to write than the default, uncompressed writes plain .nii
+CODEC = {"out_dtype": "float32", "compresslevel": None, "uncompressed": False}
+
+# Instrumentation (see instrumentation.py): progress every N files, JSON run log / cProfile dump (None = off)
+PROGRESS_EVERY = 2000
+LOG_JSON = None
+PROFILE = None
+
 def extract_ant_as_hw1(x):
     # returns (H,W,1) or None
     if x.ndim == 2:
@@ -20,39 +30,50 @@ def extract_ant_as_hw1(x):
         return x[:, :, 0][:, :, None]  # anterior
     return None  # skip 4D etc.
 
-def process(folder: Path, prefix: str):
-    files = sorted(folder.glob("*.nii*"))
+def process(folder: Path, prefix: str, stats: RunStats):
+    with stats.stage("discover"):
+        files = sorted(folder.glob("*.nii*"))
+    stats.total = (stats.total or 0) + len(files)
     written = 0
     skipped = 0
 
     for i, p in enumerate(files, start=1):
-        nii = nib.load(str(p))
-        x = np.asanyarray(nii.dataobj).astype(np.float32)
+        clock = StageClock()
+        with clock("read"):
+            x, slope, inter = load_for_output(p, CODEC["out_dtype"])
 
         ant = extract_ant_as_hw1(x)
         if ant is None:
             skipped += 1
+            stats.skip(f"unsupported shape {shape_layout(x.shape)}")
+            stats.file_done(clock.times)
             continue
 
         # cleanheader
-        out_nii = nib.Nifti1Image(ant, I)
-        out_nii.set_qform(I, code=1)
-        out_nii.set_sform(I, code=1)
-
-        out_path = OUT / f"{prefix}_{i:06d}_0000.nii.gz"
-        nib.save(out_nii, str(out_path))
+        with clock("write"):
+            write_output(ant, OUT / f"{prefix}_{i:06d}_0000.nii.gz", CODEC, slope, inter, affine=I)
         written += 1
-
-        if written % 2000 == 0:
-            print(prefix, "written:", written, "skipped:", skipped)
+        stats.file_done(clock.times)
 
     print(prefix, "DONE | written:", written, "skipped:", skipped)
     return written, skipped
 
-w1 = process(SRC_2020, "AUT2020")
-w2 = process(SRC_2023, "AUT2023")
+def main():
+    with profiled(PROFILE):
+        run()
+
+def run():
+    stats = RunStats("build_nnunet_inference_inputs_ant", progress_every=PROGRESS_EVERY)
+    OUT.mkdir(exist_ok=True)
+
+    w1 = process(SRC_2020, "AUT2020", stats)
+    w2 = process(SRC_2023, "AUT2023", stats)
+
+    print("TOTAL written:", w1[0] + w2[0])
+    print("TOTAL skipped:", w1[1] + w2[1])
+    print("OUT count:", len(list(OUT.glob("*.nii*"))))
+    print("OUT:", OUT)
+    stats.report(LOG_JSON)
 
-print("TOTAL written:", w1[0] + w2[0])
-print("TOTAL skipped:", w1[1] + w2[1])
-print("OUT count:", len(list(OUT.glob("*.nii*"))))
-print("OUT:", OUT)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+from results_cache import file_fingerprint
+
+# Local content-addressed cache of decoded NIfTI arrays, shared by all scripts.
+# Key = sha1(content hash of the source file + transform), value = uncompressed .npy that is
+# memory-mapped on later reads, so the same .nii.gz is gunzipped only once across scripts and runs.
+# Configured through the environment (inherited by pool workers and by the scripts without argparse):
+#   SOFT_TISSUE_DECODE_CACHE     cache folder (unset = no caching)
+#   SOFT_TISSUE_DECODE_CACHE_MB  size cap, least recently used entries are evicted. Default 20000.
+
+ENV_DIR = "SOFT_TISSUE_DECODE_CACHE"
+ENV_MB = "SOFT_TISSUE_DECODE_CACHE_MB"
+DEFAULT_MB = 20000
+
+# last_used is only rewritten when older than this, so cache hits stay read-only most of the time
+TOUCH_EVERY_S = 600
+
+
+class DecodedCache:
+    """<root>/<key[:2]>/<key>.npy + index.sqlite (file hashes by stat, entries with size and last use)."""
+
+    def __init__(self, root, max_mb=DEFAULT_MB):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(float(max_mb) * 1024 * 1024)
+        # a sqlite connection must not cross a fork: get_cache() reopens the cache in forked workers
+        self.pid = os.getpid()
+        # several pool workers share the index: WAL + busy timeout instead of failing on a lock
+        self.con = sqlite3.connect(str(self.root / "index.sqlite"), timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS file_hashes ("
+                             " path TEXT PRIMARY KEY, stat_fp TEXT NOT NULL, sha1 TEXT NOT NULL)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS entries ("
+                             " key TEXT PRIMARY KEY, nbytes INTEGER NOT NULL, last_used REAL NOT NULL,"
+                             " meta_json TEXT NOT NULL)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        # the cap may have been lowered since the last run
+        self.evict()
+
+    def content_hash(self, path: Path) -> str:
+        """sha1 of the file content, recomputed only when size/mtime changed."""
+        path = str(Path(path).resolve())
+        stat_fp = file_fingerprint(path)
+        hit = self.con.execute("SELECT stat_fp, sha1 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if hit is not None and hit[0] == stat_fp:
+            return hit[1]
+        sha1 = file_fingerprint(path, "hash")
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?)", (path, stat_fp, sha1))
+        return sha1
+
+    def key(self, path: Path, transform: str) -> str:
+        return hashlib.sha1(f"{self.content_hash(path)}|{transform}".encode()).hexdigest()
+
+    def _file(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.npy"
+
+    def get(self, key: str):
+        """(read-only memmap, meta) or None."""
+        hit = self.con.execute("SELECT last_used, meta_json FROM entries WHERE key = ?", (key,)).fetchone()
+        if hit is None:
+            return None
+        try:
+            x = np.load(self._file(key), mmap_mode="r")
+        except (OSError, ValueError):
+            # file evicted or damaged behind our back
+            with self.con:
+                self.con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        now = time.time()
+        if now - hit[0] > TOUCH_EVERY_S:
+            with self.con:
+                self.con.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+        return x, json.loads(hit[1])
+
+    def put(self, key: str, x: np.ndarray, meta: dict):
+        f = self._file(key)
+        f.parent.mkdir(exist_ok=True)
+        tmp = f.with_name(f"{key}.{os.getpid()}.tmp.npy")
+        np.save(tmp, np.asanyarray(x))
+        try:
+            # atomic: readers never see a half-written .npy
+            os.replace(tmp, f)
+        except OSError:
+            # another process stored the same key in the meantime (and may have it mapped)
+            tmp.unlink(missing_ok=True)
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                             (key, f.stat().st_size, time.time(), json.dumps(meta)))
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is below its size cap."""
+        total = self.con.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for key, nbytes in self.con.execute("SELECT key, nbytes FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                self._file(key).unlink(missing_ok=True)
+            except OSError:
+                # still memory-mapped somewhere (Windows): try again next time
+                continue
+            with self.con:
+                self.con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= nbytes
+            removed += 1
+        return removed
+
+    def load(self, path: Path, transform: str, decode):
+        """decode() -> (array, meta dict), served from the cache when path + transform were decoded before."""
+        key = self.key(path, transform)
+        hit = self.get(key)
+        if hit is not None:
+            return hit
+        x, meta = decode()
+        self.put(key, x, meta)
+        return x, meta
+
+
+_cache = None
+
+
+def get_cache():
+    """The cache configured in the environment (one instance per process, reopened after a fork) or None."""
+    global _cache
+    root = os.environ.get(ENV_DIR)
+    if not root:
+        return None
+    if _cache is None or _cache.root != Path(root) or _cache.pid != os.getpid():
+        _cache = DecodedCache(root, os.environ.get(ENV_MB, DEFAULT_MB))
+    return _cache
+
+
+def cached_decode(path: Path, transform: str, decode):
+    """decode() -> (array, meta); goes through the decoded cache if one is configured.
+    Only .nii.gz files are cached (plain .nii is memory-mapped by nibabel anyway).
+    """
+    cache = get_cache()
+    if cache is None or not str(path).endswith(".gz"):
+        return decode()
+    return cache.load(path, transform, decode)
+
+
+def configure(cache_dir=None, max_mb=None):
+    """Enable the cache for this process and every worker started afterwards."""
+    if cache_dir:
+        os.environ[ENV_DIR] = str(cache_dir)
+    if max_mb:
+        os.environ[ENV_MB] = str(max_mb)
+
+
+def add_decode_cache_args(ap):
+    """--decode_cache / --decode_cache_mb, shared by every script that decodes NIfTIs."""
+    ap.add_argument("--decode_cache", default=None,
+                    help=f"Folder of the decoded-image cache (.npy memmaps, shared across scripts). "
+                         f"Default: ${ENV_DIR} if set, else no cache.")
+    ap.add_argument("--decode_cache_mb", type=float, default=None,
+                    help=f"Size cap of the decoded-image cache in MB (LRU eviction). Default {DEFAULT_MB}.")
+
+
+def decode_cache_from_args(args):
+    configure(args.decode_cache, args.decode_cache_mb)
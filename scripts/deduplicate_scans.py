@@ -0,0 +1,222 @@
+import argparse
+import csv
+import hashlib
+import sqlite3
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from build_nifti_index import read_header
+from decoded_cache import add_decode_cache_args, decode_cache_from_args
+from instrumentation import RunStats, add_instrumentation_args, profiled
+from nifti_io import load_for_output
+from results_cache import file_fingerprint
+
+# Duplicate scans across the source folders (overlapping 2020/2023 exports, re-exports of a study under
+# another filename). Two passes: a pre-key from the 348-byte header (shape, dtype, scaling, affine) groups
+# the candidates without decompressing anything; only files that share a pre-key get their decoded pixels
+# hashed. Every duplicate is routed to one canonical scan (the first in source order); inference and
+# quantification run once per canonical case and the results are copied to its aliases (fan_out).
+# The compressed file size is not part of the key: gzip stores the original filename, so re-exports differ.
+
+DEDUP_COLUMNS = ["source_path", "canonical_path", "pixel_sha1"]
+
+
+def header_key(path: Path, extra: str = ""):
+    """Cheap pre-key from the header only (None if unreadable). extra: processing options that change
+    the output (rot180, reorient), so identical pixels processed differently are not merged."""
+    try:
+        hdr = read_header(path)
+    except Exception:
+        return None
+    slope, inter = hdr.get_slope_inter()
+    parts = [hdr.get_data_shape(), str(hdr.get_data_dtype()), slope, inter,
+             np.round(hdr.get_best_affine(), 4).tolist(), extra]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def pixel_hash(path: Path) -> str:
+    """sha1 of the decoded on-disk pixels (+ shape, dtype, slope/inter). Goes through the decoded cache
+    (entry of load_for_output(path, "native")): builders running with --out_dtype native reuse it, other
+    output dtypes are a different cache entry and decode the file again."""
+    x, slope, inter = load_for_output(path, "native")
+    x = np.ascontiguousarray(x)
+    h = hashlib.sha1(f"{x.shape}|{x.dtype.str}|{slope!r}|{inter!r}".encode())
+    h.update(memoryview(x).cast("B"))
+    return h.hexdigest()
+
+
+def open_hash_cache(db_path: Path) -> sqlite3.Connection:
+    """Pixel hashes by path, valid while the file's size/mtime are unchanged."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(db_path))
+    con.execute("CREATE TABLE IF NOT EXISTS pixel_hashes (path TEXT PRIMARY KEY, stat_fp TEXT NOT NULL, sha1 TEXT NOT NULL)")
+    return con
+
+
+def find_duplicates(files, extras=None, workers=1, cache=None, stats=None) -> dict:
+    """{path: (canonical path, pixel sha1)} for every file that has a duplicate (canonical ones included).
+    files: in source order, the first of every group becomes canonical.
+    extras: per-file processing options (see header_key), default none.
+    cache: connection from open_hash_cache (optional).
+    """
+    files = [Path(f) for f in files]
+    extras = extras or [""] * len(files)
+    groups = {}
+    for f, extra in zip(files, extras):
+        key = header_key(f, extra)
+        if key is not None:
+            groups.setdefault(key, []).append(f)
+    candidates = [f for group in groups.values() if len(group) > 1 for f in group]
+    print("Files:", len(files), "| pre-key groups:", len(groups), "| candidates to hash:", len(candidates))
+
+    hashes, todo = {}, []
+    for f in candidates:
+        hit = None
+        if cache is not None:
+            hit = cache.execute("SELECT stat_fp, sha1 FROM pixel_hashes WHERE path = ?", (str(f),)).fetchone()
+        if hit is not None and hit[0] == file_fingerprint(f):
+            hashes[f] = hit[1]
+        else:
+            todo.append(f)
+    if stats is not None:
+        stats.total = len(todo)
+
+    if workers > 1 and len(todo) > 1:
+        with Pool(processes=workers) as pool:
+            computed = list(pool.imap(pixel_hash, todo, chunksize=max(1, min(64, len(todo) // (workers * 8)))))
+    else:
+        computed = [pixel_hash(f) for f in todo]
+    for f, sha1 in zip(todo, computed):
+        hashes[f] = sha1
+        if stats is not None:
+            stats.file_done({})
+    if cache is not None and todo:
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO pixel_hashes VALUES (?, ?, ?)",
+                              [(str(f), file_fingerprint(f), hashes[f]) for f in todo])
+
+    duplicates = {}
+    for group in groups.values():
+        if len(group) < 2:
+            # unique pre-key: never hashed, cannot have a duplicate
+            continue
+        # same pre-key (header + options) and same pixels
+        by_hash = {}
+        for f in group:
+            by_hash.setdefault(hashes[f], []).append(f)
+        for sha1, same in by_hash.items():
+            if len(same) > 1:
+                duplicates.update({f: (same[0], sha1) for f in same})
+    return duplicates
+
+
+def write_duplicates(duplicates: dict, out_csv: Path, sep=";"):
+    Path(out_csv).parent.mkdir(parents=True, exist_ok=True)
+    with open(out_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=DEDUP_COLUMNS, delimiter=sep)
+        writer.writeheader()
+        writer.writerows({"source_path": str(p), "canonical_path": str(c), "pixel_sha1": sha1}
+                         for p, (c, sha1) in duplicates.items())
+
+
+def load_duplicates(csv_path, sep=";") -> dict:
+    """{resolved alias path: resolved canonical path} (canonical files themselves are left out)."""
+    df = pd.read_csv(csv_path, sep=sep, dtype=str)
+    aliases = {}
+    for p, c in zip(df["source_path"], df["canonical_path"]):
+        p, c = str(Path(p).resolve()), str(Path(c).resolve())
+        if p != c:
+            aliases[p] = c
+    return aliases
+
+
+def alias_case_ids(tasks, duplicates: dict) -> dict:
+    """{alias case_id: canonical case_id} for builder tasks [(path, prefix, i)] and load_duplicates() output."""
+    case_of = {str(Path(p).resolve()): f"{prefix}_{i:06d}" for p, prefix, i in tasks}
+    return {case_of[p]: case_of[c] for p, c in duplicates.items() if p in case_of and c in case_of}
+
+
+def fan_out(out: pd.DataFrame, aliases: dict) -> pd.DataFrame:
+    """Copy the result row of every canonical case to its aliases ({alias case_id: canonical case_id}).
+    Source columns (source_path, ...) are dropped from the copies, join them from the mapping afterwards."""
+    by_case = out.set_index("case_id", drop=False)
+    copies = []
+    for alias, canonical in aliases.items():
+        if canonical in by_case.index:
+            row = by_case.loc[canonical].copy()
+            row["case_id"] = alias
+            row[[c for c in row.index if c.startswith("source_")]] = np.nan
+            copies.append(row)
+    if not copies:
+        return out
+    out = pd.concat([out[~out["case_id"].isin(aliases)], pd.DataFrame(copies)], ignore_index=True)
+    return out.sort_values("case_id", kind="stable").reset_index(drop=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Find duplicate scans across the source folders (header pre-key, "
+                                             "then decoded-pixel hash) and fan results out to the duplicates.")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    scan = sub.add_parser("scan", help="Write the duplicate table (source_path -> canonical_path)")
+    scan.add_argument("--src", nargs=2, action="append", metavar=("FOLDER", "PREFIX"), required=True,
+                      help="Source folder + case prefix, in builder order (repeatable); the first copy is canonical")
+    scan.add_argument("--out_csv", required=True, help="Duplicate table")
+    scan.add_argument("--sep", default=";", help="CSV separator, default ';'")
+    scan.add_argument("--cache", default=None, help="SQLite file with pixel hashes from earlier runs")
+    scan.add_argument("--workers", type=int, default=1, help="Worker processes for hashing. Default 1 (serial).")
+    add_decode_cache_args(scan)
+    add_instrumentation_args(scan)
+
+    fan = sub.add_parser("fan_out", help="Copy the result rows of canonical cases to their duplicates")
+    fan.add_argument("--uptake_csv", required=True, help="Per-case results (quantify_soft_tissue_uptake.py)")
+    fan.add_argument("--mapping_csv", required=True,
+                     help="Mapping from build_nnunet_inference_inputs.py --dedup_csv (with canonical_case_id)")
+    fan.add_argument("--out_csv", required=True, help="Output CSV with one row per source scan")
+    fan.add_argument("--sep", default=";",
+                     help="Separator of --uptake_csv and --out_csv (quantify_soft_tissue_uptake.py --sep), default ';'")
+    args = ap.parse_args()
+
+    if args.command == "scan":
+        decode_cache_from_args(args)
+        with profiled(args.profile):
+            run_scan(args)
+    else:
+        run_fan_out(args)
+
+
+def run_scan(args):
+    from build_nnunet_inference_inputs import list_tasks
+
+    tasks = list_tasks([(Path(folder), prefix) for folder, prefix in args.src])
+    stats = RunStats("deduplicate_scans", progress_every=args.progress_every)
+    cache = open_hash_cache(args.cache) if args.cache else None
+    duplicates = find_duplicates([p for p, _, _ in tasks], workers=args.workers, cache=cache, stats=stats)
+    if cache is not None:
+        cache.close()
+    n_alias = sum(p != c for p, (c, _) in duplicates.items())
+    print("Duplicates:", n_alias, "| canonical scans with duplicates:", len(duplicates) - n_alias)
+    write_duplicates(duplicates, args.out_csv, sep=args.sep)
+    print("Saved:", args.out_csv)
+    stats.report(args.log_json)
+
+
+def run_fan_out(args):
+    out = pd.read_csv(args.uptake_csv, sep=args.sep, dtype={"case_id": str})
+    # the builder always writes the mapping ';' separated
+    mapping = pd.read_csv(args.mapping_csv, sep=";", dtype=str)
+    if "canonical_case_id" not in mapping.columns:
+        raise ValueError(f"{args.mapping_csv} has no canonical_case_id column (build it with --dedup_csv)")
+    alias = mapping[mapping["canonical_case_id"] != mapping["case_id"]]
+    out = fan_out(out, dict(zip(alias["case_id"], alias["canonical_case_id"])))
+    out.to_csv(args.out_csv, index=False, sep=args.sep)
+    print("Rows:", len(out), "| copied to duplicates:", len(alias))
+    print("Saved:", args.out_csv)
+
+
+if __name__ == "__main__":
+    main()
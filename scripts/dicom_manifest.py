@@ -0,0 +1,92 @@
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def open_manifest(db_path) -> sqlite3.Connection:
+    """Open (or create) the on-disk manifest: path -> (size, mtime, extracted tags)."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(db_path))
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        " path TEXT PRIMARY KEY,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL,"
+        " tags_json TEXT)"  # NULL = not a readable DICOM, don't retry until the file changes
+    )
+    return con
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def sync_manifest(con: sqlite3.Connection, paths, read_tags, tag_names, roots=(), workers=8):
+    """Bring the manifest up to date for the current file listing and return {path: tags}.
+
+    paths:     current files (str), in the order the caller wants them back
+    read_tags: path -> dict of tag strings, or None if the file is not a readable DICOM
+    tag_names: tags the caller needs; entries stored without one of them are re-read
+    roots:     manifest entries below these roots that are not in paths anymore are dropped
+
+    Only new or changed (size/mtime) files are parsed; the rest comes from the manifest.
+    """
+    paths = [str(p) for p in paths]
+    known = {
+        path: (size, mtime_ns, tags_json)
+        for path, size, mtime_ns, tags_json in con.execute("SELECT path, size, mtime_ns, tags_json FROM files")
+    }
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        stats = list(ex.map(_stat, paths))
+
+    result = {}
+    todo = []
+    for path, st in zip(paths, stats):
+        if st is None:
+            continue
+        entry = known.get(path)
+        if entry is not None and (entry[0], entry[1]) == st:
+            if entry[2] is None:
+                result[path] = None
+                continue
+            tags = json.loads(entry[2])
+            if all(t in tags for t in tag_names):
+                result[path] = tags
+                continue
+        todo.append((path, st))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        parsed = list(ex.map(lambda item: read_tags(item[0]), todo))
+
+    with con:
+        con.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            [(path, st[0], st[1], None if tags is None else json.dumps(tags))
+             for (path, st), tags in zip(todo, parsed)],
+        )
+        for (path, _), tags in zip(todo, parsed):
+            result[path] = tags
+
+        # drop files that were deleted below the scanned roots
+        current = set(paths)
+        roots = [str(Path(r)) for r in roots]
+        gone = [
+            (path,) for path in known
+            if path not in current and any(path.startswith(r + os.sep) for r in roots)
+        ]
+        con.executemany("DELETE FROM files WHERE path = ?", gone)
+
+    n_new = sum(1 for path, _ in todo if path not in known)
+    print(f"Manifest: {len(paths)} files | parsed {len(todo)} ({n_new} new, {len(todo) - n_new} changed)"
+          f" | {len(gone)} deleted")
+
+    # keep the caller's order
+    return {path: result[path] for path in paths if path in result}
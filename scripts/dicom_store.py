@@ -0,0 +1,201 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+# install locally (NOT in repo): pip install pydicom pyarrow
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
+
+from dicom_manifest import open_manifest, sync_manifest
+from instrumentation import RunStats, add_instrumentation_args, profiled
+
+
+# Union of what build_dicom_index.py (series level) and build_dicom_index_LOCAL.py (file level) export
+STORE_TAGS = {
+    "PatientID": ("0010", "0020"),
+    "PatientName": ("0010", "0010"),
+    "StudyInstanceUID": ("0020", "000D"),
+    "SeriesInstanceUID": ("0020", "000E"),
+    "SOPInstanceUID": ("0008", "0018"),
+    "StudyDate": ("0008", "0020"),
+    "StudyTime": ("0008", "0030"),
+    "AcquisitionDateTime": ("0008", "002A"),
+    "AccessionNumber": ("0008", "0050"),
+    "Modality": ("0008", "0060"),
+    "StudyDescription": ("0008", "1030"),
+    "SeriesDescription": ("0008", "103E"),
+    "ProtocolName": ("0018", "1030"),
+}
+
+STORE_TAG_LIST = [Tag(*(int(x, 16) for x in t)) for t in STORE_TAGS.values()]
+LAST_STORE_TAG = max(STORE_TAG_LIST)
+
+# low-cardinality / repeated strings -> pandas categoricals (much smaller than object columns)
+CATEGORICAL_COLS = [
+    "dicom_root", "PatientID", "PatientName", "StudyInstanceUID", "SeriesInstanceUID",
+    "AccessionNumber", "Modality", "StudyDescription", "SeriesDescription", "ProtocolName",
+]
+
+
+def is_dicom_candidate(fn):
+    # DICOM files may have arbitrary extensions; your screenshots show .dcm, but we do both:
+    # quick filter (keeps it fast); extend if needed
+    return Path(fn).suffix.lower() in {".dcm", "", ".ima"}
+
+
+def iter_dicom_dirs(root: Path):
+    """Yield (dirpath, sorted candidate filenames) for every folder below root that has any."""
+    for dirpath, _, filenames in os.walk(root):
+        files = sorted(fn for fn in filenames if is_dicom_candidate(fn))
+        if files:
+            yield Path(dirpath), files
+
+
+def _after_last_store_tag(tag, vr, length):
+    return tag > LAST_STORE_TAG
+
+
+def read_file_tags(path):
+    """All STORE_TAGS of one file as strings ('' if missing), or None if it is not readable.
+    Parsing stops right after the last tag we need.
+    """
+    try:
+        with open(path, "rb") as fp:
+            ds = read_partial(fp, _after_last_store_tag, force=True, specific_tags=STORE_TAG_LIST)
+    except Exception:
+        return None
+    return {name: str(getattr(ds, name, "") or "") for name in STORE_TAGS}
+
+
+def scan_paths(paths, manifest=None, roots=(), workers=8, stats=None) -> dict:
+    """{path: tags or None} for the given files, parsed in a thread pool.
+    With a manifest only new/changed files are parsed (see dicom_manifest.py).
+    stats: optional RunStats; counts every file (and the unreadable ones as skipped).
+    """
+    paths = [str(p) for p in paths]
+    if manifest:
+        con = open_manifest(manifest)
+        try:
+            result = sync_manifest(con, paths, read_file_tags, list(STORE_TAGS), roots=roots, workers=workers)
+        finally:
+            con.close()
+        if stats is not None:
+            unreadable = sum(1 for p in paths if result.get(p) is None)
+            if unreadable:
+                stats.skip("not a readable DICOM", n=unreadable)
+            stats.file_done(n=len(paths))
+        return result
+
+    result = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        for path, tags in zip(paths, ex.map(read_file_tags, paths)):
+            result[path] = tags
+            if stats is not None:
+                if tags is None:
+                    stats.skip("not a readable DICOM")
+                stats.file_done()
+    return result
+
+
+def scan_roots(roots, manifest=None, workers=8, stats=None) -> pd.DataFrame:
+    """One scan of all roots -> file-level table (string columns, one row per readable file)."""
+    files = [(root, dirpath / fn) for root in roots for dirpath, fns in iter_dicom_dirs(root) for fn in fns]
+    if stats is not None:
+        stats.total = len(files)
+    tags_by_path = scan_paths([f for _, f in files], manifest=manifest, roots=roots, workers=workers, stats=stats)
+
+    rows = []
+    for root, f in files:
+        tags = tags_by_path.get(str(f))
+        if tags is None:
+            continue
+        rows.append({"dicom_root": str(root), "file_path": str(f), **tags})
+    return pd.DataFrame(rows, columns=["dicom_root", "file_path", *STORE_TAGS])
+
+
+def parse_dicom_datetime(date: pd.Series, time: pd.Series) -> pd.Series:
+    # DA = YYYYMMDD, TM = HHMMSS[.FFFFFF] (HHMM / HH are allowed too)
+    t = time.fillna("").astype(str).str.strip().str.split(".", n=1)
+    hms = t.str[0].str.ljust(6, "0")
+    frac = t.str[1].fillna("").str.ljust(6, "0").str[:6]
+    return pd.to_datetime(date.fillna("").astype(str).str.strip() + hms + frac,
+                          format="%Y%m%d%H%M%S%f", errors="coerce")
+
+
+def to_typed(df: pd.DataFrame) -> pd.DataFrame:
+    """Categorical UIDs/IDs and parsed datetimes; original DA/TM strings are kept for exact keys."""
+    df = df.copy()
+    for c in CATEGORICAL_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    df["StudyDateTime"] = parse_dicom_datetime(df["StudyDate"], df["StudyTime"])
+    # DT = YYYYMMDDHHMMSS[.FFFFFF][&ZZXX]; offsets are dropped
+    adt = df["AcquisitionDateTime"].fillna("").astype(str).str.split("[+-]", n=1, regex=True).str[0]
+    df["AcquisitionDateTime"] = parse_dicom_datetime(adt.str[:8], adt.str[8:])
+    return df
+
+
+def series_view(files: pd.DataFrame) -> pd.DataFrame:
+    """One row per SeriesInstanceUID: first file (scan order) as example + number of files."""
+    files = files[files["SeriesInstanceUID"].astype(str) != ""]
+    g = files.groupby("SeriesInstanceUID", observed=True, sort=False)
+    series = g.first().reset_index()
+    series["n_files_in_series"] = g.size().values
+    return series.rename(columns={"file_path": "dicom_example_file"})
+
+
+def save_store(files: pd.DataFrame, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    to_typed(files).to_parquet(path, index=False)
+
+
+def load_store(path, level="file", columns=None) -> pd.DataFrame:
+    """Load the typed index: level="file" (one row per file) or "series" (one row per series)."""
+    files = pd.read_parquet(path, columns=columns)
+    if level == "file":
+        return files
+    if level == "series":
+        return series_view(files)
+    raise ValueError(f"Unknown level: {level}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Scan DICOM folders once into a typed Parquet index (file + series views).")
+    ap.add_argument("--dicom_root", required=True, help="Folder that contains DICOM subfolders (e.g. ...\\Data).")
+    ap.add_argument("--subfolders", nargs="*", default=None,
+                    help="Subfolders inside dicom_root to scan. Default: dicom_root itself.")
+    ap.add_argument("--out_parquet", required=True, help="Output Parquet path.")
+    ap.add_argument("--manifest", default=None, help="SQLite manifest; rescans only parse new/changed files.")
+    ap.add_argument("--workers", type=int, default=8, help="Threads for header reads. Default 8.")
+    add_instrumentation_args(ap)
+    args = ap.parse_args()
+
+    with profiled(args.profile):
+        run(args)
+
+
+def run(args):
+    stats = RunStats("dicom_store", progress_every=args.progress_every)
+    dicom_root = Path(args.dicom_root)
+    roots = [dicom_root / s for s in args.subfolders] if args.subfolders else [dicom_root]
+    roots = [r for r in roots if r.exists()]
+    if not roots:
+        raise FileNotFoundError(f"No valid DICOM folders found under {dicom_root}")
+
+    with stats.stage("scan"):
+        files = scan_roots(roots, manifest=args.manifest, workers=args.workers, stats=stats)
+    with stats.stage("write"):
+        save_store(files, args.out_parquet)
+    n_series = int(files["SeriesInstanceUID"].replace("", pd.NA).nunique())
+    print("Saved:", args.out_parquet)
+    print("Rows (files):", len(files))
+    print("Series:", n_series)
+    stats.report(args.log_json, extra={"series": n_series})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from decoded_cache import add_decode_cache_args, decode_cache_from_args
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled
+from nifti_io import strip_nii, find_nii
+from quantify_soft_tissue_uptake import DEFAULT_LABEL_MEANING, load_labels_2d
+
+
+def confusion_matrix(ref: np.ndarray, pred: np.ndarray, n_labels: int) -> np.ndarray:
+    """(n_labels, n_labels) pixel counts, rows = reference label, cols = predicted label (one bincount)."""
+    if ref.shape != pred.shape:
+        raise ValueError(f"Shape mismatch: ref {ref.shape} vs pred {pred.shape}")
+    top = max(int(ref.max(initial=0)), int(pred.max(initial=0)))
+    if top >= n_labels:
+        raise ValueError(f"Label {top} found, but only {n_labels} labels (0..{n_labels - 1}) are evaluated")
+    idx = ref.astype(np.int64).ravel() * n_labels + pred.ravel()
+    return np.bincount(idx, minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+
+
+def overlap_metrics(cm: np.ndarray) -> dict:
+    """Per-label arrays from a confusion matrix (NaN where the ratio is 0/0)."""
+    tp = np.diag(cm).astype(np.int64)
+    n_ref = cm.sum(axis=1)
+    n_pred = cm.sum(axis=0)
+    fp = n_pred - tp
+    fn = n_ref - tp
+
+    def ratio(num, den):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(den > 0, num / np.maximum(den, 1), np.nan)
+
+    return {
+        "tp": tp,
+        "fp": fp,
+        "fn": fn,
+        "n_ref": n_ref,
+        "n_pred": n_pred,
+        "dice": ratio(2 * tp, 2 * tp + fp + fn),
+        "iou": ratio(tp, tp + fp + fn),
+        "precision": ratio(tp, tp + fp),
+        "recall": ratio(tp, tp + fn),
+    }
+
+
+def _boundary(mask: np.ndarray) -> np.ndarray:
+    return mask & ~ndimage.binary_erosion(mask, border_value=0)
+
+
+def surface_distances(ref_mask: np.ndarray, pred_mask: np.ndarray, spacing=(1.0, 1.0)):
+    """(pred->ref, ref->pred) distances between the boundary pixels of two masks (None if one is empty).
+    Both masks are cropped to their joint bounding box first; the distance transforms then only
+    run on that window and are only read at boundary pixels.
+    """
+    if not ref_mask.any() or not pred_mask.any():
+        return None
+
+    # joint bounding box + 1 pixel margin, so the outer boundary is not clipped
+    box = ndimage.find_objects((ref_mask | pred_mask).astype(np.uint8))[0]
+    box = tuple(slice(max(s.start - 1, 0), s.stop + 1) for s in box)
+    ref_b = _boundary(ref_mask[box])
+    pred_b = _boundary(pred_mask[box])
+
+    dist_to_ref = ndimage.distance_transform_edt(~ref_b, sampling=spacing)
+    dist_to_pred = ndimage.distance_transform_edt(~pred_b, sampling=spacing)
+    return dist_to_ref[pred_b], dist_to_pred[ref_b]
+
+
+def hd95_assd(ref_mask: np.ndarray, pred_mask: np.ndarray, spacing=(1.0, 1.0)):
+    """95th percentile Hausdorff distance (max of both directions) and average symmetric surface distance."""
+    d = surface_distances(ref_mask, pred_mask, spacing)
+    if d is None:
+        return np.nan, np.nan
+    d_pr, d_rp = d
+    hd95 = max(np.percentile(d_pr, 95), np.percentile(d_rp, 95))
+    assd = (d_pr.sum() + d_rp.sum()) / (d_pr.size + d_rp.size)
+    return float(hd95), float(assd)
+
+
+def evaluate_case(ref_path: Path, pred_path: Path, n_labels: int, surface: bool = True, clock=None) -> list:
+    """One tidy row per foreground label of one case."""
+    clock = clock or StageClock()
+    with clock("read"):
+        ref = load_labels_2d(ref_path)
+        pred = load_labels_2d(pred_path)
+        # in-plane pixel spacing from the reference header
+        spacing = tuple(float(z) for z in nib.load(str(ref_path)).header.get_zooms()[:2])
+    with clock("overlap"):
+        m = overlap_metrics(confusion_matrix(ref, pred, n_labels))
+
+    rows = []
+    for k in range(1, n_labels):
+        row = {
+            "case_id": strip_nii(pred_path.name),
+            "label": k,
+            "label_name": DEFAULT_LABEL_MEANING.get(k, str(k)),
+            **{name: (v[k].item() if hasattr(v[k], "item") else v[k]) for name, v in m.items()},
+        }
+        if surface:
+            with clock("surface"):
+                row["hd95"], row["assd"] = hd95_assd(ref == k, pred == k, spacing)
+        rows.append(row)
+    return rows
+
+
+def _evaluate_task(task, n_labels: int, surface: bool):
+    # top-level so it can be pickled into pool workers; returns (rows, stage times)
+    fold, ref_path, pred_path = task
+    clock = StageClock()
+    rows = evaluate_case(ref_path, pred_path, n_labels, surface, clock=clock)
+    return [{"fold": fold, **r} for r in rows], clock.times
+
+
+def list_fold_tasks(results_dir: Path, folds, ref_dir: Path, pred_subdir="validation"):
+    """[(fold, ref_path, pred_path)] for every prediction in <results_dir>/fold_<k>/<pred_subdir>."""
+    tasks = []
+    missing = 0
+    for fold in folds:
+        pred_dir = results_dir / f"fold_{fold}" / pred_subdir
+        if not pred_dir.exists():
+            print("WARNING: missing", pred_dir)
+            continue
+        for pred_path in sorted(pred_dir.glob("*.nii*")):
+            ref_path = find_nii(ref_dir, strip_nii(pred_path.name))
+            if ref_path is None:
+                missing += 1
+                continue
+            tasks.append((fold, ref_path, pred_path))
+    return tasks, missing
+
+
+def summarize(df: pd.DataFrame) -> pd.DataFrame:
+    """Mean over cases per fold and label + the foreground mean per fold (label = "mean")."""
+    metrics = [c for c in ["dice", "iou", "precision", "recall", "fp", "fn", "hd95", "assd"] if c in df.columns]
+    per_label = df.groupby(["fold", "label", "label_name"], sort=True)[metrics].mean().reset_index()
+    per_label["n_cases"] = df.groupby(["fold", "label"], sort=True).size().values
+    fg = per_label.groupby("fold", sort=True)[metrics].mean().reset_index()
+    fg["label"], fg["label_name"] = "mean", "foreground"
+    fg["n_cases"] = df.groupby("fold", sort=True)["case_id"].nunique().values
+    out = pd.concat([per_label.astype({"label": str}), fg], ignore_index=True)
+    return out.sort_values(["fold", "label"], kind="stable").reset_index(drop=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Evaluate nnU-Net fold predictions against the reference segmentations.")
+    ap.add_argument("--results_dir", required=True,
+                    help="Trainer folder with fold_<k>/validation, e.g. ...\\nnUNetTrainer__nnUNetPlans__2d")
+    ap.add_argument("--ref_dir", required=True,
+                    help="Reference label maps <case>.nii.gz (e.g. nnUNet_raw\\...\\labelsTr or gt_segmentations)")
+    ap.add_argument("--out_csv", required=True, help="Tidy output: one row per fold, case and label")
+    ap.add_argument("--summary_csv", default=None, help="Optional per-fold means (used by notebooks/metrics.ipynb)")
+    ap.add_argument("--folds", nargs="+", default=["0", "1", "2", "3", "4"], help="Folds to evaluate. Default 0-4.")
+    ap.add_argument("--pred_subdir", default="validation", help="Prediction folder inside fold_<k>. Default validation.")
+    ap.add_argument("--n_labels", type=int, default=len(DEFAULT_LABEL_MEANING),
+                    help="Number of labels incl. background. Default 5.")
+    ap.add_argument("--no_surface", action="store_true", help="Skip HD95/ASSD (overlap metrics only)")
+    ap.add_argument("--sep", default=";", help="CSV separator, default ';'")
+    ap.add_argument("--workers", type=int, default=1, help="Worker processes. Default 1 (serial).")
+    add_decode_cache_args(ap)
+    add_instrumentation_args(ap)
+    args = ap.parse_args()
+    decode_cache_from_args(args)
+
+    with profiled(args.profile):
+        run(args)
+
+
+def run(args):
+    stats = RunStats("evaluate_segmentations", progress_every=args.progress_every)
+    results_dir = Path(args.results_dir)
+    ref_dir = Path(args.ref_dir)
+    for d in (results_dir, ref_dir):
+        if not d.exists():
+            raise FileNotFoundError(d)
+
+    with stats.stage("discover"):
+        tasks, missing = list_fold_tasks(results_dir, args.folds, ref_dir, args.pred_subdir)
+    stats.total = len(tasks)
+    if missing:
+        stats.skip("missing reference", missing)
+    if not tasks:
+        raise FileNotFoundError(f"No predictions found under {results_dir}/fold_*/{args.pred_subdir}")
+    print("Cases:", len(tasks), "| missing references:", missing)
+
+    # all folds in one pool, so slow folds do not leave workers idle
+    fn = partial(_evaluate_task, n_labels=args.n_labels, surface=not args.no_surface)
+    rows = []
+    pool = None
+    if args.workers > 1:
+        chunksize = max(1, min(64, len(tasks) // (args.workers * 8)))
+        pool = Pool(processes=args.workers)
+        results = pool.imap(fn, tasks, chunksize=chunksize)
+    else:
+        results = map(fn, tasks)
+    try:
+        for case_rows, times in results:
+            rows.extend(case_rows)
+            stats.file_done(times)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    df = pd.DataFrame(rows)
+    out_csv = Path(args.out_csv)
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(out_csv, index=False, sep=args.sep)
+    print("Saved:", out_csv)
+
+    summary = summarize(df)
+    if args.summary_csv:
+        Path(args.summary_csv).parent.mkdir(parents=True, exist_ok=True)
+        summary.to_csv(args.summary_csv, index=False, sep=args.sep)
+        print("Saved:", args.summary_csv)
+    print(summary[summary["label"] == "mean"].to_string(index=False))
+    stats.report(args.log_json)
+
+
+if __name__ == "__main__":
+    main()
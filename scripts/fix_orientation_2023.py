@@ -1,37 +1,111 @@
+import argparse
 import os
+from functools import partial
+from multiprocessing import Pool
+
 import numpy as np
 import nibabel as nib
 
+from decoded_cache import add_decode_cache_args, decode_cache_from_args
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled
+from nifti_io import load_for_output, rotate180_header, rewrite_header, save_nifti
+
 # INPUT: your current (wrongly oriented) nifti folder
 IN_DIR = r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\NIFTI_AUT2023"
 
 # OUTPUT: new folder with fixed orientation (do NOT overwrite originals)
 OUT_DIR = r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\NIFTI_AUT2023_FIXED"
 
-os.makedirs(OUT_DIR, exist_ok=True)
-
 def rotate_180_in_plane(arr):
     # Works for shapes like (H, W), (H, W, F), (H, W, F, ...)
-    # 180° rotation = flip both axes 0 and 1
+    # 180° rotation = flip both axes 0 and 1 (views, no copy)
     return np.flip(np.flip(arr, axis=0), axis=1)
 
-for fn in os.listdir(IN_DIR):
-    if not (fn.endswith(".nii") or fn.endswith(".nii.gz")):
-        continue
+def fix_one(fn, in_dir, out_dir, mode="data", compresslevel=None, clock=None):
+    """Returns the axcodes of the source affine (for mode="header": the --reorient value of the builders)."""
+    in_path = os.path.join(in_dir, fn)
+    out_path = os.path.join(out_dir, fn)
+    clock = clock or StageClock()
 
-    in_path = os.path.join(IN_DIR, fn)
-    out_path = os.path.join(OUT_DIR, fn)
+    with clock("read"):
+        img = nib.load(in_path)
+    axcodes = "".join(nib.aff2axcodes(img.affine))
 
-    img = nib.load(in_path)
-    data = img.get_fdata()
+    if mode == "header":
+        # only the q/sform change: the voxel bytes are streamed through, never decoded.
+        # Readers that respect the affine (or nifti_io.flip_to_orientation) see the rotated image.
+        with clock("write"):
+            rewrite_header(in_path, out_path, rotate180_header(img), compresslevel=compresslevel)
+        return axcodes
 
-    data_fixed = rotate_180_in_plane(data)
+    # physical rewrite in the native dtype (no float64 get_fdata), scaling kept via scl_slope/scl_inter
+    with clock("read"):
+        data, slope, inter = load_for_output(in_path, "native")
+    with clock("compute"):
+        data_fixed = rotate_180_in_plane(data)
 
     # Keep the same affine/header to preserve spacing etc.
-    out_img = nib.Nifti1Image(data_fixed, img.affine, img.header)
-    nib.save(out_img, out_path)
+    with clock("write"):
+        save_nifti(data_fixed, out_path, affine=None, header=img.header,
+                   slope=slope, inter=inter, compresslevel=compresslevel)
+    return axcodes
+
+def _fix_task(fn, **kwargs):
+    # pool worker: source axcodes + its stage times
+    clock = StageClock()
+    axcodes = fix_one(fn, clock=clock, **kwargs)
+    return axcodes, clock.times
+
+def main():
+    ap = argparse.ArgumentParser(description="Fix the 180° in-plane rotation of the 2023 NIfTIs.")
+    ap.add_argument("--in_dir", default=IN_DIR)
+    ap.add_argument("--out_dir", default=OUT_DIR)
+    ap.add_argument("--mode", choices=["data", "header"], default="data",
+                    help="data: rotate the pixels (native dtype). header: only rotate the affine/sform, "
+                         "pixels are copied untouched and flipped lazily by readers.")
+    ap.add_argument("--workers", type=int, default=1, help="Worker processes. Default 1 (serial).")
+    ap.add_argument("--compresslevel", type=int, default=None, help="gzip level for .nii.gz outputs (1 = fastest)")
+    add_decode_cache_args(ap)
+    add_instrumentation_args(ap)
+    args = ap.parse_args()
+    decode_cache_from_args(args)
+
+    with profiled(args.profile):
+        run(args)
+
+def run(args):
+    stats = RunStats("fix_orientation_2023", progress_every=args.progress_every)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with stats.stage("discover"):
+        files = sorted(fn for fn in os.listdir(args.in_dir) if fn.endswith(".nii") or fn.endswith(".nii.gz"))
+    stats.total = len(files)
+    fn_fix = partial(_fix_task, in_dir=args.in_dir, out_dir=args.out_dir, mode=args.mode,
+                     compresslevel=args.compresslevel)
+
+    source_axcodes = set()
+    if args.workers > 1:
+        with Pool(processes=args.workers) as pool:
+            for axcodes, times in pool.imap_unordered(fn_fix, files, chunksize=16):
+                source_axcodes.add(axcodes)
+                stats.file_done(times)
+    else:
+        for fn in files:
+            axcodes, times = fn_fix(fn)
+            source_axcodes.add(axcodes)
+            stats.file_done(times)
 
-    print("fixed:", fn)
+    print("\nDone.")
+    print("Fixed files written to:", args.out_dir)
+    if args.mode == "header":
+        # the pixels of the outputs are still in the source orientation: readers flip them back into it
+        for axcodes in sorted(source_axcodes):
+            print(f"Source orientation {axcodes}: read the outputs with --reorient {axcodes} "
+                  f"(build_nnunet_inference_inputs.py / nifti_io.load_for_output(reorient=\"{axcodes}\"))")
+        if len(source_axcodes) > 1:
+            print("WARNING: the sources have different orientations, build them per orientation")
+    stats.report(args.log_json)
 
-print("\nDone.")
-print("Fixed files written to:", OUT_DIR)
+if __name__ == "__main__":
+    main()
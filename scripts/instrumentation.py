@@ -0,0 +1,194 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Shared progress / timing / counter layer for the batch scripts.
+# Workers time their own stages with a StageClock and send clock.times back with the result;
+# the main process folds them into one RunStats and writes a JSON log at the end.
+
+# per-file latency histogram bins (ms)
+LATENCY_BINS_MS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf")]
+
+
+class StageClock:
+    """Per-item stage timer: {stage: seconds}; plain dict inside, so it pickles back from pool workers."""
+
+    def __init__(self):
+        self.times = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0.0) + time.perf_counter() - t0
+
+
+class RunStats:
+    """Stage totals, per-file latencies, throughput/ETA and skip/error counters of one run."""
+
+    def __init__(self, name: str, total=None, progress_every=500, progress_seconds=30.0):
+        self.name = name
+        self.total = total
+        self.progress_every = progress_every
+        self.progress_seconds = progress_seconds
+        self.stage_s = {}
+        self.stage_n = {}
+        self.latencies = []
+        self.skipped = {}
+        self.errors = {}
+        self.error_examples = []
+        self.done = 0
+        self.t0 = time.perf_counter()
+        self._last_print = self.t0
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        """Time a main-process stage (discover, write, ...)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_times({stage: time.perf_counter() - t0})
+
+    def add_times(self, times: dict):
+        for stage, s in times.items():
+            self.stage_s[stage] = self.stage_s.get(stage, 0.0) + s
+            self.stage_n[stage] = self.stage_n.get(stage, 0) + 1
+
+    def file_done(self, times=None, n=1):
+        """One input finished: fold in its StageClock times (its latency is their sum) and maybe print progress.
+        n > 1: a batch of inputs finished together (times, if any, are counted as one latency)."""
+        if times:
+            self.add_times(times)
+            self.latencies.append(sum(times.values()))
+        self.done += n
+        now = time.perf_counter()
+        if (self.done // self.progress_every != (self.done - n) // self.progress_every
+                or now - self._last_print >= self.progress_seconds):
+            self._last_print = now
+            print(self.progress_line())
+
+    def skip(self, reason: str, n=1):
+        self.skipped[reason] = self.skipped.get(reason, 0) + n
+
+    def error(self, reason: str, detail=None, n=1):
+        self.errors[reason] = self.errors.get(reason, 0) + n
+        if detail and len(self.error_examples) < 20:
+            self.error_examples.append(detail)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    def rate(self) -> float:
+        s = self.elapsed()
+        return self.done / s if s > 0 else 0.0
+
+    def eta_s(self):
+        rate = self.rate()
+        if self.total is None or rate <= 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def progress_line(self) -> str:
+        eta = self.eta_s()
+        total = f"/{self.total}" if self.total is not None else ""
+        line = f"processed: {self.done}{total} | {self.rate():.1f} files/s"
+        if eta is not None:
+            line += f" | ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}"
+        if self.skipped:
+            line += f" | skipped: {sum(self.skipped.values())}"
+        if self.errors:
+            line += f" | errors: {sum(self.errors.values())}"
+        return line
+
+    def summary(self) -> dict:
+        lat_ms = np.asarray(self.latencies) * 1000.0
+        hist, _ = np.histogram(lat_ms, bins=LATENCY_BINS_MS)
+        # note: with a process pool the stage seconds are summed over workers (CPU-side view)
+        return {
+            "script": self.name,
+            "n_total": self.total,
+            "n_done": self.done,
+            "wall_s": round(self.elapsed(), 3),
+            "files_per_s": round(self.rate(), 2),
+            "stages": {
+                stage: {"total_s": round(s, 3), "n": self.stage_n[stage],
+                        "mean_ms": round(1000.0 * s / self.stage_n[stage], 3)}
+                for stage, s in sorted(self.stage_s.items(), key=lambda kv: -kv[1])
+            },
+            "latency_ms": {
+                "bins": [b if np.isfinite(b) else None for b in LATENCY_BINS_MS],
+                "counts": hist.tolist(),
+                "p50": round(float(np.percentile(lat_ms, 50)), 3) if lat_ms.size else None,
+                "p95": round(float(np.percentile(lat_ms, 95)), 3) if lat_ms.size else None,
+                "max": round(float(lat_ms.max()), 3) if lat_ms.size else None,
+            },
+            "skipped": dict(sorted(self.skipped.items())),
+            "errors": dict(sorted(self.errors.items())),
+            "error_examples": self.error_examples,
+        }
+
+    def report(self, log_json=None, extra=None):
+        """Print the stage breakdown and write the JSON log (if log_json is given)."""
+        summary = self.summary()
+        if extra:
+            summary.update(extra)
+        wall = summary["wall_s"] or 1.0
+        print(f"{self.name}: {self.done} files in {wall:.1f}s ({summary['files_per_s']} files/s)")
+        for stage, st in summary["stages"].items():
+            print(f"  {stage:12s} {st['total_s']:9.2f}s  {st['mean_ms']:9.2f} ms/item")
+        for kind in ("skipped", "errors"):
+            for reason, n in summary[kind].items():
+                print(f"  {kind}: {n:6d}  {reason}")
+        if log_json:
+            Path(log_json).parent.mkdir(parents=True, exist_ok=True)
+            Path(log_json).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+            print("Saved:", log_json)
+        return summary
+
+
+def shape_layout(shape) -> str:
+    """(256, 1024, 2) -> '(H,W,2)', (256, 1024, 3, 2) -> '(H,W,3,2)' (for skip reasons)."""
+    return "(" + ",".join(["H", "W"][: len(shape)] + [str(n) for n in shape[2:]]) + ")"
+
+
+def error_reason(exc: Exception):
+    """(reason, detail): counters group by exception type, the message (usually naming the file) is kept as example."""
+    msg = str(exc).splitlines()[0] if str(exc) else ""
+    return type(exc).__name__, f"{type(exc).__name__}: {msg}"[:300]
+
+
+def add_instrumentation_args(ap):
+    """--log_json / --profile / --progress_every, shared by every batch script."""
+    ap.add_argument("--log_json", default=None,
+                    help="Write a JSON run log: stage timings, latency histogram, throughput, skip/error counters.")
+    ap.add_argument("--profile", default=None,
+                    help="Write a cProfile dump (.prof, open with snakeviz/pstats) of the main process. "
+                         "Use --workers 1 to profile the per-file work itself.")
+    ap.add_argument("--progress_every", type=int, default=500, help="Print progress every N files. Default 500.")
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """cProfile the block if path is given; prints the top functions by cumulative time."""
+    if not path:
+        yield
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        prof.dump_stats(str(path))
+        print("Saved:", path)
+        pstats.Stats(prof, stream=sys.stdout).sort_stats("cumulative").print_stats(15)
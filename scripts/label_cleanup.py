@@ -0,0 +1,124 @@
+import numpy as np
+from scipy import ndimage
+
+# Connected-component cleanup of predicted label maps before quantification.
+# Small spurious islands of a label (e.g. a few OS_bone pixels in the soft tissue) bias the region means,
+# and the bone mean is the denominator of every soft-to-bone ratio.
+# Runs on the already loaded uint8 plane: one find_objects pass gives the bounding box of every label,
+# components are labelled inside that box only, and the plane is edited in place (one copy per plane).
+
+# cleanup spec (dict, also the pipeline config section "cleanup"):
+#   labels:       region names to clean (default: all regions of the mapping)
+#   min_area:     keep the largest component plus every component with at least this many pixels;
+#                 None = keep only the largest component
+#   fill_holes:   fill holes of a label (background only, enclosed by that label) with the label
+#   connectivity: 8 (default) or 4
+DEFAULT_CLEANUP = {"labels": None, "min_area": None, "fill_holes": False, "connectivity": 8}
+
+
+def cleanup_spec(cleanup: dict) -> dict:
+    return {**DEFAULT_CLEANUP, **(cleanup or {})}
+
+
+def cleanup_columns(cleanup: dict, mapping: dict) -> list:
+    """Extra row columns written when cleanup is on: components found / pixels removed (/ pixels filled)."""
+    spec = cleanup_spec(cleanup)
+    regions = spec["labels"] or list(mapping)
+    cols = [f"{region}_{c}" for region in regions for c in ("components", "removed_n")]
+    if spec["fill_holes"]:
+        cols += [f"{region}_filled_n" for region in regions]
+    return cols
+
+
+def clean_labels(seg: np.ndarray, mapping: dict, cleanup: dict):
+    """Per-label connected-component filtering of a 2D label map.
+    Returns (cleaned uint8 copy, {column: value} for cleanup_columns). Removed pixels become background
+    (unless a hole fill of another label takes them).
+    """
+    spec = cleanup_spec(cleanup)
+    structure = ndimage.generate_binary_structure(2, 2 if int(spec["connectivity"]) == 8 else 1)
+    seg = np.array(seg, dtype=np.uint8)
+    boxes = ndimage.find_objects(seg)
+
+    info = {}
+    regions = spec["labels"] or list(mapping)
+    for region in regions:
+        label = mapping[region]
+        n_comp = removed = 0
+        box = boxes[label - 1] if label <= len(boxes) else None
+        if box is not None:
+            # view into seg: edits below go straight into the plane
+            crop = seg[box]
+            mask = crop == label
+            comps, n_comp = ndimage.label(mask, structure=structure)
+            if n_comp > 1:
+                sizes = np.bincount(comps.ravel())
+                keep = np.zeros(n_comp + 1, dtype=bool)
+                keep[int(np.argmax(sizes[1:])) + 1] = True
+                if spec["min_area"] is not None:
+                    keep[1:] |= sizes[1:] >= int(spec["min_area"])
+                drop = ~keep[comps] & mask
+                removed = int(np.count_nonzero(drop))
+                crop[drop] = 0
+        info[f"{region}_components"] = int(n_comp)
+        info[f"{region}_removed_n"] = removed
+
+    # second pass, so pixels removed from one label can close a hole of another
+    if spec["fill_holes"]:
+        for region in regions:
+            label = mapping[region]
+            filled = 0
+            box = boxes[label - 1] if label <= len(boxes) else None
+            if box is not None:
+                # the box holds every pixel of the label, so anything touching its edge is not enclosed
+                crop = seg[box]
+                # components of everything else (4-connected); those not touching the box edge are enclosed
+                rest, n = ndimage.label(crop != label)
+                if n:
+                    fill = np.ones(n + 1, dtype=bool)
+                    fill[0] = False
+                    fill[np.concatenate((rest[0], rest[-1], rest[:, 0], rest[:, -1]))] = False
+                    # only holes of pure background: another label inside (bone in soft tissue) stays
+                    other = np.bincount(rest.ravel(), weights=crop.ravel() != 0, minlength=n + 1)
+                    fill &= other == 0
+                    holes = fill[rest]
+                    filled = int(np.count_nonzero(holes))
+                    crop[holes] = label
+            info[f"{region}_filled_n"] = filled
+    return seg, info
+
+
+def add_cleanup_args(ap):
+    """--cc_* options of the quantifier."""
+    ap.add_argument("--cc_cleanup", action="store_true",
+                    help="Connected-component cleanup of the predictions before quantifying: keep the largest "
+                         "component per label (plus those >= --cc_min_area) and write component/removed-pixel columns")
+    ap.add_argument("--cc_labels", nargs="+", default=None, metavar="REGION",
+                    help="Regions to clean, e.g. OS_bone US_bone. Default: all.")
+    ap.add_argument("--cc_min_area", type=int, default=None,
+                    help="Also keep components with at least this many pixels. Default: largest component only.")
+    ap.add_argument("--cc_fill_holes", action="store_true", help="Fill background holes enclosed by a label")
+    ap.add_argument("--cc_connectivity", type=int, choices=[4, 8], default=8, help="Pixel connectivity. Default 8.")
+
+
+def cleanup_from_args(args):
+    """cleanup spec from the --cc_* options, None when cleanup is off."""
+    if not args.cc_cleanup:
+        return None
+    return {"labels": args.cc_labels, "min_area": args.cc_min_area, "fill_holes": args.cc_fill_holes,
+            "connectivity": args.cc_connectivity}
+
+
+def cleanup_argv(cleanup: dict) -> list:
+    """cleanup spec -> quantifier command line options (inverse of cleanup_from_args)."""
+    if not cleanup:
+        return []
+    spec = cleanup_spec(cleanup)
+    argv = ["--cc_cleanup", "--cc_connectivity", str(spec["connectivity"])]
+    if spec["labels"]:
+        argv += ["--cc_labels", *spec["labels"]]
+    if spec["min_area"] is not None:
+        argv += ["--cc_min_area", str(spec["min_area"])]
+    if spec["fill_holes"]:
+        argv.append("--cc_fill_holes")
+    return argv
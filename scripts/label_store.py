@@ -0,0 +1,162 @@
+import argparse
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled
+from nifti_io import find_nii, strip_nii
+
+# Compact storage of 2D label maps: runs of equal non-zero labels in row-major (C) order.
+# A planar segmentation is mostly background, which costs nothing here, and the region statistics
+# only touch the foreground pixels of the image instead of scanning the whole plane.
+# One <case>.rle.npz per label map, next to / instead of <case>.nii.gz.
+
+RLE_SUFFIX = ".rle.npz"
+
+
+class LabelRuns:
+    """Run-length encoded (H,W) label map: starts/lengths (flat C-order indices) and label of every run."""
+
+    def __init__(self, shape, starts, lengths, labels):
+        self.shape = tuple(int(n) for n in shape)
+        self.starts = np.asarray(starts, dtype=np.uint32)
+        self.lengths = np.asarray(lengths, dtype=np.uint32)
+        self.labels = np.asarray(labels, dtype=np.uint8)
+
+    @classmethod
+    def from_dense(cls, seg: np.ndarray):
+        seg = np.asarray(seg)
+        if seg.ndim == 3 and seg.shape[2] == 1:
+            seg = seg[:, :, 0]
+        if seg.ndim != 2:
+            raise ValueError(f"Expected a 2D label map, got shape {seg.shape}")
+        flat = seg.ravel()
+        # run boundaries = positions where the label changes
+        edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        starts = np.concatenate(([0], edges))
+        ends = np.concatenate((edges, [flat.size]))
+        labels = flat[starts]
+        fg = labels != 0
+        return cls(seg.shape, starts[fg], ends[fg] - starts[fg], labels[fg])
+
+    def to_dense(self) -> np.ndarray:
+        flat = np.zeros(self.shape[0] * self.shape[1], dtype=np.uint8)
+        flat[self.pixel_index()] = np.repeat(self.labels, self.lengths)
+        return flat.reshape(self.shape)
+
+    def pixel_index(self) -> np.ndarray:
+        """Flat indices of all foreground pixels, ascending (run after run)."""
+        lengths = self.lengths.astype(np.int64)
+        if lengths.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        # arange over all run pixels, shifted by (run start - run offset) per run
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(int(lengths.sum())) + np.repeat(self.starts.astype(np.int64) - offsets, lengths)
+
+    def region_stats(self, img: np.ndarray, n_labels: int, sumsq=False) -> dict:
+        """count/sum (/sumsq) per label like region_stats.region_stats, but only foreground pixels are read.
+        Pixels are summed in the same (C) order, so the foreground results are identical.
+        Label 0 only gets its count (sum/sumsq NaN: background is never read).
+        """
+        if tuple(img.shape) != self.shape:
+            raise ValueError(f"Shape mismatch: img {img.shape} vs seg {self.shape}")
+        keep = self.labels < n_labels
+        runs = LabelRuns(self.shape, self.starts[keep], self.lengths[keep], self.labels[keep])
+        values = np.ravel(img)[runs.pixel_index()].astype(np.float64, copy=False)
+        labels = np.repeat(runs.labels, runs.lengths)
+
+        count = np.bincount(labels, minlength=n_labels)[:n_labels]
+        # (float casts: bincount returns ints when there is no foreground at all)
+        total = np.bincount(labels, weights=values, minlength=n_labels)[:n_labels].astype(np.float64)
+        count[0] = self.shape[0] * self.shape[1] - int(self.lengths.sum())
+        total[0] = np.nan
+        stats = {"count": count, "sum": total}
+        if sumsq:
+            sq = np.bincount(labels, weights=values * values, minlength=n_labels)[:n_labels].astype(np.float64)
+            sq[0] = np.nan
+            stats["sumsq"] = sq
+        return stats
+
+    def save(self, path: Path):
+        np.savez_compressed(path, shape=np.asarray(self.shape, dtype=np.int64), starts=self.starts,
+                            lengths=self.lengths, labels=self.labels)
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as z:
+            return cls(z["shape"], z["starts"], z["lengths"], z["labels"])
+
+
+def is_rle(path) -> bool:
+    return str(path).endswith(RLE_SUFFIX)
+
+
+def rle_path(folder: Path, case_id: str) -> Path:
+    return Path(folder) / f"{case_id}{RLE_SUFFIX}"
+
+
+def find_seg(folder: Path, case_id: str):
+    """<case>.nii.gz / <case>.nii / <case>.rle.npz, whichever exists first (None otherwise)."""
+    p = find_nii(folder, case_id)
+    if p is None and rle_path(folder, case_id).exists():
+        p = rle_path(folder, case_id)
+    return p
+
+
+def _convert_one(path: Path, out_dir: Path):
+    # pool worker: NIfTI label map -> <case>.rle.npz; returns (case, in bytes, out bytes, stage times)
+    from quantify_soft_tissue_uptake import load_labels_2d
+
+    clock = StageClock()
+    with clock("read"):
+        seg = load_labels_2d(path)
+    with clock("encode"):
+        runs = LabelRuns.from_dense(seg)
+    out = rle_path(out_dir, strip_nii(path.name))
+    with clock("write"):
+        runs.save(out)
+    return path.name, path.stat().st_size, out.stat().st_size, clock.times
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Convert NIfTI label maps (<case>.nii.gz) into the compact run-length "
+                                             "store (<case>.rle.npz) read by quantify_soft_tissue_uptake.py.")
+    ap.add_argument("--in_dir", required=True, help="Folder with <case>.nii.gz label maps (e.g. nnU-Net predictions)")
+    ap.add_argument("--out_dir", required=True, help="Output folder for <case>.rle.npz")
+    ap.add_argument("--workers", type=int, default=1, help="Worker processes. Default 1 (serial).")
+    add_instrumentation_args(ap)
+    args = ap.parse_args()
+
+    with profiled(args.profile):
+        run(args)
+
+
+def run(args):
+    in_dir, out_dir = Path(args.in_dir), Path(args.out_dir)
+    if not in_dir.exists():
+        raise FileNotFoundError(in_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = sorted(in_dir.glob("*.nii*"))
+    stats = RunStats("label_store", total=len(files), progress_every=args.progress_every)
+
+    fn = partial(_convert_one, out_dir=out_dir)
+    n_in = n_out = 0
+    if args.workers > 1:
+        with Pool(processes=args.workers) as pool:
+            results = list(pool.imap(fn, files, chunksize=max(1, min(64, len(files) // (args.workers * 8)))))
+    else:
+        results = map(fn, files)
+    for _, size_in, size_out, times in results:
+        n_in += size_in
+        n_out += size_out
+        stats.file_done(times)
+
+    print(f"Converted {len(files)} label maps: {n_in / 1e6:.1f} MB -> {n_out / 1e6:.1f} MB")
+    print("Saved:", out_dir)
+    stats.report(args.log_json)
+
+
+if __name__ == "__main__":
+    main()
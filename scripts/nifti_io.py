@@ -0,0 +1,168 @@
+import gzip
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from nibabel.volumeutils import array_to_file
+
+from decoded_cache import cached_decode
+
+# "Clean header" affine (identity)
+I = np.eye(4, dtype=np.float32)
+
+OUT_DTYPES = ["float32", "native"]
+
+
+def add_codec_args(ap):
+    """Output-format options shared by every script that writes NIfTIs."""
+    ap.add_argument("--out_dtype", choices=OUT_DTYPES, default="float32",
+                    help="float32 (old behaviour) or native: keep the source dtype (e.g. uint16 counts) "
+                         "and its scl_slope/scl_inter. Default float32.")
+    ap.add_argument("--compresslevel", type=int, default=None,
+                    help="gzip level 1-9 for .nii.gz (1 = fastest). Default: nibabel's default.")
+    ap.add_argument("--uncompressed", action="store_true", help="Write plain .nii instead of .nii.gz")
+
+
+def codec_from_args(args) -> dict:
+    return {"out_dtype": args.out_dtype, "compresslevel": args.compresslevel, "uncompressed": args.uncompressed}
+
+
+def nii_suffix(uncompressed=False) -> str:
+    return ".nii" if uncompressed else ".nii.gz"
+
+
+def strip_nii(name: str) -> str:
+    """'x.nii.gz' / 'x.nii' -> 'x'"""
+    for suffix in (".nii.gz", ".nii"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def find_nii(folder: Path, stem: str):
+    """<folder>/<stem>.nii.gz or <stem>.nii, whichever exists (None otherwise)."""
+    for suffix in (".nii.gz", ".nii"):
+        p = Path(folder) / f"{stem}{suffix}"
+        if p.exists():
+            return p
+    return None
+
+
+def load_for_output(path: Path, out_dtype="float32", reorient=None):
+    """Load a source NIfTI the way it will be written.
+    Returns (array, slope, inter): float32 with scaling applied, or the raw on-disk
+    array with its slope/inter for out_dtype="native".
+    reorient: axcodes of the original sources (e.g. "RAS") -> apply header-only orientation fixes here
+    (flip_to_orientation); for fix_orientation_2023.py --mode header outputs this gives the --mode data pixels.
+    With a decoded cache configured (decoded_cache.py) a .nii.gz is only gunzipped the first time.
+    """
+    def decode():
+        nii = nib.load(str(path))
+        if out_dtype == "native":
+            slope, inter = nii.dataobj.slope, nii.dataobj.inter
+            x, slope, inter = np.asanyarray(nii.dataobj.get_unscaled()), float(slope), float(inter)
+        else:
+            x, slope, inter = np.asanyarray(nii.dataobj).astype(np.float32), 1.0, 0.0
+        if reorient:
+            x = flip_to_orientation(x, nii.affine, reorient)
+        return x, {"slope": slope, "inter": inter}
+
+    x, meta = cached_decode(path, f"load_for_output:{out_dtype}:{reorient or ''}", decode)
+    return x, meta["slope"], meta["inter"]
+
+
+def _open_out(out_path: Path, compresslevel=None):
+    if out_path.name.endswith(".gz"):
+        level = nib.openers.Opener.default_compresslevel if compresslevel is None else compresslevel
+        return gzip.open(out_path, "wb", compresslevel=level)
+    return open(out_path, "wb")
+
+
+def save_nifti(x: np.ndarray, out_path: Path, affine=I, slope=1.0, inter=0.0, compresslevel=None, header=None):
+    """Write x as a single-file NIfTI in its own dtype (no float promotion, no rescaling).
+    slope/inter go to scl_slope/scl_inter, so raw integer counts keep their physical scaling.
+    header: start from a copy of this header (keeps pixdim etc.); affine=None then keeps its q/sform.
+    .nii.gz is gzipped with compresslevel (None = nibabel default), .nii is written plain.
+    """
+    out_path = Path(out_path)
+    x = np.asanyarray(x)
+
+    hdr = nib.Nifti1Header() if header is None else nib.Nifti1Header.from_header(header)
+    hdr.set_data_dtype(x.dtype)
+    hdr.set_data_shape(x.shape)
+    if affine is not None:
+        hdr.set_qform(affine, code=1)
+        hdr.set_sform(affine, code=1)
+    hdr.set_slope_inter(*((slope, inter) if (slope, inter) != (1.0, 0.0) else (None, None)))
+
+    with _open_out(out_path, compresslevel) as f:
+        hdr.write_to(f)
+        array_to_file(x, f, x.dtype, offset=hdr.get_data_offset(), order="F")
+
+
+def write_output(x, out_path: Path, codec: dict, slope=1.0, inter=0.0, affine=I):
+    """Write x with the codec options from add_codec_args (suffix follows codec["uncompressed"])."""
+    out_path = Path(out_path)
+    out_path = out_path.with_name(strip_nii(out_path.name) + nii_suffix(codec.get("uncompressed", False)))
+    if codec.get("out_dtype", "float32") == "float32":
+        x = np.asarray(x, dtype=np.float32)
+    save_nifti(x, out_path, affine=affine, slope=slope, inter=inter, compresslevel=codec.get("compresslevel"))
+    return out_path
+
+
+def rotate180_affine(affine: np.ndarray, shape) -> np.ndarray:
+    """Affine that shows the unchanged voxel array rotated by 180 deg in-plane (axes 0 and 1).
+    new voxel (i, j) sits where old voxel (H-1-i, W-1-j) was.
+    """
+    flip = np.eye(4)
+    flip[0, 0] = flip[1, 1] = -1
+    flip[0, 3] = shape[0] - 1
+    flip[1, 3] = shape[1] - 1
+    return affine @ flip
+
+
+def rotate180_header(img):
+    """Copy of img's header whose q/sform carry a 180 deg in-plane rotation (see rotate180_affine)."""
+    hdr = img.header.copy()
+    # nibabel moves scl_slope/scl_inter from the header into the proxy on load; put them back
+    hdr.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    # same for vox_offset: keep it, the voxel bytes are copied to the same position
+    hdr.set_data_offset(img.dataobj.offset)
+    new_affine = rotate180_affine(img.affine, img.shape)
+    hdr.set_sform(new_affine, code=int(hdr["sform_code"]) or 1)
+    hdr.set_qform(new_affine, code=int(hdr["qform_code"]) or 1)
+    return hdr
+
+
+def rewrite_header(src: Path, dst: Path, header, compresslevel=None, chunk=1 << 20):
+    """Copy src to dst with a new 348-byte header; the voxel bytes are streamed, never decoded.
+    .nii: plain byte copy. .nii.gz: gunzip/gzip stream (no numpy, no dtype conversion).
+    header must keep dtype, shape and vox_offset of src (only geometry fields should differ).
+    """
+    src, dst = Path(src), Path(dst)
+    block = header.binaryblock
+    opener = gzip.open if src.name.endswith(".gz") else open
+    with opener(src, "rb") as fin, _open_out(dst, compresslevel) as fout:
+        fin.read(len(block))
+        fout.write(block)
+        while True:
+            buf = fin.read(chunk)
+            if not buf:
+                break
+            fout.write(buf)
+
+
+def flip_to_orientation(x: np.ndarray, affine: np.ndarray, axcodes="LPS") -> np.ndarray:
+    """Flip axes 0/1 of x (views, no copy) so that it is displayed in the given orientation.
+    Applies header-only orientation fixes (rotate180_affine) lazily when the data is read.
+    Only flips are supported; a transform that would swap axes raises ValueError.
+    """
+    from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
+
+    transform = ornt_transform(io_orientation(affine), axcodes2ornt(tuple(axcodes)))
+    if not np.array_equal(transform[:, 0], np.arange(3)):
+        raise ValueError(f"Orientation {nib.aff2axcodes(affine)} -> {axcodes} needs an axis swap, not only flips")
+    for axis in (0, 1):
+        if transform[axis, 1] < 0:
+            x = np.flip(x, axis=axis)
+    return x
@@ -0,0 +1,158 @@
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from decoded_cache import add_decode_cache_args, decode_cache_from_args
+from instrumentation import RunStats, StageClock, add_instrumentation_args, profiled
+from label_store import LabelRuns, rle_path
+from nifti_io import nii_suffix, save_nifti
+from quantify_soft_tissue_uptake import case_id_of, load_2d_any, labels_uint8
+
+# In-process nnU-Net v2 inference on 2D planes that are already in memory.
+# The predictor (network + plans + weights of all folds) is loaded once per process and then fed
+# batches of planes, instead of writing <case>_0000.nii.gz, calling nnUNetv2_predict and reading
+# <case>.nii.gz back. torch / nnunetv2 are only imported when a predictor is loaded.
+
+# Our inputs are written as (H,W,1) NIfTIs with an identity affine and pixdim 1; nnU-Net reads them
+# as (C, Z, Y, X) = (1, 1, W, H) (axes reversed by SimpleITK) with spacing [1, 1, 1].
+PLANE_PROPERTIES = {"spacing": [1.0, 1.0, 1.0]}
+
+
+def load_predictor(model_dir, folds=("all",), checkpoint="checkpoint_final.pth", device="cpu", torch_threads=None,
+                   tile_step_size=0.5, use_mirroring=True):
+    """nnUNetPredictor for a trained model folder (e.g. ...\\nnUNetTrainer__nnUNetPlans__2d).
+    torch_threads: intra-op threads on CPU (torch.set_num_threads); None = torch default.
+    """
+    import torch
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+    if torch_threads:
+        torch.set_num_threads(int(torch_threads))
+    dev = torch.device(device)
+    predictor = nnUNetPredictor(
+        tile_step_size=tile_step_size,
+        use_gaussian=True,
+        use_mirroring=use_mirroring,
+        # keeping the whole sliding-window result on the device only makes sense on a GPU
+        perform_everything_on_device=dev.type == "cuda",
+        device=dev,
+        verbose=False,
+        verbose_preprocessing=False,
+        allow_tqdm=False,
+    )
+    folds = tuple(f if f == "all" else int(f) for f in folds)
+    predictor.initialize_from_trained_model_folder(str(model_dir), use_folds=folds, checkpoint_name=checkpoint)
+    return predictor
+
+
+def plane_to_nnunet(plane: np.ndarray) -> np.ndarray:
+    """(H,W) plane -> (1, 1, W, H) float32, the layout nnU-Net sees when it reads our (H,W,1) inputs."""
+    if plane.ndim != 2:
+        raise ValueError(f"Expected a 2D plane, got shape {plane.shape}")
+    return np.ascontiguousarray(plane.T[None, None], dtype=np.float32)
+
+
+def seg_from_nnunet(seg: np.ndarray) -> np.ndarray:
+    """(1, W, H) predicted label map -> (H,W) uint8, aligned with the input plane again."""
+    return labels_uint8(np.asarray(seg)[0].T)
+
+
+def predict_planes(predictor, planes: list, workers: int = 0) -> list:
+    """Label maps (H,W uint8) for a batch of 2D planes.
+    workers = 0: predict one plane after the other in this process.
+    workers > 0: nnU-Net preprocesses/exports the batch in that many background processes while
+    the network runs (predict_from_list_of_npy_arrays).
+    Planes are not stacked into one volume: nnU-Net normalizes every image with its own statistics.
+    """
+    if not planes:
+        return []
+    images = [plane_to_nnunet(p) for p in planes]
+    props = [dict(PLANE_PROPERTIES) for _ in planes]
+    if workers > 0:
+        segs = predictor.predict_from_list_of_npy_arrays(images, None, props, None, num_processes=workers)
+    else:
+        segs = [predictor.predict_single_npy_array(x, pr, None, None, False) for x, pr in zip(images, props)]
+    return [seg_from_nnunet(s) for s in segs]
+
+
+def iter_batches(items, batch_size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Predict a folder of nnU-Net inputs (<case>_0000.nii.gz) with one persistent in-process predictor.")
+    ap.add_argument("--model_dir", required=True, help="Trained model folder, e.g. ...\\nnUNetTrainer__nnUNetPlans__2d")
+    ap.add_argument("--images_dir", required=True, help="Folder with <case>_0000.nii.gz (or .nii)")
+    ap.add_argument("--out_dir", required=True, help="Output folder for <case>.nii.gz label maps")
+    ap.add_argument("--folds", nargs="+", default=["all"], help="Folds to ensemble. Default: all (fold_all).")
+    ap.add_argument("--checkpoint", default="checkpoint_final.pth", help="Checkpoint file name. Default checkpoint_final.pth.")
+    ap.add_argument("--device", default="cpu", help="cpu, cuda or mps. Default cpu.")
+    ap.add_argument("--torch_threads", type=int, default=None, help="torch intra-op threads (CPU). Default: torch default.")
+    ap.add_argument("--workers", type=int, default=0,
+                    help="nnU-Net preprocessing/export processes per batch. Default 0 (all in this process).")
+    ap.add_argument("--batch_size", type=int, default=32, help="Planes per predictor call. Default 32.")
+    ap.add_argument("--no_mirroring", action="store_true", help="Disable test-time mirroring (faster, slightly worse)")
+    ap.add_argument("--uncompressed", action="store_true", help="Write plain .nii instead of .nii.gz")
+    ap.add_argument("--out_format", choices=["nifti", "rle"], default="nifti",
+                    help="nifti: <case>.nii.gz label maps. rle: compact <case>.rle.npz (label_store.py), "
+                         "read directly by the quantifier. Default nifti.")
+    add_decode_cache_args(ap)
+    add_instrumentation_args(ap)
+    args = ap.parse_args()
+    decode_cache_from_args(args)
+
+    with profiled(args.profile):
+        run(args)
+
+
+def run(args):
+    images_dir, out_dir = Path(args.images_dir), Path(args.out_dir)
+    if not images_dir.exists():
+        raise FileNotFoundError(images_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    stats = RunStats("nnunet_inference", progress_every=args.progress_every)
+    with stats.stage("discover"):
+        image_files = sorted(images_dir.glob("*_0000.nii*"))
+    if not image_files:
+        raise FileNotFoundError(f"No *_0000.nii.gz / *_0000.nii found in {images_dir}")
+    stats.total = len(image_files)
+
+    t0 = time.perf_counter()
+    with stats.stage("load_model"):
+        predictor = load_predictor(args.model_dir, args.folds, args.checkpoint, args.device, args.torch_threads,
+                                   use_mirroring=not args.no_mirroring)
+    print(f"Model loaded in {time.perf_counter() - t0:.1f}s | files: {len(image_files)}")
+
+    for batch in iter_batches(image_files, args.batch_size):
+        clock = StageClock()
+        with clock("read"):
+            planes = [load_2d_any(p).astype(np.float32, copy=False) for p in batch]
+        with clock("predict"):
+            segs = predict_planes(predictor, planes, args.workers)
+        with clock("write"):
+            for p, seg in zip(batch, segs):
+                if args.out_format == "rle":
+                    LabelRuns.from_dense(seg).save(rle_path(out_dir, case_id_of(p)))
+                else:
+                    save_nifti(seg[:, :, None], out_dir / f"{case_id_of(p)}{nii_suffix(args.uncompressed)}")
+        # one clock per batch: spread its times evenly over the files
+        for _ in batch:
+            stats.file_done({k: v / len(batch) for k, v in clock.times.items()})
+
+    print("Saved:", out_dir)
+    stats.report(args.log_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,147 +1,672 @@
-import argparse
-from pathlib import Path
-
-import numpy as np
-import nibabel as nib
-import pandas as pd
-
-
-# Default label meaning (edit if needed)
-DEFAULT_LABEL_MEANING = {
-    0: "Background",
-    1: "OS_soft",
-    2: "OS_bone",
-    3: "US_soft",
-    4: "US_bone",
-}
-
-DEFAULT_MAPPING = {
-    "OS_soft": 1,
-    "OS_bone": 2,
-    "US_soft": 3,
-    "US_bone": 4,
-}
-
-
-def load_2d_any(path: Path, channel: int = 0, slice_idx=None) -> np.ndarray:
-    """Load NIfTI and return a 2D array.
-    Supports (H,W), (H,W,C), (H,W,Z), (H,W,Z,C).
-    """
-    arr = nib.load(str(path)).get_fdata()
-
-    if arr.ndim == 2:
-        return arr
-
-    if arr.ndim == 3:
-        # (H,W,C) or (H,W,Z)
-        if arr.shape[2] <= 4:
-            if channel >= arr.shape[2]:
-                raise ValueError(f"Channel {channel} out of range for {path} with shape {arr.shape}")
-            return arr[:, :, channel]
-        else:
-            if slice_idx is None:
-                slice_idx = arr.shape[2] // 2
-            return arr[:, :, slice_idx]
-
-    if arr.ndim == 4:
-        # (H,W,Z,C)
-        if slice_idx is None:
-            slice_idx = arr.shape[2] // 2
-        if channel >= arr.shape[3]:
-            raise ValueError(f"Channel {channel} out of range for {path} with shape {arr.shape}")
-        return arr[:, :, slice_idx, channel]
-
-    raise ValueError(f"Unsupported NIfTI shape {arr.shape} for {path}")
-
-
-def safe_mean(x: np.ndarray):
-    return float(x.mean()) if x.size else np.nan
-
-
-def safe_ratio(num, den):
-    if np.isnan(num) or np.isnan(den) or den == 0:
-        return np.nan
-    return float(num / den)
-
-
-def quantify_case(image_path: Path, seg_path: Path, channel: int, mapping: dict) -> dict:
-    img = load_2d_any(image_path, channel=channel)
-    seg = load_2d_any(seg_path, channel=0)
-    seg = np.rint(seg).astype(np.int32)
-
-    if img.shape != seg.shape:
-        raise ValueError(f"Shape mismatch: {image_path.name} img {img.shape} vs seg {seg.shape}")
-
-    case_id = image_path.name.replace("_0000.nii.gz", "")
-
-    os_soft = img[seg == mapping["OS_soft"]]
-    os_bone = img[seg == mapping["OS_bone"]]
-    us_soft = img[seg == mapping["US_soft"]]
-    us_bone = img[seg == mapping["US_bone"]]
-
-    os_soft_mean = safe_mean(os_soft)
-    os_bone_mean = safe_mean(os_bone)
-    us_soft_mean = safe_mean(us_soft)
-    us_bone_mean = safe_mean(us_bone)
-
-    return {
-        "case_id": case_id,
-        "OS_soft_mean": os_soft_mean,
-        "OS_bone_mean": os_bone_mean,
-        "OS_soft_to_bone_ratio": safe_ratio(os_soft_mean, os_bone_mean),
-        "US_soft_mean": us_soft_mean,
-        "US_bone_mean": us_bone_mean,
-        "US_soft_to_bone_ratio": safe_ratio(us_soft_mean, us_bone_mean),
-        "OS_soft_n": int(os_soft.size),
-        "OS_bone_n": int(os_bone.size),
-        "US_soft_n": int(us_soft.size),
-        "US_bone_n": int(us_bone.size),
-    }
-
-
-def main():
-    ap = argparse.ArgumentParser(description="Quantify soft-tissue uptake from nnU-Net segmentations (planar scintigraphy).")
-    ap.add_argument("--images_dir", required=True, help="Folder with nnU-Net style inputs: <case>_0000.nii.gz")
-    ap.add_argument("--segs_dir", required=True, help="Folder with predicted segmentations: <case>.nii.gz")
-    ap.add_argument("--out_csv", required=True, help="Output CSV path")
-    ap.add_argument("--channel", type=int, default=0, help="Image channel for (H,W,2) anterior/posterior. Default 0.")
-    ap.add_argument("--sep", default=";", help="CSV separator, default ';'")
-    args = ap.parse_args()
-
-    images_dir = Path(args.images_dir)
-    segs_dir = Path(args.segs_dir)
-    out_csv = Path(args.out_csv)
-
-    if not images_dir.exists():
-        raise FileNotFoundError(images_dir)
-    if not segs_dir.exists():
-        raise FileNotFoundError(segs_dir)
-
-    image_files = sorted(images_dir.glob("*_0000.nii.gz"))
-    if not image_files:
-        raise FileNotFoundError(f"No *_0000.nii.gz found in {images_dir}")
-
-    rows = []
-    missing = 0
-
-    for img_path in image_files:
-        case_id = img_path.name.replace("_0000.nii.gz", "")
-        seg_path = segs_dir / f"{case_id}.nii.gz"
-
-        if not seg_path.exists():
-            missing += 1
-            continue
-
-        rows.append(quantify_case(img_path, seg_path, channel=args.channel, mapping=DEFAULT_MAPPING))
-
-    df = pd.DataFrame(rows).sort_values("case_id").reset_index(drop=True)
-    out_csv.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(out_csv, index=False, sep=args.sep)
-
-    print("Saved:", out_csv)
-    print("Cases quantified:", len(df))
-    print("Missing segmentations:", missing)
-
-
-if __name__ == "__main__":
-    main()
+import argparse
+import json
+import os
+from functools import partial
+from multiprocessing import Pool, resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from decoded_cache import add_decode_cache_args, cached_decode, decode_cache_from_args, get_cache
+from label_cleanup import add_cleanup_args, clean_labels, cleanup_columns, cleanup_from_args
+from label_store import LabelRuns, find_seg, is_rle
+from region_stats import batch_region_stats, region_stats, region_mean
+from nifti_io import strip_nii
+from results_cache import file_fingerprint, open_cache, load_cached_rows, store_rows, prune
+from instrumentation import RunStats, StageClock, add_instrumentation_args, error_reason, profiled
+
+
+# Default label meaning (edit if needed)
+DEFAULT_LABEL_MEANING = {
+    0: "Background",
+    1: "OS_soft",
+    2: "OS_bone",
+    3: "US_soft",
+    4: "US_bone",
+}
+
+DEFAULT_MAPPING = {
+    "OS_soft": 1,
+    "OS_bone": 2,
+    "US_soft": 3,
+    "US_bone": 4,
+}
+
+
+def plane_slicer(shape, path, channel: int = 0, slice_idx=None):
+    """Index tuple that picks one 2D plane out of (H,W), (H,W,C), (H,W,Z), (H,W,Z,C)."""
+    if len(shape) == 2:
+        return (slice(None), slice(None))
+
+    if len(shape) == 3:
+        # (H,W,C) or (H,W,Z)
+        if shape[2] <= 4:
+            if channel >= shape[2]:
+                raise ValueError(f"Channel {channel} out of range for {path} with shape {shape}")
+            return (slice(None), slice(None), channel)
+        else:
+            if slice_idx is None:
+                slice_idx = shape[2] // 2
+            return (slice(None), slice(None), slice_idx)
+
+    if len(shape) == 4:
+        # (H,W,Z,C)
+        if slice_idx is None:
+            slice_idx = shape[2] // 2
+        if channel >= shape[3]:
+            raise ValueError(f"Channel {channel} out of range for {path} with shape {shape}")
+        return (slice(None), slice(None), slice_idx, channel)
+
+    raise ValueError(f"Unsupported NIfTI shape {shape} for {path}")
+
+
+def open_nii(path: Path):
+    # mmap: plain .nii planes are read straight from the page cache
+    return nib.load(str(path), mmap="r")
+
+
+def open_source(path: Path):
+    """Lazy image for plane reads, or with a decoded cache configured the whole array as memmap
+    (a .nii.gz is then gunzipped once across scripts and runs)."""
+    if get_cache() is not None and str(path).endswith(".gz"):
+        return cached_decode(path, "dataobj", lambda: (np.asanyarray(open_nii(path).dataobj), {}))[0]
+    return open_nii(path)
+
+
+def read_plane(img, path: Path, channel: int = 0, slice_idx=None) -> np.ndarray:
+    """One 2D plane of an opened NIfTI (or of an already decoded array)."""
+    data = img if isinstance(img, np.ndarray) else img.dataobj
+    return np.asarray(data[plane_slicer(data.shape, path, channel, slice_idx)])
+
+
+def load_2d_any(path: Path, channel: int = 0, slice_idx=None) -> np.ndarray:
+    """Load NIfTI and return a 2D array.
+    Supports (H,W), (H,W,C), (H,W,Z), (H,W,Z,C).
+    Only the requested plane is read through the array proxy (memory-mapped for plain .nii),
+    in the on-disk dtype unless scl_slope/scl_inter require floats.
+    """
+    return read_plane(open_source(path), path, channel, slice_idx)
+
+
+def labels_uint8(seg: np.ndarray) -> np.ndarray:
+    if seg.dtype.kind == "f":
+        seg = np.rint(seg)
+    return seg.astype(np.uint8, copy=False)
+
+
+def load_labels_2d(path: Path, slice_idx=None) -> np.ndarray:
+    """Load a label map plane as compact uint8 (float label maps are rounded first).
+    <case>.rle.npz (label_store.py) is expanded to the dense plane."""
+    if is_rle(path):
+        return LabelRuns.load(path).to_dense()
+    return labels_uint8(load_2d_any(path, channel=0, slice_idx=slice_idx))
+
+
+def load_seg(path: Path):
+    """Label map for quantify_planes: LabelRuns for <case>.rle.npz (stats from the runs), else the dense plane."""
+    return LabelRuns.load(path) if is_rle(path) else load_labels_2d(path)
+
+
+def safe_ratio(num, den):
+    if np.isnan(num) or np.isnan(den) or den == 0:
+        return np.nan
+    return float(num / den)
+
+
+def case_id_of(image_path: Path) -> str:
+    """<case>_0000.nii.gz / <case>_0000.nii -> <case>"""
+    return strip_nii(image_path.name)[: -len("_0000")]
+
+
+def quantify_planes(img: np.ndarray, seg, mapping: dict, name: str = "", cleanup=None) -> dict:
+    """Region means, soft/bone ratios and pixel counts of one image plane (columns of METRIC_COLS).
+    seg: dense label plane or LabelRuns (then only the foreground pixels of img are read).
+    cleanup: connected-component cleanup spec (label_cleanup.py), adds the cleanup_columns."""
+    if tuple(img.shape) != tuple(seg.shape):
+        raise ValueError(f"Shape mismatch: {name} img {img.shape} vs seg {seg.shape}")
+    info = {}
+    if cleanup:
+        seg, info = clean_labels(seg.to_dense() if isinstance(seg, LabelRuns) else seg, mapping, cleanup)
+
+    # all regions in one bincount pass instead of one mask + copy per region
+    n_labels = max(mapping.values()) + 1
+    if isinstance(seg, LabelRuns):
+        stats = seg.region_stats(img, n_labels)
+    else:
+        stats = region_stats(img, seg, n_labels)
+    return {**plane_metrics(region_mean(stats), stats["count"], mapping), **info}
+
+
+def plane_metrics(means, counts, mapping: dict) -> dict:
+    """METRIC_COLS from the per-label means and pixel counts of one plane."""
+    os_soft_mean = float(means[mapping["OS_soft"]])
+    os_bone_mean = float(means[mapping["OS_bone"]])
+    us_soft_mean = float(means[mapping["US_soft"]])
+    us_bone_mean = float(means[mapping["US_bone"]])
+
+    return {
+        "OS_soft_mean": os_soft_mean,
+        "OS_bone_mean": os_bone_mean,
+        "OS_soft_to_bone_ratio": safe_ratio(os_soft_mean, os_bone_mean),
+        "US_soft_mean": us_soft_mean,
+        "US_bone_mean": us_bone_mean,
+        "US_soft_to_bone_ratio": safe_ratio(us_soft_mean, us_bone_mean),
+        "OS_soft_n": int(counts[mapping["OS_soft"]]),
+        "OS_bone_n": int(counts[mapping["OS_bone"]]),
+        "US_soft_n": int(counts[mapping["US_soft"]]),
+        "US_bone_n": int(counts[mapping["US_bone"]]),
+    }
+
+
+METRIC_COLS = [
+    "OS_soft_mean", "OS_bone_mean", "OS_soft_to_bone_ratio",
+    "US_soft_mean", "US_bone_mean", "US_soft_to_bone_ratio",
+    "OS_soft_n", "OS_bone_n", "US_soft_n", "US_bone_n",
+]
+
+
+def quantify_case(image_path: Path, seg_path: Path, channel: int, mapping: dict, clock=None, cleanup=None) -> dict:
+    clock = clock or StageClock()
+    with clock("read"):
+        img = load_2d_any(image_path, channel=channel)
+        seg = load_seg(seg_path)
+    with clock("compute"):
+        metrics = quantify_planes(img, seg, mapping, name=image_path.name, cleanup=cleanup)
+    return {"case_id": case_id_of(image_path), **metrics}
+
+
+def gm_columns(row: dict, ant: str, post: str) -> dict:
+    """Conjugate-view geometric means sqrt(ANT * POST) of the region means and the ratios built from them."""
+    out = {}
+    for region in ("OS_soft", "OS_bone", "US_soft", "US_bone"):
+        a, p = row.get(f"{ant}_{region}_mean", np.nan), row.get(f"{post}_{region}_mean", np.nan)
+        out[f"GM_{region}_mean"] = float(np.sqrt(a * p)) if a >= 0 and p >= 0 else np.nan
+    out["GM_OS_soft_to_bone_ratio"] = safe_ratio(out["GM_OS_soft_mean"], out["GM_OS_bone_mean"])
+    out["GM_US_soft_to_bone_ratio"] = safe_ratio(out["GM_US_soft_mean"], out["GM_US_bone_mean"])
+    return out
+
+
+GM_COLS = [
+    "GM_OS_soft_mean", "GM_OS_bone_mean", "GM_US_soft_mean", "GM_US_bone_mean",
+    "GM_OS_soft_to_bone_ratio", "GM_US_soft_to_bone_ratio",
+]
+
+
+def quantify_study(case_id: str, views: list, mapping: dict, gm_views=None, clock=None, cleanup=None) -> dict:
+    """All views of one study -> one wide row (<view>_<metric> columns + GM_* if both gm_views exist).
+    views: [(view, image_path, seg_path, channel)]
+    Files used by several views (e.g. one (H,W,2) ANT/POST image) are decoded once.
+    """
+    n_uses = {}
+    for _, img_path, seg_path, _ in views:
+        n_uses[img_path] = n_uses.get(img_path, 0) + 1
+        n_uses[seg_path] = n_uses.get(seg_path, 0) + 1
+
+    clock = clock or StageClock()
+    opened = {}
+
+    def source(path):
+        if path not in opened:
+            img = open_source(path)
+            # shared file: decode it once and slice the planes from memory
+            opened[path] = np.asanyarray(img.dataobj) if n_uses[path] > 1 and not isinstance(img, np.ndarray) else img
+        return opened[path]
+
+    row = {"case_id": case_id}
+    for view, img_path, seg_path, channel in views:
+        with clock("read"):
+            img = read_plane(source(img_path), img_path, channel)
+            seg = load_seg(seg_path) if is_rle(seg_path) else labels_uint8(read_plane(source(seg_path), seg_path))
+        with clock("compute"):
+            for k, v in quantify_planes(img, seg, mapping, name=f"{Path(img_path).name} [{view}]",
+                                        cleanup=cleanup).items():
+                row[f"{view}_{k}"] = v
+
+    if gm_views:
+        row.update(gm_columns(row, *gm_views))
+    return row
+
+
+def _quantify_task(task, mapping: dict, gm_views=None, skip_errors=False, cleanup=None):
+    # top-level so it can be pickled into pool workers; returns (row, stage times, error reason)
+    case_id, views = task
+    clock = StageClock()
+    try:
+        if len(views) == 1 and views[0][0] is None:
+            _, img_path, seg_path, channel = views[0]
+            row = quantify_case(img_path, seg_path, channel=channel, mapping=mapping, clock=clock, cleanup=cleanup)
+        else:
+            row = quantify_study(case_id, views, mapping, gm_views=gm_views, clock=clock, cleanup=cleanup)
+    except Exception as e:
+        if not skip_errors:
+            raise
+        return None, clock.times, error_reason(e)
+    return row, clock.times, None
+
+
+def iter_results(tasks, mapping: dict, workers: int = 1, chunksize=None, gm_views=None, stats=None,
+                 skip_errors=False, cleanup=None):
+    """Yield one row per task in task order, optionally across a process pool.
+    tasks: [(case_id, [(view, image_path, seg_path, channel)])]; view None = single-view row.
+    stats: RunStats that collects the per-case stage times/errors (see instrumentation.py).
+    skip_errors: count failing cases in stats instead of aborting the run.
+    cleanup: connected-component cleanup spec applied to every label plane (label_cleanup.py).
+    """
+    fn = partial(_quantify_task, mapping=mapping, gm_views=gm_views, skip_errors=skip_errors, cleanup=cleanup)
+    if workers <= 1:
+        results = map(fn, tasks)
+        pool = None
+    else:
+        if chunksize is None:
+            # a few chunks per worker keeps the pool busy without huge result backlogs
+            chunksize = max(1, min(64, len(tasks) // (workers * 8)))
+        pool = Pool(processes=workers)
+        # imap keeps input order, so the CSV stays sorted by case_id
+        results = pool.imap(fn, tasks, chunksize=chunksize)
+
+    try:
+        for row, times, err in results:
+            if stats is not None:
+                stats.file_done(times)
+                if err is not None:
+                    stats.error(*err)
+            if row is not None:
+                yield row
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+# --- batched mode: same-shape planes stacked in shared memory, one bincount per stack ---
+
+def _attach(name: str, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _fill_slot(job):
+    # runs in pool workers: decode one image/label plane straight into slot k of the shared stacks
+    # (nothing but the file paths and the stack names is pickled), cleaning the labels on the way if asked;
+    # returns (k, stage times, exception, cleanup columns)
+    img_name, seg_name, stack_shape, k, img_path, seg_path, channel, mapping, cleanup = job
+    clock = StageClock()
+    info = {}
+    try:
+        with clock("read"):
+            img = load_2d_any(img_path, channel=channel)
+            seg = load_labels_2d(seg_path)
+        if img.shape != seg.shape or img.shape != tuple(stack_shape[1:]):
+            raise ValueError(f"Shape mismatch: {Path(img_path).name} img {img.shape} vs seg {seg.shape}")
+        if cleanup:
+            with clock("cleanup"):
+                seg, info = clean_labels(seg, mapping, cleanup)
+        with clock("copy"):
+            shm_img, imgs = _attach(img_name, stack_shape, np.float64)
+            shm_seg, segs = _attach(seg_name, stack_shape, np.uint8)
+            imgs[k] = img
+            segs[k] = seg
+            del imgs, segs
+            shm_img.close()
+            shm_seg.close()
+    except Exception as e:
+        return k, clock.times, e, info
+    return k, clock.times, None, info
+
+
+class PlaneStacks:
+    """Shared (N,H,W) float64 image + uint8 label stacks, one pair per plane shape, reused across batches."""
+
+    def __init__(self):
+        self.stacks = {}
+
+    def get(self, shape, n: int):
+        stack = self.stacks.get(shape)
+        if stack is None or stack[2] < n:
+            if stack is not None:
+                self._free(stack)
+            pixels = n * shape[0] * shape[1]
+            stack = (shared_memory.SharedMemory(create=True, size=pixels * 8),
+                     shared_memory.SharedMemory(create=True, size=pixels), n)
+            self.stacks[shape] = stack
+        shm_img, shm_seg, cap = stack
+        full = (cap, *shape)
+        return (shm_img.name, shm_seg.name, full,
+                np.ndarray(full, dtype=np.float64, buffer=shm_img.buf),
+                np.ndarray(full, dtype=np.uint8, buffer=shm_seg.buf))
+
+    @staticmethod
+    def _free(stack):
+        for shm in stack[:2]:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        for stack in self.stacks.values():
+            self._free(stack)
+        self.stacks = {}
+
+
+def iter_results_batched(tasks, mapping: dict, workers: int = 1, batch_size: int = 64, gm_views=None, stats=None,
+                         skip_errors=False, cleanup=None):
+    """Same rows as iter_results (in task order), computed batch_size cases at a time:
+    the planes of a batch are grouped by shape (header only), decoded by the workers straight into
+    shared (N,H,W) stacks and quantified with one bincount per stack (batch_region_stats).
+    """
+    n_labels = max(mapping.values()) + 1
+    if workers > 1 and os.name == "posix":
+        # forked workers must share our resource tracker, or their own one unlinks the stacks when they exit
+        resource_tracker.ensure_running()
+    pool = Pool(processes=workers) if workers > 1 else None
+    stacks = PlaneStacks()
+    try:
+        for start in range(0, len(tasks), batch_size):
+            window = tasks[start:start + batch_size]
+            times = {case_id: {} for case_id, _ in window}
+            failed = {}
+            metrics = {}
+
+            def add_times(case_id, t):
+                for stage, sec in t.items():
+                    times[case_id][stage] = times[case_id].get(stage, 0.0) + sec
+
+            groups = {}
+            for case_id, views in window:
+                for view, img_path, seg_path, channel in views:
+                    try:
+                        shape = tuple(open_nii(img_path).shape[:2])
+                    except Exception as e:
+                        failed.setdefault(case_id, e)
+                        continue
+                    groups.setdefault(shape, []).append((case_id, view, img_path, seg_path, channel))
+
+            for shape, planes in groups.items():
+                img_name, seg_name, full, imgs, segs = stacks.get(shape, len(planes))
+                jobs = [(img_name, seg_name, full, k, img_path, seg_path, channel, mapping, cleanup)
+                        for k, (_, _, img_path, seg_path, channel) in enumerate(planes)]
+                done = pool.map(_fill_slot, jobs) if pool is not None else map(_fill_slot, jobs)
+                infos = {}
+                for k, t, err, info in done:
+                    add_times(planes[k][0], t)
+                    infos[k] = info
+                    if err is not None:
+                        failed.setdefault(planes[k][0], err)
+
+                clock = StageClock()
+                with clock("compute"):
+                    # slots of failed planes hold stale pixels; their results are never used
+                    n = len(planes)
+                    st = batch_region_stats(imgs[:n], segs[:n], n_labels)
+                    means = region_mean(st)
+                    for k, (case_id, view, _, _, _) in enumerate(planes):
+                        if case_id not in failed:
+                            metrics[(case_id, view)] = {**plane_metrics(means[k], st["count"][k], mapping), **infos[k]}
+                del imgs, segs
+                for case_id, _, _, _, _ in planes:
+                    add_times(case_id, {s: v / n for s, v in clock.times.items()})
+
+            for case_id, views in window:
+                err = failed.get(case_id)
+                if err is not None and not skip_errors:
+                    raise err
+                if stats is not None:
+                    stats.file_done(times[case_id])
+                    if err is not None:
+                        stats.error(*error_reason(err))
+                if err is not None:
+                    continue
+                if len(views) == 1 and views[0][0] is None:
+                    yield {"case_id": case_id, **metrics[(case_id, None)]}
+                    continue
+                row = {"case_id": case_id}
+                for view, _, _, _ in views:
+                    for k, v in metrics[(case_id, view)].items():
+                        row[f"{view}_{k}"] = v
+                if gm_views:
+                    row.update(gm_columns(row, *gm_views))
+                yield row
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        stacks.close()
+
+
+def collect_view_tasks(view_specs):
+    """--view triplets -> ({case_id: [(view, image_path, seg_path, channel)]}, missing segmentations).
+    Cases are matched across views by case_id (<case>_0000 in every images_dir).
+    """
+    studies = {}
+    missing = 0
+    for view, images_dir, segs_dir, channel in view_specs:
+        images_dir, segs_dir = Path(images_dir), Path(segs_dir)
+        for d in (images_dir, segs_dir):
+            if not d.exists():
+                raise FileNotFoundError(d)
+        for img_path in sorted(p for p in images_dir.glob("*_0000.nii*") if strip_nii(p.name) != p.name):
+            case_id = case_id_of(img_path)
+            seg_path = find_seg(segs_dir, case_id)
+            if seg_path is None:
+                missing += 1
+                continue
+            studies.setdefault(case_id, []).append((view, img_path, seg_path, channel))
+    return studies, missing
+
+
+def read_views_csv(path: Path, sep: str):
+    """Master mapping table (long format): case_id, view, image_path, seg_path[, channel]."""
+    df = pd.read_csv(path, sep=sep, dtype=str).fillna("")
+    need = {"case_id", "view", "image_path", "seg_path"}
+    if not need.issubset(df.columns):
+        raise ValueError(f"{path} needs columns {sorted(need)}, found {list(df.columns)}")
+
+    studies = {}
+    missing = 0
+    for r in df.itertuples(index=False):
+        seg_path = Path(r.seg_path) if r.seg_path else None
+        if seg_path is None or not seg_path.exists():
+            missing += 1
+            continue
+        channel = int(getattr(r, "channel", "") or 0)
+        studies.setdefault(r.case_id, []).append((r.view, Path(r.image_path), seg_path, channel))
+    return studies, missing
+
+
+def parse_view_spec(spec):
+    """--view VIEW IMAGES_DIR SEGS_DIR [CHANNEL]"""
+    if len(spec) not in (3, 4):
+        raise ValueError(f"--view needs VIEW IMAGES_DIR SEGS_DIR [CHANNEL], got {spec}")
+    return spec[0], spec[1], spec[2], int(spec[3]) if len(spec) == 4 else 0
+
+
+def write_rows(out_csv: Path, rows: list, sep: str, header: bool, columns=None):
+    """Append a batch of rows to out_csv (header only on the first batch)."""
+    pd.DataFrame(rows, columns=columns).to_csv(out_csv, mode="w" if header else "a", header=header, index=False, sep=sep)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Quantify soft-tissue uptake from nnU-Net segmentations (planar scintigraphy).")
+    ap.add_argument("--images_dir", default=None, help="Folder with nnU-Net style inputs: <case>_0000.nii.gz (or .nii)")
+    ap.add_argument("--segs_dir", default=None,
+                    help="Folder with predicted segmentations: <case>.nii.gz (or .nii, or .rle.npz from label_store.py)")
+    ap.add_argument("--out_csv", required=True, help="Output CSV path")
+    ap.add_argument("--channel", type=int, default=0, help="Image channel for (H,W,2) anterior/posterior. Default 0.")
+    ap.add_argument("--view", nargs="+", action="append", default=None, metavar="ARG",
+                    help="Multi-view mode: VIEW IMAGES_DIR SEGS_DIR [CHANNEL] (repeatable), e.g. "
+                         "--view ant ...\\ant_in ...\\ant_seg --view post ...\\post_in ...\\post_seg. "
+                         "Writes one wide row per case_id with <view>_<metric> columns.")
+    ap.add_argument("--views_csv", default=None,
+                    help="Multi-view mode from a master table: case_id, view, image_path, seg_path[, channel]")
+    ap.add_argument("--gm_views", nargs=2, default=["ant", "post"], metavar=("ANT", "POST"),
+                    help="Views combined into GM_* geometric-mean columns (multi-view mode). Default: ant post.")
+    ap.add_argument("--sep", default=";", help="CSV separator, default ';'")
+    ap.add_argument("--workers", type=int, default=1, help="Worker processes. Default 1 (serial).")
+    ap.add_argument("--chunksize", type=int, default=None, help="Cases per pool task. Default: auto.")
+    ap.add_argument("--batch_size", type=int, default=0,
+                    help="Batched mode: quantify N cases at a time from shared-memory (N,H,W) stacks of same-shape "
+                         "planes, one bincount per stack. Default 0 (case by case).")
+    ap.add_argument("--flush_every", type=int, default=500, help="Write rows to the CSV every N cases. Default 500.")
+    ap.add_argument("--cache", default=None,
+                    help="SQLite results cache. Cases whose image/seg fingerprints are unchanged are not recomputed.")
+    ap.add_argument("--fingerprint", choices=["stat", "hash"], default="stat",
+                    help="Cache key per file: stat = size+mtime (fast), hash = sha1 of the content. Default stat.")
+    ap.add_argument("--resume", action="store_true",
+                    help="Continue an interrupted run without --cache: keep rows already in out_csv and quantify the rest.")
+    ap.add_argument("--skip_errors", action="store_true",
+                    help="Count failing cases (e.g. shape mismatch) by reason in the log instead of aborting the run.")
+    add_cleanup_args(ap)
+    add_decode_cache_args(ap)
+    add_instrumentation_args(ap)
+    args = ap.parse_args(argv)
+    decode_cache_from_args(args)
+
+    with profiled(args.profile):
+        run(args)
+
+
+def run(args):
+    out_csv = Path(args.out_csv)
+    stats = RunStats("quantify_soft_tissue_uptake", progress_every=args.progress_every)
+    multi_view = bool(args.view or args.views_csv)
+    cleanup = cleanup_from_args(args)
+    cc_cols = cleanup_columns(cleanup, DEFAULT_MAPPING) if cleanup else []
+
+    with stats.stage("discover"):
+        if multi_view:
+            if args.views_csv:
+                studies, missing = read_views_csv(Path(args.views_csv), args.sep)
+            else:
+                studies, missing = collect_view_tasks([parse_view_spec(v) for v in args.view])
+            if not studies:
+                raise FileNotFoundError("No image/segmentation pairs found for the given views")
+
+            view_names = list(dict.fromkeys(v[0] for views in studies.values() for v in views))
+            gm_views = tuple(args.gm_views) if set(args.gm_views) <= set(view_names) else None
+            columns = (["case_id"] + [f"{v}_{m}" for v in view_names for m in METRIC_COLS + cc_cols]
+                       + (GM_COLS if gm_views else []))
+            tasks = sorted(studies.items())
+            print("Studies:", len(tasks), "| views:", ", ".join(view_names))
+        else:
+            if not args.images_dir or not args.segs_dir:
+                raise ValueError("Give --images_dir and --segs_dir, or --view / --views_csv for multi-view mode")
+            images_dir = Path(args.images_dir)
+            segs_dir = Path(args.segs_dir)
+
+            if not images_dir.exists():
+                raise FileNotFoundError(images_dir)
+            if not segs_dir.exists():
+                raise FileNotFoundError(segs_dir)
+
+            image_files = sorted(p for p in images_dir.glob("*_0000.nii*") if strip_nii(p.name) != p.name)
+            if not image_files:
+                raise FileNotFoundError(f"No *_0000.nii.gz / *_0000.nii found in {images_dir}")
+
+            tasks = []
+            missing = 0
+
+            for img_path in image_files:
+                case_id = case_id_of(img_path)
+                seg_path = find_seg(segs_dir, case_id)
+
+                if seg_path is None:
+                    missing += 1
+                    continue
+
+                tasks.append((case_id, [(None, img_path, seg_path, args.channel)]))
+
+            tasks.sort(key=lambda t: t[0])
+            gm_views = None
+            columns = ["case_id"] + METRIC_COLS + cc_cols
+
+    if missing:
+        stats.skip("missing segmentation", missing)
+
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+
+    # --cache: only recompute cases whose image or segmentation changed
+    con = None
+    cached = {}
+    if args.cache:
+        con = open_cache(Path(args.cache))
+        # (no cleanup key without cleanup: existing caches stay valid)
+        extra = {"cleanup": cleanup} if cleanup else {}
+        if multi_view:
+            params = json.dumps({"views": view_names, "gm_views": gm_views, "mapping": DEFAULT_MAPPING, **extra},
+                                sort_keys=True)
+        else:
+            params = json.dumps({"channel": args.channel, "mapping": DEFAULT_MAPPING, **extra}, sort_keys=True)
+
+        def view_key(view, channel, path):
+            fp = file_fingerprint(path, args.fingerprint)
+            return fp if view is None else f"{view}:{channel}:{fp}"
+
+        # multi-view: one key per study, the fingerprints of all its files joined in view order
+        keys = {
+            case_id: (
+                "|".join(view_key(view, channel, img_path) for view, img_path, _, channel in views),
+                "|".join(view_key(view, channel, seg_path) for view, _, seg_path, channel in views),
+            )
+            for case_id, views in tasks
+        }
+        prune(con, keys)
+        cached = load_cached_rows(con, keys, params)
+        tasks = [t for t in tasks if t[0] not in cached]
+        print("Cache hits:", len(cached), "| to compute:", len(tasks))
+
+    # --resume: cases already in out_csv came from the interrupted run, keep appending after them
+    # (with --cache the cache itself already holds the progress of an interrupted run)
+    n_written = 0
+    if args.resume and con is None and out_csv.exists() and out_csv.stat().st_size > 0:
+        done = set(pd.read_csv(out_csv, sep=args.sep, usecols=["case_id"], dtype=str)["case_id"])
+        tasks = [t for t in tasks if t[0] not in done]
+        n_written = len(done)
+        print("Resuming after", n_written, "cases already in", out_csv)
+
+    # stream rows in bounded batches so a crash keeps everything computed so far:
+    # straight into out_csv, or into the cache when out_csv is re-merged at the end
+    new_rows = []
+
+    def flush(rows):
+        nonlocal n_written
+        with stats.stage("write"):
+            if con is not None:
+                store_rows(con, rows, keys, params)
+                new_rows.extend(rows)
+            else:
+                write_rows(out_csv, rows, args.sep, header=(n_written == 0), columns=columns)
+                n_written += len(rows)
+
+    stats.total = len(tasks)
+    batch = []
+    if args.batch_size > 0:
+        results = iter_results_batched(tasks, DEFAULT_MAPPING, workers=args.workers, batch_size=args.batch_size,
+                                       gm_views=gm_views, stats=stats, skip_errors=args.skip_errors, cleanup=cleanup)
+    else:
+        results = iter_results(tasks, DEFAULT_MAPPING, workers=args.workers, chunksize=args.chunksize,
+                               gm_views=gm_views, stats=stats, skip_errors=args.skip_errors, cleanup=cleanup)
+    for row in results:
+        batch.append(row)
+        if len(batch) >= args.flush_every:
+            flush(batch)
+            batch = []
+    if batch or n_written == 0:
+        flush(batch)
+
+    if con is not None:
+        con.close()
+        # unchanged cached rows + recomputed ones, sorted like a full run
+        with stats.stage("write"):
+            rows = sorted(list(cached.values()) + new_rows, key=lambda r: r["case_id"])
+            write_rows(out_csv, rows, args.sep, header=True, columns=columns)
+        n_written = len(rows)
+
+    print("Saved:", out_csv)
+    print("Studies quantified:" if multi_view else "Cases quantified:", n_written)
+    print("Missing segmentations:", missing)
+    stats.report(args.log_json, extra={"cache_hits": len(cached), "rows_written": n_written})
+
+
+if __name__ == "__main__":
+    main()
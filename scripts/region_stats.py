@@ -0,0 +1,111 @@
+import numpy as np
+
+
+def region_stats(img: np.ndarray, seg: np.ndarray, n_labels: int, percentiles=(), extrema=False,
+                 sumsq=False) -> dict:
+    """Per-label statistics of img over the label map seg.
+
+    Returns a dict of 1D arrays indexed by label (0..n_labels-1): count and sum, plus on request
+    sumsq (sumsq=True), min/max (extrema=True) and p<q> for every requested percentile.
+    count/sum/sumsq come from weighted np.bincount passes over the label map;
+    min/max/percentiles need one sort of the pixels grouped by label, so they are off by default.
+    Labels >= n_labels are ignored, empty labels get NaN for min/max/percentiles.
+    """
+    if img.shape != seg.shape:
+        raise ValueError(f"Shape mismatch: img {img.shape} vs seg {seg.shape}")
+
+    labels = np.ravel(seg)
+    values = np.ravel(img).astype(np.float64, copy=False)
+
+    # bincount needs non-negative ints; labels are small, so this is cheap
+    if labels.dtype.kind not in "ui":
+        labels = np.rint(labels).astype(np.int64)
+
+    # --- pass 1: count / sum (/ sum of squares) ---
+    count = np.bincount(labels, minlength=n_labels)[:n_labels]
+    total = np.bincount(labels, weights=values, minlength=n_labels)[:n_labels]
+    stats = {"count": count, "sum": total}
+    if sumsq:
+        stats["sumsq"] = np.bincount(labels, weights=values * values, minlength=n_labels)[:n_labels]
+    if not extrema and not percentiles:
+        return stats
+
+    if extrema:
+        stats["min"] = np.full(n_labels, np.nan)
+        stats["max"] = np.full(n_labels, np.nan)
+    for q in percentiles:
+        stats[f"p{q:g}"] = np.full(n_labels, np.nan)
+
+    # --- pass 2: group pixels by label (sorted by value inside each label) ---
+    if percentiles:
+        order = np.lexsort((values, labels))
+    else:
+        order = np.argsort(labels, kind="stable")
+    grouped = values[order]
+
+    # label groups start after all pixels with a smaller label (labels >= n_labels sort last)
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    present = np.flatnonzero(count)
+    if present.size == 0:
+        return stats
+
+    if percentiles:
+        if extrema:
+            # values are sorted inside each group: min/max are the group ends
+            stats["min"][present] = grouped[starts[present]]
+            stats["max"][present] = grouped[starts[present] + count[present] - 1]
+        for q in percentiles:
+            # same interpolation as np.percentile(..., method="linear")
+            pos = starts[present] + (count[present] - 1) * (q / 100.0)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, starts[present] + count[present] - 1)
+            frac = pos - lo
+            stats[f"p{q:g}"][present] = grouped[lo] + (grouped[hi] - grouped[lo]) * frac
+    else:
+        # reduceat runs each group up to the next start; cut off labels >= n_labels first
+        inside = grouped[:int(count.sum())]
+        stats["min"][present] = np.minimum.reduceat(inside, starts[present])
+        stats["max"][present] = np.maximum.reduceat(inside, starts[present])
+
+    return stats
+
+
+def region_mean(stats: dict) -> np.ndarray:
+    """Mean per label (NaN for empty labels)."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(stats["count"] > 0, stats["sum"] / np.maximum(stats["count"], 1), np.nan)
+
+
+def region_std(stats: dict) -> np.ndarray:
+    """Population standard deviation per label (NaN for empty labels); needs sumsq=True stats."""
+    n = np.maximum(stats["count"], 1)
+    mean = stats["sum"] / n
+    var = np.maximum(stats["sumsq"] / n - mean * mean, 0.0)
+    return np.where(stats["count"] > 0, np.sqrt(var), np.nan)
+
+
+def batch_region_stats(img: np.ndarray, seg: np.ndarray, n_labels: int) -> dict:
+    """count/sum per case and label of a stack of planes: img, seg (N,H,W) -> (N, n_labels) arrays.
+
+    One bincount over the whole stack: label l of case k goes to bin k * (n_labels + 1) + l,
+    labels >= n_labels are clipped into an extra bin per case and dropped.
+    Per case the pixels are summed in the same order as region_stats, so the results are identical.
+    """
+    if img.shape != seg.shape:
+        raise ValueError(f"Shape mismatch: img {img.shape} vs seg {seg.shape}")
+    n = seg.shape[0]
+    stride = n_labels + 1
+
+    labels = seg.reshape(n, -1)
+    if labels.dtype.kind not in "ui":
+        labels = np.rint(labels)
+    idx = np.minimum(labels, n_labels).astype(np.intp)
+    idx += (np.arange(n, dtype=np.intp) * stride)[:, None]
+    idx = idx.ravel()
+    values = img.reshape(-1).astype(np.float64, copy=False)
+
+    size = n * stride
+    return {
+        "count": np.bincount(idx, minlength=size).reshape(n, stride)[:, :n_labels],
+        "sum": np.bincount(idx, weights=values, minlength=size).reshape(n, stride)[:, :n_labels],
+    }
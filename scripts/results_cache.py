@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+
+def file_fingerprint(path: Path, mode: str = "stat") -> str:
+    """Cheap file identity.
+    stat: size + mtime (ns), hash: sha1 of the file content (robust to copies/touches),
+    content: like hash, but of the decompressed content of .gz files (gzip headers carry the write time,
+    so rewriting the same image gives new bytes).
+    """
+    path = Path(path)
+    if mode == "stat":
+        st = path.stat()
+        return f"{st.st_size}:{st.st_mtime_ns}"
+    if mode in ("hash", "content"):
+        h = hashlib.sha1()
+        opener = gzip.open if mode == "content" and path.name.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return "sha1:" + h.hexdigest()
+    raise ValueError(f"Unknown fingerprint mode: {mode}")
+
+
+def open_cache(db_path: Path) -> sqlite3.Connection:
+    """Open (or create) the per-case results cache."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(db_path))
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        " case_id TEXT PRIMARY KEY,"
+        " image_fp TEXT NOT NULL,"
+        " seg_fp TEXT NOT NULL,"
+        " params TEXT NOT NULL,"
+        " row_json TEXT NOT NULL)"
+    )
+    return con
+
+
+def load_cached_rows(con: sqlite3.Connection, keys: dict, params: str) -> dict:
+    """Return {case_id: row} for every case whose (image_fp, seg_fp, params) still match.
+    keys: {case_id: (image_fp, seg_fp)}
+    """
+    hits = {}
+    for case_id, image_fp, seg_fp, p, row_json in con.execute("SELECT * FROM results"):
+        if keys.get(case_id) == (image_fp, seg_fp) and p == params:
+            hits[case_id] = json.loads(row_json)
+    return hits
+
+
+def store_rows(con: sqlite3.Connection, rows: list, keys: dict, params: str):
+    """Insert/replace a batch of freshly computed rows (one transaction per batch)."""
+    with con:
+        con.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            [(r["case_id"], *keys[r["case_id"]], params, json.dumps(r)) for r in rows],
+        )
+
+
+def prune(con: sqlite3.Connection, keep_ids):
+    """Drop cache entries for cases that no longer exist."""
+    keep_ids = set(keep_ids)
+    stale = [(cid,) for (cid,) in con.execute("SELECT case_id FROM results") if cid not in keep_ids]
+    if stale:
+        with con:
+            con.executemany("DELETE FROM results WHERE case_id = ?", stale)
+    return len(stale)
@@ -0,0 +1,268 @@
+import argparse
+import sqlite3
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from build_dicom_nifti_reference import merge_reference
+from deduplicate_scans import fan_out
+from quantify_soft_tissue_uptake import DEFAULT_MAPPING, METRIC_COLS
+
+# Cohort results store: the quantification output joined once with the mapping and the DICOM<->NIfTI
+# reference, in one SQLite file that can be queried without re-merging CSVs.
+#   studies       one row per case: patient, study date/time, study UID, source file   (index: patient+date, date)
+#   measurements  one row per case and view (ant, post, GM, ...) with the metric columns (index: view)
+# The store is rebuilt from the CSVs on every build; queries join the two tables on case_id.
+
+SINGLE_VIEW = "single"
+GM_VIEW = "GM"
+STUDY_COLUMNS = {
+    # store column: candidate source columns, first non-empty value wins (DICOM side before NIfTI filename)
+    # (CamelCase: file-level DICOM index, snake_case: series-level index of build_dicom_index.py)
+    "patient_id": ["PatientID", "patient_id"],
+    "study_date": ["dicom_StudyDate", "study_date", "StudyDate"],
+    "study_time": ["dicom_StudyTime", "study_time", "StudyTime"],
+    "study_uid": ["StudyInstanceUID", "study_uid"],
+    "accession": ["AccessionNumber"],
+    "series_description": ["SeriesDescription", "series_description"],
+    "source_filename": ["source_filename"],
+    "source_path": ["source_path"],
+    "match_found": ["match_found"],
+}
+
+
+def join_results(uptake: pd.DataFrame, mapping: pd.DataFrame = None, reference: pd.DataFrame = None) -> pd.DataFrame:
+    """Per-case uptake rows + source file (mapping; duplicates from deduplicate_scans get their canonical's
+    results) + DICOM reference columns. Joins that the input already has (run_pipeline out_csv) are skipped."""
+    out = uptake
+    if mapping is not None and "source_filename" not in out.columns:
+        if "canonical_case_id" in mapping.columns:
+            alias = mapping[mapping["canonical_case_id"] != mapping["case_id"]]
+            out = fan_out(out, dict(zip(alias["case_id"], alias["canonical_case_id"])))
+        out = out.merge(mapping[["case_id", "source_path", "source_filename"]], on="case_id", how="left")
+    if reference is not None and "match_found" not in out.columns and "source_path" in out.columns:
+        out = merge_reference(out, reference)
+    return out
+
+
+def split_views(df: pd.DataFrame, views=None):
+    """Wide uptake rows -> {view: [metric columns]}: <view>_<metric> columns of multi-view runs (incl. the
+    GM_ geometric means), plain metric columns of single-view runs.
+    The view is whatever precedes a known metric name, so view names may contain "_" (ant_180).
+    views: view names of the run (GM is always allowed); any other prefix raises ValueError.
+    """
+    metrics = set(METRIC_COLS) | {f"{region}_{s}" for region in DEFAULT_MAPPING
+                                  for s in ("components", "removed_n", "filled_n")}
+    # longest first, so a metric that ends with a shorter one is never split in the middle
+    suffixes = sorted(metrics, key=len, reverse=True)
+    allowed = None if views is None else set(views) | {GM_VIEW}
+    found = {}
+    for col in df.columns:
+        if col in metrics:
+            found.setdefault(SINGLE_VIEW, []).append(col)
+            continue
+        metric = next((m for m in suffixes if col.endswith(f"_{m}")), None)
+        if metric is None:
+            continue
+        view = col[: -len(metric) - 1]
+        if allowed is not None and view not in allowed:
+            raise ValueError(f"Column {col}: unknown view {view!r} (expected one of {sorted(allowed)})")
+        found.setdefault(view, []).append(col)
+    return found
+
+
+def study_rows(df: pd.DataFrame) -> pd.DataFrame:
+    studies = pd.DataFrame({"case_id": df["case_id"].astype(str)})
+    for col, candidates in STUDY_COLUMNS.items():
+        value = pd.Series(pd.NA, index=df.index, dtype=object)
+        for c in candidates:
+            if c in df.columns:
+                value = value.fillna(df[c].where(df[c].astype(str).str.strip() != ""))
+        studies[col] = value
+    studies["match_found"] = pd.to_numeric(studies["match_found"], errors="coerce")
+    return studies
+
+
+def measurement_rows(df: pd.DataFrame, views=None) -> pd.DataFrame:
+    """Long format: one row per (case_id, view), metric columns without the view prefix."""
+    parts = []
+    for view, cols in split_views(df, views).items():
+        prefix = "" if view == SINGLE_VIEW else f"{view}_"
+        names = [c[len(prefix):] for c in cols]
+        part = df[["case_id"] + cols].rename(columns=dict(zip(cols, names)))
+        part[names] = part[names].apply(pd.to_numeric, errors="coerce")
+        # views a case does not have (e.g. no POST plane) get no row
+        part = part[part[names].notna().any(axis=1)]
+        parts.append(part.assign(view=view))
+    if not parts:
+        raise ValueError("No metric columns found (expected METRIC_COLS or <view>_<metric> columns)")
+    out = pd.concat(parts, ignore_index=True)
+    return out[["case_id", "view"] + [c for c in out.columns if c not in ("case_id", "view")]]
+
+
+def build_store(results: pd.DataFrame, db_path: Path, views=None) -> dict:
+    """(Re)write the store from joined per-case rows (join_results); returns the table sizes.
+    views: view names of the run (see split_views); None accepts any prefix of a metric column."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    studies = study_rows(results).drop_duplicates("case_id")
+    measurements = measurement_rows(results, views)
+    dup = measurements.duplicated(["case_id", "view"], keep=False)
+    if dup.any():
+        cases = measurements.loc[dup, "case_id"].unique()
+        raise ValueError(f"{len(cases)} case(s) have more than one result row per view, e.g. {list(cases[:5])} "
+                         "(duplicate rows in the uptake CSV or a join that multiplied them)")
+    metric_cols = [c for c in measurements.columns if c not in ("case_id", "view")]
+
+    tmp = db_path.with_name(db_path.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    con = sqlite3.connect(str(tmp))
+    try:
+        with con:
+            con.execute("CREATE TABLE studies (case_id TEXT PRIMARY KEY, "
+                        + ", ".join(f"{c} {'REAL' if c == 'match_found' else 'TEXT'}" for c in STUDY_COLUMNS) + ")")
+            con.execute("CREATE TABLE measurements (case_id TEXT NOT NULL, view TEXT NOT NULL, "
+                        + ", ".join(f'"{c}" REAL' for c in metric_cols) + ", PRIMARY KEY (case_id, view))")
+            studies.to_sql("studies", con, if_exists="append", index=False)
+            measurements.to_sql("measurements", con, if_exists="append", index=False)
+            con.execute("CREATE INDEX studies_patient ON studies (patient_id, study_date, study_time)")
+            con.execute("CREATE INDEX studies_date ON studies (study_date)")
+            con.execute("CREATE INDEX measurements_view ON measurements (view, case_id)")
+        con.execute("ANALYZE")
+    finally:
+        con.close()
+    # atomic: readers never see a half-built store
+    tmp.replace(db_path)
+    return {"studies": len(studies), "measurements": len(measurements)}
+
+
+def open_store(db_path: Path) -> sqlite3.Connection:
+    db_path = Path(db_path)
+    if not db_path.exists():
+        raise FileNotFoundError(db_path)
+    return sqlite3.connect(f"file:{db_path.as_posix()}?mode=ro", uri=True)
+
+
+def metric_columns(con: sqlite3.Connection) -> list:
+    return [r[1] for r in con.execute("PRAGMA table_info(measurements)") if r[1] not in ("case_id", "view")]
+
+
+def _select_metrics(con, metrics):
+    available = metric_columns(con)
+    metrics = list(metrics) if metrics else available
+    unknown = [m for m in metrics if m not in available]
+    if unknown:
+        raise ValueError(f"Unknown metrics {unknown}, available: {available}")
+    return metrics
+
+
+def patient_series(con: sqlite3.Connection, patient_id: str, view: str = GM_VIEW, metrics=None) -> pd.DataFrame:
+    """Longitudinal series of one patient: one row per study (oldest first) with the metrics of one view."""
+    metrics = _select_metrics(con, metrics)
+    sql = ("SELECT s.case_id, s.study_date, s.study_time, s.source_filename, "
+           + ", ".join(f'm."{c}"' for c in metrics)
+           + " FROM studies s JOIN measurements m ON m.case_id = s.case_id AND m.view = ?"
+           " WHERE s.patient_id = ? ORDER BY s.study_date, s.study_time, s.case_id")
+    return pd.read_sql_query(sql, con, params=(view, str(patient_id)))
+
+
+def cohort_summary(con: sqlite3.Connection, view: str = GM_VIEW, metrics=None, by: str = None,
+                   date_from: str = None, date_to: str = None) -> pd.DataFrame:
+    """n / mean / std / min / max of the metrics of one view over the cohort.
+    by: None (whole cohort), "year" or "patient". date_from/date_to: YYYYMMDD, inclusive.
+    """
+    metrics = _select_metrics(con, metrics)
+    group = {None: "'all'", "year": "substr(s.study_date, 1, 4)", "patient": "s.patient_id"}[by]
+    cols = []
+    for c in metrics:
+        q = f'm."{c}"'
+        cols += [f'COUNT({q}) AS "{c}_n"', f'AVG({q}) AS "{c}_mean"',
+                 # population variance from the running sums, clamped against rounding below zero
+                 f'MAX(AVG({q} * {q}) - AVG({q}) * AVG({q}), 0) AS "{c}_var"',
+                 f'MIN({q}) AS "{c}_min"', f'MAX({q}) AS "{c}_max"']
+    where, params = ["m.view = ?"], [view]
+    if date_from:
+        where.append("s.study_date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        where.append("s.study_date <= ?")
+        params.append(str(date_to))
+    sql = (f"SELECT {group} AS grp, COUNT(DISTINCT s.patient_id) AS n_patients, COUNT(*) AS n_studies, "
+           + ", ".join(cols)
+           + " FROM measurements m JOIN studies s ON s.case_id = m.case_id WHERE " + " AND ".join(where)
+           + " GROUP BY grp ORDER BY grp")
+    df = pd.read_sql_query(sql, con, params=params)
+    for c in metrics:
+        df[f"{c}_var"] = df[f"{c}_var"] ** 0.5
+    df = df.rename(columns={"grp": by or "cohort", **{f"{c}_var": f"{c}_std" for c in metrics}})
+    return df[[by or "cohort", "n_patients", "n_studies"]
+              + [f"{c}_{s}" for c in metrics for s in ("n", "mean", "std", "min", "max")]]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Cohort results store (SQLite): quantification output joined with the "
+                                             "mapping and the DICOM<->NIfTI reference, with patient/cohort queries.")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="(Re)build the store from the CSVs")
+    build.add_argument("--uptake_csv", required=True,
+                       help="quantify_soft_tissue_uptake.py output or run_pipeline.py out_csv (already joined)")
+    build.add_argument("--mapping_csv", default=None, help="case_id -> source file mapping (nnunet_inference_mapping.csv)")
+    build.add_argument("--reference_csv", default=None, help="dicom_nifti_reference.csv")
+    build.add_argument("--db", required=True, help="Store file (.sqlite)")
+    build.add_argument("--sep", default=";", help="CSV separator, default ';'")
+    build.add_argument("--views", nargs="+", default=["ant", "post"],
+                       help="View names of the quantification run (<view>_<metric> columns; GM is always accepted). "
+                            "Other column prefixes are an error. Default: ant post.")
+
+    for name, help_text in (("patient", "Longitudinal series of one patient"), ("summary", "Cohort summary")):
+        q = sub.add_parser(name, help=help_text)
+        q.add_argument("--db", required=True, help="Store file (.sqlite)")
+        q.add_argument("--view", default="GM", help=f"ant, post, GM, ... ({SINGLE_VIEW} for single-view runs). Default GM.")
+        q.add_argument("--metrics", nargs="+", default=None, help="Metric columns. Default: all.")
+        q.add_argument("--out_csv", default=None, help="Write the result to this CSV instead of printing it")
+        if name == "patient":
+            q.add_argument("--patient_id", required=True, help="PatientID")
+        else:
+            q.add_argument("--by", choices=["year", "patient"], default=None, help="Group by. Default: whole cohort.")
+            q.add_argument("--date_from", default=None, help="First study date (YYYYMMDD)")
+            q.add_argument("--date_to", default=None, help="Last study date (YYYYMMDD)")
+    args = ap.parse_args()
+
+    if args.command == "build":
+        run_build(args)
+    else:
+        run_query(args)
+
+
+def run_build(args):
+    read = lambda p: pd.read_csv(p, sep=args.sep, dtype=str) if p else None
+    # everything as text (PatientIDs with leading zeros); the metric columns are converted in the store
+    uptake = read(args.uptake_csv)
+    results = join_results(uptake, read(args.mapping_csv), read(args.reference_csv))
+    sizes = build_store(results, args.db, args.views)
+    print("Studies:", sizes["studies"], "| measurements:", sizes["measurements"])
+    print("Saved:", args.db)
+
+
+def run_query(args):
+    con = open_store(args.db)
+    t0 = time.perf_counter()
+    if args.command == "patient":
+        df = patient_series(con, args.patient_id, args.view, args.metrics)
+    else:
+        df = cohort_summary(con, args.view, args.metrics, args.by, args.date_from, args.date_to)
+    elapsed = time.perf_counter() - t0
+    con.close()
+    if args.out_csv:
+        df.to_csv(args.out_csv, index=False, sep=";")
+        print("Saved:", args.out_csv)
+    else:
+        with pd.option_context("display.max_columns", None, "display.width", 200):
+            print(df.to_string(index=False))
+    print(f"{len(df)} rows in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
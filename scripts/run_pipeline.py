@@ -0,0 +1,640 @@
+import argparse
+import csv
+import json
+import shutil
+import sqlite3
+import subprocess
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import build_dicom_nifti_reference
+import decoded_cache
+from build_dicom_index import build_index_from_manifest
+from build_nifti_index import build_index, list_nifti, load_index, write_index
+from build_nnunet_inference_inputs import (MAPPING_COLUMNS, alias_row, list_tasks, process_one, skip_by_index,
+                                           skipped_row)
+from build_nnunet_inference_inputs_ant import extract_ant_as_hw1
+from build_nnunet_inference_inputs_post import extract_post_as_hw1
+from deduplicate_scans import (alias_case_ids, fan_out, find_duplicates, load_duplicates, open_hash_cache,
+                               write_duplicates)
+from instrumentation import RunStats, StageClock, profiled, shape_layout
+from label_cleanup import cleanup_argv, cleanup_columns
+from nifti_io import find_nii, load_for_output
+from nnunet_inference import iter_batches, load_predictor, predict_planes
+from quantify_soft_tissue_uptake import DEFAULT_MAPPING, GM_COLS, METRIC_COLS, gm_columns, quantify_planes
+from quantify_soft_tissue_uptake import main as quantify_main
+from results_cache import file_fingerprint, open_cache, load_cached_rows, store_rows, prune
+from results_store import build_store
+
+# One declarative config instead of PATH constants in every script.
+# Stages: index (DICOM index + NIfTI index + reference join) -> dedup (duplicate scans) -> inputs (ANT/POST nnU-Net inputs,
+# orientation fix applied in memory) -> predict (nnU-Net, external) -> quantify (+ join to the reference).
+# Duplicates are predicted/quantified once, as their canonical case, and copied to every alias at the end.
+# With nnunet.model_dir set, infer replaces inputs/predict/quantify: the planes go from the sources through
+# one in-process predictor straight into the quantification, without any NIfTI in between.
+# Every stage keeps its cache in work_dir, so a cohort refresh only redoes what changed.
+
+STAGES = ["index", "dedup", "inputs", "predict", "quantify", "infer"]
+FILE_STAGES = ["index", "dedup", "inputs", "predict", "quantify"]
+IN_PROCESS_STAGES = ["index", "dedup", "infer"]
+
+EXAMPLE_CONFIG = {
+    "work_dir": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\pipeline",
+    "out_csv": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\uptake.csv",
+    # indexed results store for patient/cohort queries (results_store.py); omit to write the CSV only
+    "results_db": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\uptake.sqlite",
+    "workers": 8,
+    "queue_size": 64,
+    "dicom": {
+        "root": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\Data",
+        "subfolders": ["DICOMS_AUT2020", "DICOMS_AUT2023"],
+        "tolerance_s": 1.0,
+    },
+    "sources": [
+        {"folder": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\NIFTI_AUT2020", "prefix": "AUT2020"},
+        # rot180: net in-plane rotation per view (replaces fix_orientation_2023.py + ant_180/post_180)
+        {"folder": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\NIFTI_AUT2023", "prefix": "AUT2023",
+         "rot180": ["ant", "post"]},
+    ],
+    "codec": {"out_dtype": "float32", "compresslevel": 1, "uncompressed": False},
+    # decoded-image cache shared with the standalone scripts (decoded_cache.py); omit to disable
+    "decode_cache": {"dir": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\decode_cache", "max_mb": 20000},
+    # connected-component cleanup of the predictions before quantifying (label_cleanup.py); omit for raw labels
+    "cleanup": {"labels": ["OS_bone", "US_bone"], "min_area": 50, "fill_holes": False},
+    "nnunet": {
+        # {input} / {output} are replaced per view; without a command the predictions are expected in pred dirs
+        "command": ["nnUNetv2_predict", "-i", "{input}", "-o", "{output}", "-d", "Dataset001_SoftTissueDiana",
+                    "-c", "2d", "-f", "all", "--continue_prediction"],
+        # in-process inference (stage infer, default when model_dir is set); remove model_dir to use the command
+        "model_dir": r"C:\Users\NukMed-AI\Desktop\Soft Tissue Diana\nnUNet_results\Dataset001_SoftTissueDiana"
+                     r"\nnUNetTrainer__nnUNetPlans__2d",
+        "folds": ["all"],
+        "checkpoint": "checkpoint_final.pth",
+        "device": "cpu",
+        "torch_threads": 8,
+        "batch_size": 32,
+        "preprocess_workers": 0,
+    },
+}
+
+
+class Config(dict):
+    """Config dict with the derived work_dir paths."""
+
+    @property
+    def views(self):
+        # view -> (nnU-Net input dir, prediction dir)
+        nn = self.get("nnunet", {})
+        return {
+            view: (Path(nn.get(f"{view}_input") or Path(self["work_dir"]) / f"nnunet_in_{view}"),
+                   Path(nn.get(f"{view}_pred") or Path(self["work_dir"]) / f"nnunet_pred_{view}"))
+            for view in ("ant", "post")
+        }
+
+
+def load_config(path) -> Config:
+    cfg = Config(json.loads(Path(path).read_text(encoding="utf-8")))
+    for key in ("work_dir", "out_csv", "sources"):
+        if key not in cfg:
+            raise ValueError(f"Config {path} needs '{key}'")
+    cfg.setdefault("workers", 8)
+    cfg.setdefault("queue_size", 64)
+    cfg.setdefault("codec", {"out_dtype": "float32", "compresslevel": None, "uncompressed": False})
+    Path(cfg["work_dir"]).mkdir(parents=True, exist_ok=True)
+    return cfg
+
+
+def bounded_imap(pool, fn, items, max_pending=64):
+    """Ordered pool.imap with back-pressure: at most max_pending tasks are submitted but not yet consumed.
+    (Pool.imap itself drains the whole input iterator up front, so a slow consumer lets results pile up.)
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+# --------------------------- stage: index ---------------------------
+
+def stage_index(cfg: Config):
+    """DICOM series index (manifest: only new/changed DICOMs are parsed), NIfTI index (headers only:
+    shape, dtype, n_frames, ... used by the later stages to skip sources without a view), reference join."""
+    work = Path(cfg["work_dir"])
+    nifti_csv = work / "nifti_index.csv"
+
+    files = [f for src in cfg["sources"] for f in list_nifti(src["folder"])]
+    rows = build_index(files, workers=cfg["workers"])
+    write_index(rows, nifti_csv)
+    print("NIfTI index:", len(rows), "files")
+
+    dicom = cfg.get("dicom")
+    if not dicom:
+        print("No 'dicom' section: reference join skipped")
+        return
+    dicom_root = Path(dicom["root"])
+    roots = [dicom_root / s for s in dicom.get("subfolders", [])] or [dicom_root]
+    roots = [r for r in roots if r.exists()]
+    if not roots:
+        raise FileNotFoundError(f"No valid DICOM folders found under {dicom_root}")
+
+    dicom_csv = work / "dicom_index_full.csv"
+    df = build_index_from_manifest(roots, work / "dicom_manifest.sqlite", workers=cfg["workers"])
+    df.to_csv(dicom_csv, index=False, sep=";")
+    print("DICOM index:", len(df), "series")
+
+    build_dicom_nifti_reference.main(dicom_csv, nifti_csv, work / "dicom_nifti_reference.csv",
+                                     tol_s=float(dicom.get("tolerance_s", 1.0)),
+                                     ambiguous_csv=work / "dicom_nifti_ambiguous.csv")
+
+
+# --------------------------- stage: dedup ---------------------------
+
+def stage_dedup(cfg: Config, log_json=None, progress_every=500):
+    """Duplicate scans across the sources (header pre-key, then decoded-pixel hash; hashes cached by file
+    stat). Writes duplicates.csv, which routes every duplicate to its canonical case in the later stages."""
+    work = Path(cfg["work_dir"])
+    dedup_csv = work / "duplicates.csv"
+    # the table from the last run must not decide which sources are looked at
+    dedup_csv.unlink(missing_ok=True)
+    stats = RunStats("pipeline:dedup", progress_every=progress_every)
+    with stats.stage("discover"):
+        tasks, _, _, _ = discover_sources(cfg)
+
+    cache = open_hash_cache(work / "dedup_cache.sqlite")
+    # sources with different in-memory fixes (rot180, reorient) give different inputs: never merged
+    extras = [json.dumps(opts, sort_keys=True) for _, opts in tasks]
+    duplicates = find_duplicates([p for (p, _, _), _ in tasks], extras, workers=cfg["workers"], cache=cache,
+                                 stats=stats)
+    cache.close()
+    write_duplicates(duplicates, dedup_csv)
+    print("Duplicates:", sum(p != c for p, (c, _) in duplicates.items()), "| table:", dedup_csv)
+    stats.report(log_json)
+
+
+# --------------------------- stage: inputs ---------------------------
+
+def discover_sources(cfg: Config, stats=None):
+    """[((path, prefix, i), options)] for all sources + their case ids (numbered like the builders),
+    {case_id: mapping row} of the sources the NIfTI index (stage index) shows to have no view, and
+    {alias case_id: (canonical case_id, path)} of the duplicates found by stage dedup (not in tasks)."""
+    tasks = []
+    for src in cfg["sources"]:
+        opts = {k: src[k] for k in ("reorient", "rot180") if k in src}
+        tasks.extend((t, opts) for t in list_tasks([(Path(src["folder"]), src["prefix"])]))
+    tasks = stable_case_numbers(cfg, tasks)
+
+    skipped = {}
+    nifti_csv = Path(cfg["work_dir"]) / "nifti_index.csv"
+    if nifti_csv.exists():
+        index = load_index(nifti_csv)
+        todo = []
+        for (p, prefix, i), opts in tasks:
+            reasons = skip_by_index(p, index)
+            if reasons is None:
+                todo.append(((p, prefix, i), opts))
+                continue
+            skipped[f"{prefix}_{i:06d}"] = skipped_row(p, f"{prefix}_{i:06d}", index)
+            for reason in reasons:
+                if stats is not None:
+                    stats.skip(reason)
+        tasks = todo
+
+    aliases = {}
+    dedup_csv = Path(cfg["work_dir"]) / "duplicates.csv"
+    if dedup_csv.exists():
+        paths = {f"{prefix}_{i:06d}": p for (p, prefix, i), _ in tasks}
+        found = alias_case_ids([t for t, _ in tasks], load_duplicates(dedup_csv))
+        aliases = {a: (c, paths[a]) for a, c in found.items()}
+        tasks = [((p, prefix, i), opts) for (p, prefix, i), opts in tasks if f"{prefix}_{i:06d}" not in aliases]
+    case_ids = [f"{prefix}_{i:06d}" for (_, prefix, i), _ in tasks]
+    return tasks, case_ids, skipped, aliases
+
+
+def stable_case_numbers(cfg: Config, tasks) -> list:
+    """Renumber builder tasks [((path, prefix, i), options)] so a case id stays with its source file across
+    runs: case_ids.sqlite in work_dir keeps path -> (prefix, number); files not seen before get the next free
+    number of their prefix (in source order), numbers of removed files are not reused. On the first run the
+    ids are the builders' positional ones, a file added later no longer shifts the ids of the others."""
+    con = sqlite3.connect(str(Path(cfg["work_dir"]) / "case_ids.sqlite"))
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS case_ids (path TEXT PRIMARY KEY, prefix TEXT NOT NULL,"
+                    " num INTEGER NOT NULL, UNIQUE (prefix, num))")
+        known = {path: (prefix, num) for path, prefix, num in con.execute("SELECT path, prefix, num FROM case_ids")}
+        last = {}
+        for prefix, num in known.values():
+            last[prefix] = max(last.get(prefix, 0), num)
+        out, new = [], []
+        for (p, prefix, _), opts in tasks:
+            path = str(Path(p).resolve())
+            hit = known.get(path)
+            if hit is None or hit[0] != prefix:
+                last[prefix] = last.get(prefix, 0) + 1
+                hit = known[path] = (prefix, last[prefix])
+                new.append((path, prefix, hit[1]))
+            out.append(((p, prefix, hit[1]), opts))
+        if new:
+            with con:
+                con.executemany("INSERT OR REPLACE INTO case_ids VALUES (?, ?, ?)", new)
+    finally:
+        con.close()
+    return out
+
+
+def source_keys(case_ids, tasks) -> dict:
+    # the source file (path + stat) and its options are the key: a case id only reuses cached work of its own file
+    return {cid: (f"{p}|{file_fingerprint(p)}", json.dumps(opts, sort_keys=True))
+            for cid, ((p, _, _), opts) in zip(case_ids, tasks)}
+
+
+def _input_task(task, out_ant: Path, out_post: Path, codec: dict):
+    # top-level so it can be pickled into pool workers.
+    # Also returns the views whose input content changed (an input written for the first time did not).
+    (p, prefix, i), opts = task
+    case_id = f"{prefix}_{i:06d}"
+    clock = StageClock()
+    before = {}
+    with clock("compare"):
+        for view, out_dir in (("ant", out_ant), ("post", out_post)):
+            old = find_nii(out_dir, f"{case_id}_0000")
+            if old is not None:
+                before[view] = file_fingerprint(old, "content")
+    row, times, skipped = process_one((p, prefix, i), out_ant, out_post, codec,
+                                      reorient=opts.get("reorient"), rot180=tuple(opts.get("rot180", ())))
+    with clock("compare"):
+        changed = [view for view, fp in before.items()
+                   if not row[f"{view}_path"] or file_fingerprint(row[f"{view}_path"], "content") != fp]
+    return row, {**times, **clock.times}, skipped, changed
+
+
+STALE_TABLE = ("CREATE TABLE IF NOT EXISTS stale_predictions (case_id TEXT NOT NULL, view TEXT NOT NULL,"
+               " pred_fp TEXT NOT NULL, PRIMARY KEY (case_id, view))")
+
+
+def stale_predictions(cfg: Config) -> dict:
+    """{(case_id, view): prediction path} of predictions made from an older input of the case (recorded by
+    stage_inputs). A prediction that was rewritten (or removed) since is no longer stale."""
+    con = open_cache(Path(cfg["work_dir"]) / "inputs_cache.sqlite")
+    con.execute(STALE_TABLE)
+    stale, resolved = {}, []
+    for case_id, view, pred_fp in con.execute("SELECT case_id, view, pred_fp FROM stale_predictions"):
+        pred = find_nii(cfg.views[view][1], case_id)
+        if pred is not None and file_fingerprint(pred) == pred_fp:
+            stale[(case_id, view)] = pred
+        else:
+            resolved.append((case_id, view))
+    if resolved:
+        with con:
+            con.executemany("DELETE FROM stale_predictions WHERE case_id = ? AND view = ?", resolved)
+    con.close()
+    return stale
+
+
+def stage_inputs(cfg: Config, log_json=None, progress_every=500):
+    """ANT/POST nnU-Net inputs for every source file; unchanged sources are not decoded again.
+    Predictions of cases whose input content changed are recorded as stale (never deleted: the prediction
+    folders may be user-supplied); stage predict redoes them, stage quantify leaves them out until then.
+    """
+    views = cfg.views
+    out_ant, out_post = views["ant"][0], views["post"][0]
+    for d in (out_ant, out_post):
+        d.mkdir(parents=True, exist_ok=True)
+    codec = cfg["codec"]
+    stats = RunStats("pipeline:inputs", progress_every=progress_every)
+
+    with stats.stage("discover"):
+        tasks, case_ids, skipped_rows, aliases = discover_sources(cfg, stats)
+    stats.total = len(tasks)
+
+    con = open_cache(Path(cfg["work_dir"]) / "inputs_cache.sqlite")
+    con.execute(STALE_TABLE)
+    with stats.stage("fingerprint"):
+        keys = source_keys(case_ids, tasks)
+    params = json.dumps(codec, sort_keys=True)
+    prune(con, keys)
+    cached = load_cached_rows(con, keys, params)
+
+    def outputs_exist(row):
+        return all(Path(row[c]).exists() for c in ("ant_path", "post_path") if row[c])
+
+    todo = [(cid, t) for cid, t in zip(case_ids, tasks) if not (cid in cached and outputs_exist(cached[cid]))]
+    print("Inputs: cached", len(tasks) - len(todo), "| to build", len(todo))
+
+    fn = partial(_input_task, out_ant=out_ant, out_post=out_post, codec=codec)
+    rows = dict(cached)
+    batch, stale = [], []
+
+    def flush():
+        with stats.stage("cache"):
+            store_rows(con, batch, keys, params)
+            with con:
+                con.executemany("INSERT OR REPLACE INTO stale_predictions VALUES (?, ?, ?)", stale)
+        batch.clear()
+        stale.clear()
+
+    n_stale = 0
+    with Pool(processes=max(1, cfg["workers"])) as pool:
+        for row, times, skipped, changed in bounded_imap(pool, fn, (t for _, t in todo), cfg["queue_size"]):
+            for reason in skipped:
+                stats.skip(reason)
+            stats.file_done(times)
+            rows[row["case_id"]] = row
+            # input content changed -> its existing prediction is stale
+            for view in changed:
+                pred = find_nii(views[view][1], row["case_id"])
+                if pred is not None:
+                    stale.append((row["case_id"], view, file_fingerprint(pred)))
+                    n_stale += 1
+            batch.append(row)
+            if len(batch) >= 500:
+                flush()
+    if batch:
+        flush()
+    con.close()
+    if n_stale:
+        print("Predictions now older than their input (recorded as stale):", n_stale)
+
+    rows = {cid: {**r, "canonical_case_id": cid} for cid, r in rows.items()}
+    rows.update({cid: {**r, "canonical_case_id": cid} for cid, r in skipped_rows.items()})
+    # duplicates reuse the inputs (and later the prediction) of their canonical case
+    rows.update({a: alias_row(p, a, rows[c]) for a, (c, p) in aliases.items()})
+
+    # cases without a view in this run (or now duplicates) must not keep old inputs around
+    for view, col in (("ant", "ant_path"), ("post", "post_path")):
+        keep = {Path(r[col]).name for r in rows.values() if r[col]}
+        for p in views[view][0].glob("*_0000.nii*"):
+            if p.name not in keep:
+                p.unlink()
+
+    mapping_csv = Path(cfg["work_dir"]) / "nnunet_inference_mapping.csv"
+    with open(mapping_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=MAPPING_COLUMNS, delimiter=";")
+        writer.writeheader()
+        writer.writerows(sorted(rows.values(), key=lambda r: r["case_id"]))
+    print("Mapping:", mapping_csv)
+    stats.report(log_json)
+
+
+# --------------------------- stage: predict ---------------------------
+
+def _command(command, in_dir: Path, out_dir: Path) -> list:
+    return [c.replace("{input}", str(in_dir)).replace("{output}", str(out_dir)) for c in command]
+
+
+def repredict(command, in_dir: Path, pred_dir: Path, case_ids, scratch: Path):
+    """Predict these cases again in a scratch folder and copy the results over their stale predictions
+    (--continue_prediction in pred_dir would keep the stale ones)."""
+    shutil.rmtree(scratch, ignore_errors=True)
+    (scratch / "in").mkdir(parents=True)
+    for case_id in case_ids:
+        src = find_nii(in_dir, f"{case_id}_0000")
+        if src is not None:
+            shutil.copy2(src, scratch / "in" / src.name)
+    cmd = _command(command, scratch / "in", scratch / "out")
+    print("re-predict:", " ".join(cmd))
+    subprocess.run(cmd, check=True)
+    for p in (scratch / "out").glob("*.nii*"):
+        shutil.copy2(p, pred_dir / p.name)
+    shutil.rmtree(scratch)
+
+
+def stage_predict(cfg: Config):
+    """Run the configured nnU-Net command per view; with --continue_prediction only cases without a
+    prediction are predicted, cases with a stale prediction (changed input, see stage_inputs) are redone first."""
+    command = cfg.get("nnunet", {}).get("command")
+    stale = stale_predictions(cfg)
+    for view, (in_dir, pred_dir) in cfg.views.items():
+        n_in = len(list(in_dir.glob("*_0000.nii*")))
+        redo = sorted(case_id for case_id, v in stale if v == view)
+        if not command:
+            n_pred = len(list(pred_dir.glob("*.nii*"))) if pred_dir.exists() else 0
+            print(f"{view}: no nnunet.command configured, using {n_pred} existing predictions for {n_in} inputs")
+            if redo:
+                print(f"{view}: {len(redo)} predictions are older than their input, e.g. {redo[:3]}: "
+                      "predict them again (they are left out of quantify until then)")
+            continue
+        pred_dir.mkdir(parents=True, exist_ok=True)
+        if redo:
+            repredict(command, in_dir, pred_dir, redo, Path(cfg["work_dir"]) / f"repredict_{view}")
+        cmd = _command(command, in_dir, pred_dir)
+        print(f"{view}:", " ".join(cmd))
+        subprocess.run(cmd, check=True)
+
+
+# --------------------------- stage: quantify ---------------------------
+
+def stage_quantify(cfg: Config, log_json=None, progress_every=500):
+    """Multi-view quantification (results cache: only cases with changed image/prediction are redone),
+    then one output row per case with its source file and DICOM reference columns."""
+    work = Path(cfg["work_dir"])
+    uptake_csv = work / "uptake_by_case.csv"
+    argv = ["--out_csv", str(uptake_csv), "--cache", str(work / "quantify_cache.sqlite"),
+            "--workers", str(cfg["workers"]), "--progress_every", str(progress_every), "--skip_errors"]
+    for view, (in_dir, pred_dir) in cfg.views.items():
+        if in_dir.exists() and pred_dir.exists():
+            argv += ["--view", view, str(in_dir), str(pred_dir)]
+    if "--view" not in argv:
+        raise FileNotFoundError("No nnU-Net inputs/predictions to quantify (run the inputs and predict stages)")
+    argv += cleanup_argv(cfg.get("cleanup"))
+    if log_json:
+        argv += ["--log_json", str(log_json)]
+    quantify_main(argv)
+
+    out = pd.read_csv(uptake_csv, sep=";", dtype={"case_id": str})
+    stale = {case_id for case_id, _ in stale_predictions(cfg)}
+    if stale:
+        out = out[~out["case_id"].isin(stale)]
+        print("Left out (prediction older than its input, run stage predict):", len(stale))
+    mapping_csv = work / "nnunet_inference_mapping.csv"
+    if mapping_csv.exists():
+        mapping = pd.read_csv(mapping_csv, sep=";", dtype=str)
+        if "canonical_case_id" in mapping.columns:
+            alias = mapping[mapping["canonical_case_id"] != mapping["case_id"]]
+            out = fan_out(out, dict(zip(alias["case_id"], alias["canonical_case_id"])))
+        out = out.merge(mapping[["case_id", "source_path", "source_filename"]], on="case_id", how="left")
+    write_output_csv(cfg, out)
+
+
+def write_output_csv(cfg: Config, out: pd.DataFrame):
+    """Join the per-case uptake rows (with source_path) to the DICOM reference and write out_csv
+    (and the results store, if results_db is configured)."""
+    reference_csv = Path(cfg["work_dir"]) / "dicom_nifti_reference.csv"
+    if reference_csv.exists() and "source_path" in out.columns:
+        ref = pd.read_csv(reference_csv, sep=";", dtype=str)
+        out = build_dicom_nifti_reference.merge_reference(out, ref)
+
+    out_csv = Path(cfg["out_csv"])
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    out.to_csv(out_csv, index=False, sep=";")
+    print("Saved:", out_csv)
+    if cfg.get("results_db"):
+        sizes = build_store(out, cfg["results_db"], views=list(cfg.views))
+        print("Saved:", cfg["results_db"], "| studies:", sizes["studies"], "| measurements:", sizes["measurements"])
+
+
+# --------------------------- stage: infer ---------------------------
+
+VIEW_EXTRACTORS = {"ant": extract_ant_as_hw1, "post": extract_post_as_hw1}
+
+
+def _plane_task(task):
+    # top-level so it can be pickled into pool workers; like process_one, but the views stay in memory
+    (p, prefix, i), opts = task
+    clock = StageClock()
+    with clock("read"):
+        x, _, _ = load_for_output(p, "float32", reorient=opts.get("reorient"))
+    row = {"case_id": f"{prefix}_{i:06d}", "source_path": str(p), "source_filename": p.name}
+    planes, skipped = {}, []
+    with clock("extract"):
+        for view, extract in VIEW_EXTRACTORS.items():
+            hw1 = extract(x)
+            if hw1 is None:
+                skipped.append(f"{view}: unsupported shape {shape_layout(x.shape)}")
+                continue
+            plane = hw1[:, :, 0]
+            if view in opts.get("rot180", ()):
+                plane = np.rot90(plane, 2)
+            planes[view] = np.ascontiguousarray(plane)
+    return row, planes, clock.times, skipped
+
+
+def stage_infer(cfg: Config, log_json=None, progress_every=500):
+    """Sources -> ANT/POST planes (reader pool) -> one persistent nnU-Net predictor (batches) -> uptake rows.
+    Replaces inputs + predict + quantify; cached per source file fingerprint and model checkpoint.
+    """
+    nn = cfg.get("nnunet", {})
+    if not nn.get("model_dir"):
+        raise ValueError("Stage infer needs nnunet.model_dir in the config")
+    model_dir = Path(nn["model_dir"])
+    folds = [str(f) for f in nn.get("folds", ["all"])]
+    checkpoint = nn.get("checkpoint", "checkpoint_final.pth")
+    batch_size = int(nn.get("batch_size", 32))
+    stats = RunStats("pipeline:infer", progress_every=progress_every)
+
+    with stats.stage("discover"):
+        tasks, case_ids, skipped_rows, aliases = discover_sources(cfg, stats)
+    stats.total = len(tasks)
+
+    # new weights (retraining) invalidate every cached row
+    checkpoints = {f: file_fingerprint(model_dir / f"fold_{f}" / checkpoint) for f in folds}
+    cleanup = cfg.get("cleanup")
+    params = json.dumps({"model_dir": str(model_dir), "checkpoints": checkpoints,
+                         "mirroring": nn.get("use_mirroring", True), "mapping": DEFAULT_MAPPING,
+                         **({"cleanup": cleanup} if cleanup else {})}, sort_keys=True)
+    con = open_cache(Path(cfg["work_dir"]) / "infer_cache.sqlite")
+    with stats.stage("fingerprint"):
+        keys = source_keys(case_ids, tasks)
+    prune(con, keys)
+    cached = load_cached_rows(con, keys, params)
+    todo = [t for cid, t in zip(case_ids, tasks) if cid not in cached]
+    print("Infer: cached", len(cached), "| to predict", len(todo))
+
+    rows = dict(cached)
+    # reader pool first: workers must not be forked from a process that already runs torch
+    with Pool(processes=max(1, cfg["workers"])) as pool:
+        predictor = None
+        if todo:
+            with stats.stage("load_model"):
+                predictor = load_predictor(model_dir, folds, checkpoint, nn.get("device", "cpu"),
+                                           nn.get("torch_threads"), use_mirroring=nn.get("use_mirroring", True))
+        loaded = bounded_imap(pool, _plane_task, todo, cfg["queue_size"])
+        for batch in iter_batches(loaded, batch_size):
+            clock = StageClock()
+            jobs = [(k, view, plane) for k, (_, planes, _, _) in enumerate(batch) for view, plane in planes.items()]
+            with clock("predict"):
+                segs = predict_planes(predictor, [plane for _, _, plane in jobs], int(nn.get("preprocess_workers", 0)))
+
+            with clock("quantify"):
+                for (k, view, plane), seg in zip(jobs, segs):
+                    row = batch[k][0]
+                    name = f"{row['case_id']} [{view}]"
+                    for m, v in quantify_planes(plane, seg, DEFAULT_MAPPING, name=name, cleanup=cleanup).items():
+                        row[f"{view}_{m}"] = v
+                for row, planes, _, _ in batch:
+                    if "ant" in planes and "post" in planes:
+                        row.update(gm_columns(row, "ant", "post"))
+            with clock("cache"):
+                store_rows(con, [r for r, _, _, _ in batch], keys, params)
+
+            # predict/quantify/cache ran once for the whole batch: spread evenly over its cases
+            for row, _, times, skipped in batch:
+                for reason in skipped:
+                    stats.skip(reason)
+                stats.file_done({**times, **{k: v / len(batch) for k, v in clock.times.items()}})
+                rows[row["case_id"]] = row
+    con.close()
+
+    cc_cols = cleanup_columns(cleanup, DEFAULT_MAPPING) if cleanup else []
+    columns = (["case_id"] + [f"{v}_{m}" for v in VIEW_EXTRACTORS for m in METRIC_COLS + cc_cols] + GM_COLS
+               + ["source_path", "source_filename"])
+    rows.update({cid: {k: r[k] for k in ("case_id", "source_path", "source_filename")}
+                 for cid, r in skipped_rows.items()})
+    # duplicates: the canonical case's results under their own case id and source
+    rows.update({a: {**rows[c], "case_id": a, "source_path": str(p), "source_filename": p.name}
+                 for a, (c, p) in aliases.items() if c in rows})
+    out = pd.DataFrame(sorted(rows.values(), key=lambda r: r["case_id"]), columns=columns)
+    uptake_csv = Path(cfg["work_dir"]) / "uptake_by_case.csv"
+    out.to_csv(uptake_csv, index=False, sep=";")
+    write_output_csv(cfg, out)
+    stats.report(log_json, extra={"cache_hits": len(cached)})
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run the pipeline DICOM/NIfTI -> nnU-Net inputs -> predictions -> uptake CSV "
+                                             "from one JSON config, redoing only what changed.")
+    ap.add_argument("--config", help="Pipeline config (JSON), see --example_config")
+    ap.add_argument("--stages", nargs="+", choices=STAGES, default=None,
+                    help="Stages to run. Default: index dedup infer if nnunet.model_dir is configured, "
+                         "else index dedup inputs predict quantify.")
+    ap.add_argument("--example_config", default=None, help="Write an example config to this path and exit")
+    ap.add_argument("--clean", action="store_true", help="Delete work_dir (all stage caches) before running")
+    ap.add_argument("--log_dir", default=None, help="Write one JSON run log per stage (<stage>.json) into this folder")
+    ap.add_argument("--profile", default=None, help="Write a cProfile dump (.prof) of the whole run")
+    ap.add_argument("--progress_every", type=int, default=500, help="Print progress every N files. Default 500.")
+    args = ap.parse_args()
+
+    if args.example_config:
+        Path(args.example_config).write_text(json.dumps(EXAMPLE_CONFIG, indent=2), encoding="utf-8")
+        print("Saved:", args.example_config)
+        return
+    if not args.config:
+        ap.error("--config is required")
+
+    cfg = load_config(args.config)
+    if cfg.get("decode_cache"):
+        decoded_cache.configure(cfg["decode_cache"].get("dir"), cfg["decode_cache"].get("max_mb"))
+    if args.clean:
+        shutil.rmtree(cfg["work_dir"], ignore_errors=True)
+        Path(cfg["work_dir"]).mkdir(parents=True)
+
+    log_dir = Path(args.log_dir) if args.log_dir else None
+    if log_dir:
+        log_dir.mkdir(parents=True, exist_ok=True)
+    stages = args.stages or (IN_PROCESS_STAGES if cfg.get("nnunet", {}).get("model_dir") else FILE_STAGES)
+    with profiled(args.profile):
+        for stage in [s for s in STAGES if s in stages]:
+            print(f"=== {stage} ===")
+            log_json = log_dir / f"{stage}.json" if log_dir else None
+            if stage == "index":
+                stage_index(cfg)
+            elif stage == "dedup":
+                stage_dedup(cfg, log_json, args.progress_every)
+            elif stage == "inputs":
+                stage_inputs(cfg, log_json, args.progress_every)
+            elif stage == "predict":
+                stage_predict(cfg)
+            elif stage == "quantify":
+                stage_quantify(cfg, log_json, args.progress_every)
+            elif stage == "infer":
+                stage_infer(cfg, log_json, args.progress_every)
+
+
+if __name__ == "__main__":
+    main()
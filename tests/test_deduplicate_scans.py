@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+from deduplicate_scans import find_duplicates  # noqa: E402
+
+
+def _save(path, data):
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(path))
+    return path
+
+
+def test_find_duplicates_with_singleton_group(tmp_path):
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 1000, (16, 16, 1)).astype(np.int16)
+    b = rng.integers(0, 1000, (16, 16, 1)).astype(np.int16)
+    files = [
+        _save(tmp_path / "a.nii.gz", a),
+        _save(tmp_path / "a_reexport.nii.gz", a.copy()),
+        _save(tmp_path / "b.nii.gz", b),
+        # only scan of its shape: a pre-key group of one, never hashed
+        _save(tmp_path / "single.nii.gz", rng.integers(0, 1000, (8, 8, 1)).astype(np.int16)),
+    ]
+
+    duplicates = find_duplicates(files)
+
+    assert set(duplicates) == {files[0], files[1]}
+    assert duplicates[files[0]][0] == files[0]
+    assert duplicates[files[1]][0] == files[0]
+    assert duplicates[files[0]][1] == duplicates[files[1]][1]
+
+
+def test_find_duplicates_without_candidates(tmp_path):
+    files = [_save(tmp_path / f"s{n}.nii.gz", np.zeros((n, n, 1), dtype=np.int16)) for n in (4, 5, 6)]
+    assert find_duplicates(files) == {}
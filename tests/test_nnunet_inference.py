@@ -0,0 +1,103 @@
+import sys
+from argparse import Namespace
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import nnunet_inference  # noqa: E402
+from label_store import LabelRuns, rle_path  # noqa: E402
+from nifti_io import save_nifti  # noqa: E402
+from nnunet_inference import plane_to_nnunet, predict_planes, seg_from_nnunet  # noqa: E402
+
+H, W = 6, 9
+
+
+class DummyPredictor:
+    """Stands in for nnUNetPredictor: (C, Z, Y, X) image -> (Z, Y, X) label map that depends on the
+    position and the intensity, so any axis mix-up changes the result."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def _predict(self, x, props):
+        assert x.ndim == 4 and x.shape[:2] == (1, 1) and x.dtype == np.float32
+        assert props["spacing"] == [1.0, 1.0, 1.0]
+        self.calls += 1
+        _, _, ny, nx = x.shape
+        yy, xx = np.meshgrid(np.arange(ny), np.arange(nx), indexing="ij")
+        return ((xx + 2 * yy + (x[0, 0] > np.median(x))) % 5)[None].astype(np.int64)
+
+    def predict_single_npy_array(self, x, props, prev_stage, truncated_ofname, save_probabilities):
+        return self._predict(x, props)
+
+    def predict_from_list_of_npy_arrays(self, images, prev_stage, props, truncated_ofname, num_processes=1):
+        return [self._predict(x, p) for x, p in zip(images, props)]
+
+
+def subprocess_path(predictor, image_path: Path) -> np.ndarray:
+    """What nnUNetv2_predict does with one of our (H,W,1) inputs: SimpleITK reads the voxel axes reversed
+    (C, Z, Y, X) = (1, 1, W, H), the (Z, Y, X) prediction is written back reversed as (H,W,1)."""
+    x = np.asanyarray(nib.load(str(image_path)).dataobj).astype(np.float32).T[None]
+    seg = predictor.predict_single_npy_array(x, {"spacing": [1.0, 1.0, 1.0]}, None, None, False)
+    return seg.T[:, :, 0].astype(np.uint8)
+
+
+@pytest.fixture
+def images_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    d = tmp_path / "in"
+    d.mkdir()
+    for k in range(3):
+        # (H,W,1) with an identity affine, like build_nnunet_inference_inputs.py writes them
+        save_nifti(rng.random((H, W, 1)).astype(np.float32), d / f"CASE_{k:06d}_0000.nii.gz")
+    return d
+
+
+def test_plane_layout_round_trip():
+    plane = np.arange(H * W, dtype=np.float32).reshape(H, W)
+    x = plane_to_nnunet(plane)
+    assert x.shape == (1, 1, W, H) and x.dtype == np.float32 and x.flags.c_contiguous
+    assert x[0, 0, 2, 5] == plane[5, 2]
+    back = seg_from_nnunet((x[0] % 5).astype(np.int64))
+    assert back.dtype == np.uint8
+    np.testing.assert_array_equal(back, (plane % 5).astype(np.uint8))
+    with pytest.raises(ValueError):
+        plane_to_nnunet(plane[:, :, None])
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_predict_planes_matches_subprocess_path(images_dir, workers):
+    predictor = DummyPredictor()
+    files = sorted(images_dir.glob("*_0000.nii.gz"))
+    planes = [np.asanyarray(nib.load(str(f)).dataobj)[:, :, 0] for f in files]
+    segs = predict_planes(predictor, planes, workers=workers)
+    assert predictor.calls == len(files)
+    for f, seg in zip(files, segs):
+        assert seg.shape == (H, W) and seg.dtype == np.uint8
+        np.testing.assert_array_equal(seg, subprocess_path(DummyPredictor(), f))
+    assert predict_planes(predictor, []) == []
+
+
+@pytest.mark.parametrize("out_format", ["nifti", "rle"])
+def test_run_writes_label_maps(images_dir, tmp_path, monkeypatch, out_format):
+    monkeypatch.setattr(nnunet_inference, "load_predictor", lambda *a, **k: DummyPredictor())
+    out_dir = tmp_path / "pred"
+    args = Namespace(model_dir="unused", images_dir=str(images_dir), out_dir=str(out_dir), folds=["all"],
+                     checkpoint="checkpoint_final.pth", device="cpu", torch_threads=None, workers=0, batch_size=2,
+                     no_mirroring=False, uncompressed=False, out_format=out_format, log_json=None, profile=None,
+                     progress_every=500)
+    nnunet_inference.run(args)
+
+    for f in sorted(images_dir.glob("*_0000.nii.gz")):
+        case_id = f.name[: -len("_0000.nii.gz")]
+        if out_format == "rle":
+            seg = LabelRuns.load(rle_path(out_dir, case_id)).to_dense()
+        else:
+            img = nib.load(str(out_dir / f"{case_id}.nii.gz"))
+            assert img.shape == (H, W, 1)
+            seg = np.asanyarray(img.dataobj)[:, :, 0]
+        np.testing.assert_array_equal(seg, subprocess_path(DummyPredictor(), f))
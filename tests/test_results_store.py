@@ -0,0 +1,38 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+from quantify_soft_tissue_uptake import GM_COLS, METRIC_COLS  # noqa: E402
+from results_store import SINGLE_VIEW, measurement_rows, split_views  # noqa: E402
+
+
+def _wide(views):
+    cols = [f"{v}_{m}" for v in views for m in METRIC_COLS + ["OS_soft_components"]] + GM_COLS
+    df = pd.DataFrame([[float(i)] * len(cols) for i in range(3)], columns=cols)
+    return df.assign(case_id=[f"CASE_{i:06d}" for i in range(3)], source_path="x.nii.gz")
+
+
+def test_split_views_with_underscore_in_view_name():
+    df = _wide(["ant_180", "post"])
+
+    views = split_views(df, ["ant_180", "post"])
+
+    assert set(views) == {"ant_180", "post", "GM"}
+    assert views["ant_180"] == [f"ant_180_{m}" for m in METRIC_COLS + ["OS_soft_components"]]
+    long = measurement_rows(df, ["ant_180", "post"])
+    assert len(long) == 9
+    assert set(long.columns) - {"case_id", "view"} == set(METRIC_COLS) | {"OS_soft_components"}
+
+
+def test_split_views_rejects_unknown_prefix():
+    with pytest.raises(ValueError, match="ant_180"):
+        split_views(_wide(["ant_180", "post"]), ["ant", "post"])
+
+
+def test_split_views_single_view():
+    df = pd.DataFrame([[1.0] * len(METRIC_COLS)], columns=METRIC_COLS).assign(case_id="CASE_000001")
+    assert split_views(df, ["ant", "post"]) == {SINGLE_VIEW: METRIC_COLS}